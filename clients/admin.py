@@ -1,6 +1,7 @@
+from django import forms
 from django.contrib import admin
 
-from clients.models import Client, Configuration, ConfigurationFile
+from clients.models import Client, Configuration, ConfigurationFile, Blob
 
 class ConfigurationInline(admin.TabularInline):
     model = Configuration
@@ -21,16 +22,44 @@ class ConfigurationAdmin(admin.ModelAdmin):
     list_display = ('file_path', 'client', 'is_binary', 'is_encrypted', 'is_case_sensitive', 'is_disabled',)
     list_filter = ('client__client_name', 'is_binary', 'is_encrypted', 'is_case_sensitive', 'is_disabled',)
     #date_hierarchy = 'log_time'
-    #readonly_fields = ('log_time',)
+    readonly_fields = ('revision_count',)
     search_fields = ['client', 'file_path',]
     #inlines = [ConfigurationFileInline,]
 admin.site.register(Configuration, ConfigurationAdmin)
 
+class ConfigurationFileForm(forms.ModelForm):
+    content = forms.CharField(widget=forms.Textarea, required=False)
+    
+    class Meta:
+        model = ConfigurationFile
+        exclude = ('blob',)
+    
+    def __init__(self, *args, **kwargs):
+        super(ConfigurationFileForm, self).__init__(*args, **kwargs)
+        if self.instance.pk:
+            content = self.instance.content
+            if isinstance(content, bytes):
+                # Binary content can't be edited as text.
+                content = '(binary, {} bytes)'.format(len(content))
+                self.fields['content'].widget.attrs['readonly'] = True
+            self.fields['content'].initial = content
+    
+    def save(self, commit=True):
+        if not isinstance(self.instance.content, bytes):
+            self.instance.content = self.cleaned_data.get('content', '')
+        return super(ConfigurationFileForm, self).save(commit)
+
 class ConfigurationFileAdmin(admin.ModelAdmin):
+    form = ConfigurationFileForm
     #list_display = ('short_django_sessionid', 'log_time', 'ip', 'url', 'referrer', 'method')
     #list_filter = ('log_time', 'method')
     #date_hierarchy = 'log_time'
     #readonly_fields = ('log_time',)
     #search_fields = ['django_sessionid', 'ip', 'user_agent', 'log_time', 'juror_id', 'annual_nbr']
-    pass
 admin.site.register(ConfigurationFile, ConfigurationFileAdmin)
+
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ('sha1_checksum',)
+    search_fields = ['sha1_checksum',]
+    readonly_fields = ('sha1_checksum', 'content',)
+admin.site.register(Blob, BlobAdmin)
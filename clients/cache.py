@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    A thread safe, in-process LRU cache. Entries expire `ttl` seconds after
+    they were set, and the least recently used entries are evicted once
+    there are more than `max_entries` of them, or once the `sizeof` of all
+    values adds up to more than `max_size`. `hits` and `misses` count
+    lookups, to help size it.
+    """
+    def __init__(self, max_entries=1000, ttl=None, max_size=None, sizeof=len):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        # Doesn't count as a lookup or refresh the entry.
+        entry = self._entries.get(key, None)
+        return entry is not None and (entry[1] is None or entry[1] >= time.time())
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.max_size is not None else 0
+        with self._lock:
+            self._pop(key)
+            if self.max_size is not None and size > self.max_size:
+                # Would evict everything else and still not fit.
+                return
+            self._entries[key] = (value, expires, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_size is not None and self.size > self.max_size):
+                self._pop(next(iter(self._entries)))
+    
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+    
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = 0
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
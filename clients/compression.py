@@ -0,0 +1,51 @@
+import gzip
+import io
+import zlib
+
+
+class CodecError(Exception):
+    pass
+
+
+def encode(codec, data):
+    if codec == 'raw':
+        return data
+    if codec == 'gzip':
+        buf = io.BytesIO()
+        # A fixed mtime keeps the output of identical content identical.
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fh:
+            fh.write(data)
+        return buf.getvalue()
+    if codec == 'zlib':
+        return zlib.compress(data)
+    raise CodecError('Unknown codec `{}`.'.format(codec))
+
+
+def encode_file(codec, fh, chunk_size=64 * 1024):
+    """
+    Encode the rest of the file object `fh` with `codec`, reading it a chunk
+    at a time so only the encoded bytes are held whole.
+    """
+    chunks = iter(lambda: fh.read(chunk_size), b'')
+    if codec == 'raw':
+        return b''.join(chunks)
+    if codec == 'gzip':
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+            for chunk in chunks:
+                gz.write(chunk)
+        return buf.getvalue()
+    if codec == 'zlib':
+        compressor = zlib.compressobj()
+        return b''.join(compressor.compress(chunk) for chunk in chunks) + compressor.flush()
+    raise CodecError('Unknown codec `{}`.'.format(codec))
+
+
+def decode(codec, data):
+    if codec == 'raw':
+        return data
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    raise CodecError('Unknown codec `{}`.'.format(codec))
@@ -0,0 +1,41 @@
+import json
+from difflib import SequenceMatcher
+
+
+class DeltaError(Exception):
+    pass
+
+
+def make_delta(base, target):
+    """
+    Return a line delta that rebuilds `target` from `base`.
+    
+    The delta is a JSON list of operations: `[start, count]` copies `count`
+    lines of `base` starting at line `start`, and a string inserts new text.
+    """
+    base_lines = base.splitlines(True)
+    target_lines = target.splitlines(True)
+    matcher = SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2 - i1])
+        elif tag in ('replace', 'insert'):
+            ops.append(''.join(target_lines[j1:j2]))
+    return json.dumps(ops, separators=(',', ':'))
+
+
+def apply_delta(base, delta):
+    base_lines = base.splitlines(True)
+    try:
+        ops = json.loads(delta)
+    except ValueError:
+        raise DeltaError('Delta is not valid JSON.')
+    out = []
+    for op in ops:
+        if isinstance(op, list):
+            start, count = op
+            out.extend(base_lines[start:start + count])
+        else:
+            out.append(op)
+    return ''.join(out)
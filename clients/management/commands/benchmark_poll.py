@@ -0,0 +1,50 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from clients.models import Client, Configuration, ConfigurationFile
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Measure the SQL query count and time of a poll manifest as the number of tracked files grows.'
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='10,100,1000,10000',
+                    help='Comma separated list of file counts to benchmark.'),
+    )
+    
+    def handle(self, *args, **options):
+        sizes = [int(x) for x in options.get('sizes').split(',') if x.strip()]
+        self.stdout.write('{:>8s} {:>8s} {:>10s}'.format('files', 'queries', 'seconds'))
+        for size in sizes:
+            queries, seconds = self.benchmark(size)
+            self.stdout.write('{:>8d} {:>8d} {:>10.4f}'.format(size, queries, seconds))
+    
+    def benchmark(self, size):
+        """
+        Build a throwaway client tracking `size` files, time one manifest and
+        roll everything back so the database is left untouched.
+        """
+        result = {}
+        try:
+            with transaction.atomic():
+                client = Client(client_name='benchmark-poll-{}'.format(size), is_disabled=False)
+                client.save()
+                for i in range(size):
+                    conf = Configuration.objects.create(client=client, file_path='/etc/bench/{}.conf'.format(i))
+                    ConfigurationFile(configuration=conf, sha1_checksum='0' * 40, mtime=1, content='x').save()
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.time()
+                    client.get_managed_configuration()
+                    result['seconds'] = time.time() - start
+                result['queries'] = len(ctx.captured_queries)
+                raise Rollback()
+        except Rollback:
+            pass
+        return result['queries'], result['seconds']
@@ -0,0 +1,79 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clients.models import Client, Configuration, ConfigurationFile, Blob
+from clients.models import content_cache
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Measure stored size and reconstruct latency of a delta encoded revision history.'
+    option_list = BaseCommand.option_list + (
+        make_option('--revisions', dest='revisions', type='int', default=200,
+                    help='Number of revisions to write.'),
+        make_option('--lines', dest='lines', type='int', default=400,
+                    help='Number of lines in the benchmarked file.'),
+    )
+    
+    def handle(self, *args, **options):
+        revisions = options.get('revisions')
+        lines = options.get('lines')
+        try:
+            with transaction.atomic():
+                self.benchmark(revisions, lines)
+                raise Rollback()
+        except Rollback:
+            pass
+    
+    def benchmark(self, revisions, lines):
+        """
+        Write `revisions` revisions of a `lines` line file, changing one line
+        each time, then report storage and the time to read back revisions at
+        increasing depth. Everything is rolled back afterwards.
+        """
+        client = Client(client_name='benchmark-revisions', is_disabled=False)
+        client.save()
+        conf = Configuration.objects.create(client=client, file_path='/etc/bench/revisions.conf')
+        body = ['setting_{} = {}\n'.format(i, i) for i in range(lines)]
+        conf_file = ConfigurationFile(configuration=conf, content=''.join(body))
+        conf_file.save()
+        for revision in range(2, revisions + 1):
+            body[revision % lines] = 'setting_{} = r{}\n'.format(revision % lines, revision)
+            conf_file.content = ''.join(body)
+            conf_file.save()
+        
+        blob_ids = ConfigurationFile.objects.filter(configuration=conf).values_list('blob_id', flat=True)
+        blobs = Blob.objects.filter(sha1_checksum__in=list(blob_ids))
+        stored = sum(b.get_stored_size() for b in blobs)
+        full = len(''.join(body)) * revisions
+        self.stdout.write('keyframe interval: {}'.format(getattr(settings, 'CMDB_DELTA_KEYFRAME_INTERVAL', 16)))
+        self.stdout.write('revisions: {}, keyframes: {}'.format(revisions, len([b for b in blobs if b.base_id is None])))
+        self.stdout.write('stored bytes: {} (full copies would be {}, {:.1f}x)'.format(
+            stored, full, float(full) / max(stored, 1)))
+        
+        self.stdout.write('{:>8s} {:>8s} {:>10s}'.format('depth', 'deltas', 'ms'))
+        depth = 0
+        while depth < revisions:
+            conf_file = ConfigurationFile.objects.select_related('blob').get(
+                configuration=conf, revision=revisions - depth)
+            blob = conf_file.blob
+            deltas = 0
+            while blob.base_id is not None:
+                deltas += 1
+                blob = blob.base
+            # Time a cold read: a fresh blob, so none of its chain is loaded,
+            # and nothing in the content cache.
+            blob = Blob.objects.get(pk=conf_file.blob_id)
+            content_cache.clear()
+            start = time.time()
+            blob.get_content()
+            elapsed = (time.time() - start) * 1000
+            self.stdout.write('{:>8d} {:>8d} {:>10.2f}'.format(depth, deltas, elapsed))
+            depth = depth * 2 if depth else 1
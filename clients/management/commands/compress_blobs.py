@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clients.models import Blob
+
+
+class Command(BaseCommand):
+    help = 'Re-encode stored file content with CMDB_BLOB_CODEC, in batches.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help='Number of blobs re-encoded per transaction.'),
+    )
+    
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        codec = getattr(settings, 'CMDB_BLOB_CODEC', 'gzip')
+        before = after = count = 0
+        last_pk = ''
+        while True:
+            with transaction.atomic():
+                blobs = list(Blob.objects.filter(pk__gt=last_pk).exclude(codec=codec).order_by('pk')[:batch_size])
+                if not blobs:
+                    break
+                for blob in blobs:
+                    size = blob.get_stored_size()
+                    blob.set_stored(blob.get_stored(), codec)
+                    if blob.codec != codec:
+                        # Too small to gain anything from compression.
+                        continue
+                    blob.save()
+                    before += size
+                    after += blob.get_stored_size()
+                    count += 1
+                last_pk = blobs[-1].pk
+            self.stdout.write('Re-encoded {} blobs...'.format(count))
+        self.stdout.write('Done: {} blobs, {} bytes before, {} bytes after.'.format(count, before, after))
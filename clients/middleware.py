@@ -0,0 +1,33 @@
+from io import BytesIO
+import zlib
+
+from django.conf import settings
+
+from clients.responses import error_msg
+
+
+class GzipRequestMiddleware(object):
+    """
+    Decode request bodies sent with `Content-Encoding: gzip`, as agents do
+    for large JSON documents, before any view reads them. Bodies that are
+    truncated or decode to more than `CMDB_UPLOAD_MAX_SIZE` bytes are
+    refused.
+    """
+    def process_request(self, request):
+        if request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower() != 'gzip':
+            return None
+        max_size = getattr(settings, 'CMDB_UPLOAD_MAX_SIZE', 64 * 1024 * 1024)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(request.body, max_size + 1)
+        except zlib.error:
+            return error_msg('Could not decode gzip request body.', status=400)
+        if len(body) > max_size or decompressor.unconsumed_tail:
+            return error_msg('Request body is larger than {} bytes.'.format(max_size), status=413)
+        if not decompressor.eof:
+            return error_msg('Gzip request body is truncated.', status=400)
+        request._body = body
+        request._stream = BytesIO(body)
+        request.META['CONTENT_LENGTH'] = str(len(body))
+        del request.META['HTTP_CONTENT_ENCODING']
+        return None
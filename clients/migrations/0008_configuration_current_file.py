@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+def set_current_file(apps, schema_editor):
+    Configuration = apps.get_model('clients', 'Configuration')
+    ConfigurationFile = apps.get_model('clients', 'ConfigurationFile')
+    for conf in Configuration.objects.all():
+        latest = ConfigurationFile.objects.filter(configuration=conf).order_by('-revision').first()
+        if latest is not None:
+            Configuration.objects.filter(pk=conf.pk).update(current_file=latest)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0007_auto_20160301_1338'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='current_file',
+            field=models.ForeignKey(blank=True, null=True, related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='clients.ConfigurationFile'),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_current_file, noop),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import uuid
+
+from django.db import models, migrations
+
+
+def set_manifest_tag(apps, schema_editor):
+    Client = apps.get_model('clients', 'Client')
+    for client in Client.objects.all():
+        Client.objects.filter(pk=client.pk).update(manifest_tag=uuid.uuid4().hex)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0008_configuration_current_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='manifest_tag',
+            field=models.CharField(max_length=32, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_manifest_tag, noop),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def record_existing(apps, schema_editor):
+    # Agents asking for every change since cursor 0 must see the
+    # configurations that existed before the log did.
+    Configuration = apps.get_model('clients', 'Configuration')
+    ConfigurationChange = apps.get_model('clients', 'ConfigurationChange')
+    confs = Configuration.objects.order_by('id').values_list('id', 'client_id', 'file_path')
+    ConfigurationChange.objects.bulk_create(
+        [ConfigurationChange(configuration_id=pk, client_id=client_id, file_path=file_path)
+         for pk, client_id, file_path in confs], batch_size=500)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0009_client_manifest_tag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfigurationChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('configuration_id', models.PositiveIntegerField()),
+                ('file_path', models.CharField(max_length=516)),
+                ('client', models.ForeignKey(to='clients.Client')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(record_existing, noop),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from hashlib import sha1
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+def move_content_to_blobs(apps, schema_editor):
+    Blob = apps.get_model('clients', 'Blob')
+    ConfigurationFile = apps.get_model('clients', 'ConfigurationFile')
+    for conf_file in ConfigurationFile.objects.all().iterator():
+        sha1_checksum = sha1(conf_file.content.encode('UTF-8')).hexdigest()
+        Blob.objects.get_or_create(sha1_checksum=sha1_checksum, defaults={'content': conf_file.content})
+        ConfigurationFile.objects.filter(pk=conf_file.pk).update(blob=sha1_checksum)
+
+
+def move_blobs_to_content(apps, schema_editor):
+    ConfigurationFile = apps.get_model('clients', 'ConfigurationFile')
+    for conf_file in ConfigurationFile.objects.select_related('blob').iterator():
+        ConfigurationFile.objects.filter(pk=conf_file.pk).update(content=conf_file.blob.content)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0010_configurationchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('sha1_checksum', models.CharField(max_length=40, serialize=False, primary_key=True)),
+                ('content', models.TextField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='configurationfile',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='clients.Blob'),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='configurationfile',
+            name='content',
+            field=models.TextField(blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(move_content_to_blobs, move_blobs_to_content),
+        migrations.RemoveField(
+            model_name='configurationfile',
+            name='content',
+        ),
+        migrations.AlterField(
+            model_name='configurationfile',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='clients.Blob'),
+            preserve_default=True,
+        ),
+    ]
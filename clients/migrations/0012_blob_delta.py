@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0011_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='base',
+            field=models.ForeignKey(blank=True, null=True, related_name='+', on_delete=django.db.models.deletion.PROTECT, to='clients.Blob'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='delta_height',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0012_blob_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='codec',
+            field=models.CharField(max_length=8, blank=True, default=''),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='data',
+            field=models.BinaryField(null=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='blob',
+            name='content',
+            field=models.TextField(blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def set_revision_count(apps, schema_editor):
+    Configuration = apps.get_model('clients', 'Configuration')
+    ConfigurationFile = apps.get_model('clients', 'ConfigurationFile')
+    for conf in Configuration.objects.all():
+        conf_files = list(ConfigurationFile.objects.filter(configuration=conf).order_by('revision', 'id'))
+        revisions = [f.revision for f in conf_files]
+        if len(set(revisions)) != len(revisions):
+            # Concurrent saves used to hand out the same revision twice,
+            # number them again in the order they were written.
+            for revision, conf_file in enumerate(conf_files, 1):
+                ConfigurationFile.objects.filter(pk=conf_file.pk).update(revision=revision)
+            revisions = range(1, len(conf_files) + 1)
+        Configuration.objects.filter(pk=conf.pk).update(revision_count=max(revisions or [0]))
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0013_blob_codec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='revision_count',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_revision_count, noop),
+        migrations.AlterUniqueTogether(
+            name='configurationfile',
+            unique_together=set([('configuration', 'revision')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def check_duplicate_file_paths(apps, schema_editor):
+    Configuration = apps.get_model('clients', 'Configuration')
+    duplicates = Configuration.objects.values('client', 'file_path').annotate(count=Count('id')).filter(count__gt=1)
+    if duplicates:
+        # Which of the copies holds the history worth keeping can't be told
+        # here, so leave the choice to an administrator.
+        raise Exception('Remove the duplicate configurations before migrating: {}'.format(
+            ', '.join('client {} `{}`'.format(d['client'], d['file_path']) for d in duplicates)))
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0014_configuration_revision_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_file_paths, noop),
+        migrations.AlterUniqueTogether(
+            name='configuration',
+            unique_together=set([('client', 'file_path')]),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from clients import compression
+from clients.delta import apply_delta
+
+
+def set_content_length(apps, schema_editor):
+    Blob = apps.get_model('clients', 'Blob')
+    ConfigurationFile = apps.get_model('clients', 'ConfigurationFile')
+    
+    def stored(blob):
+        if blob.codec == '':
+            return blob.content.encode('UTF-8')
+        return compression.decode(blob.codec, bytes(blob.data))
+    
+    def content(blob):
+        chain = []
+        while blob.base_id is not None:
+            chain.append(stored(blob).decode('UTF-8'))
+            blob = Blob.objects.get(pk=blob.base_id)
+        data = stored(blob)
+        if chain:
+            text = data.decode('UTF-8')
+            for delta in reversed(chain):
+                text = apply_delta(text, delta)
+            data = text.encode('UTF-8')
+        return data
+    
+    lengths = {}
+    for conf_file in ConfigurationFile.objects.all():
+        if conf_file.blob_id not in lengths:
+            lengths[conf_file.blob_id] = len(content(Blob.objects.get(pk=conf_file.blob_id)))
+        ConfigurationFile.objects.filter(pk=conf_file.pk).update(content_length=lengths[conf_file.blob_id])
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0015_configuration_unique_file_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configurationfile',
+            name='content_length',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_content_length, noop),
+    ]
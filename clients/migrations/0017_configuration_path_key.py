@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def fill_path_keys(apps, schema_editor):
+    Configuration = apps.get_model('clients', 'Configuration')
+    for config in Configuration.objects.only('file_path', 'is_case_sensitive'):
+        path_key = config.file_path if config.is_case_sensitive else config.file_path.lower()
+        Configuration.objects.filter(pk=config.pk).update(path_key=path_key)
+    duplicates = Configuration.objects.values('client', 'path_key').annotate(count=Count('id')).filter(count__gt=1)
+    if duplicates:
+        raise Exception('Remove the configurations differing only in case before migrating: {}'.format(
+            ', '.join('client {} `{}`'.format(d['client'], d['path_key']) for d in duplicates)))
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0016_configurationfile_content_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='path_key',
+            field=models.CharField(default='', max_length=516, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_path_keys, noop),
+        migrations.AlterUniqueTogether(
+            name='configuration',
+            unique_together=set([('client', 'path_key')]),
+        ),
+    ]
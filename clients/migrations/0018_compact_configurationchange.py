@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Max
+
+
+def compact_changes(apps, schema_editor):
+    ConfigurationChange = apps.get_model('clients', 'ConfigurationChange')
+    latest = ConfigurationChange.objects.values('client', 'configuration_id', 'file_path').annotate(latest=Max('id'))
+    keep = set(row['latest'] for row in latest)
+    stale = [pk for pk in ConfigurationChange.objects.values_list('id', flat=True) if pk not in keep]
+    for start in range(0, len(stale), 500):
+        ConfigurationChange.objects.filter(id__in=stale[start:start + 500]).delete()
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0017_configuration_path_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_changes, noop),
+    ]
@@ -3,8 +3,22 @@ from datetime import date, datetime, timedelta
 import time
 from hashlib import sha1
 import random
+import threading
+import uuid
+import base64
+import json
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import pre_delete, post_save, post_delete
+from django.dispatch import receiver
+from django.utils.crypto import salted_hmac
+
+from clients import compression
+from clients.cache import LRUCache
+from clients.delta import make_delta, apply_delta
+from cmdb_agent.lib.hash_tree import HashTree
 
 
 class ClientException(Exception):
@@ -14,12 +28,62 @@ class ConfigurationException(Exception):
     pass
 
 
+# Clients resolved from their api key, shared by every request this process
+# serves. Each entry holds the version of the client it was loaded at, which
+# lives in the CMDB_MANIFEST_CACHE cache and is dropped whenever the client is
+# saved or deleted, so with a cache shared by every process (see settings.py)
+# a change reaches all of them on their next request. Otherwise, other
+# processes see it once their entry expires.
+client_cache = LRUCache(max_entries=getattr(settings, 'CMDB_CLIENT_CACHE_SIZE', 10000),
+                        ttl=getattr(settings, 'CMDB_CLIENT_CACHE_TTL', 60))
+
+
+# Full content of blobs, keyed by sha1 so entries never go stale, and their
+# stored encodings, keyed by (sha1, codec). Bounded to CMDB_CONTENT_CACHE_SIZE
+# bytes in each process.
+content_cache = LRUCache(max_entries=getattr(settings, 'CMDB_CONTENT_CACHE_ENTRIES', 100000),
+                         max_size=getattr(settings, 'CMDB_CONTENT_CACHE_SIZE', 64 * 1024 * 1024))
+
+
+class UploadedContent(object):
+    """
+    Uploaded file content, spooled to `fh` as it was received along with its
+    sha1 and size, so it can be stored without being held in memory whole.
+    Blobs and revisions accept it wherever they accept content.
+    """
+    def __init__(self, fh, sha1_checksum, size):
+        self.fh = fh
+        self.sha1_checksum = sha1_checksum
+        self.size = size
+    
+    def open(self):
+        self.fh.seek(0)
+        return self.fh
+    
+    def read(self):
+        return self.open().read()
+    
+    def close(self):
+        self.fh.close()
+
+
+# Ids of the clients and configurations being deleted on each thread, from
+# their pre_delete to their post_delete. The revisions of a configuration
+# being deleted record no change of their own, the configuration records the
+# one, and nothing is recorded for a client being deleted.
+_deleting = threading.local()
+
+def _get_deleting(name):
+    return _deleting.__dict__.setdefault(name, set())
+
+
 class Client(models.Model):
     client_name = models.CharField(max_length=256, unique=True)
     api_key = models.CharField(max_length=40, unique=True, blank=True)
     date_created = models.DateField(auto_now_add=True)
     is_disabled = models.BooleanField(default=True)
     is_blacklisted = models.BooleanField(default=False)
+    manifest_tag = models.CharField(max_length=32, blank=True)
     
     class Meta:
         managed = True
@@ -30,11 +94,60 @@ class Client(models.Model):
     def __str__(self):
         return self.__unicode__()
     
+    def __init__(self, *args, **kwargs):
+        super(Client, self).__init__(*args, **kwargs)
+        # The key the client was loaded with, which is the one it is cached
+        # under if its key is changed and saved.
+        self._loaded_api_key = self.api_key
+    
     def save(self, *args, **kwargs):
         if not self.id:
             self.api_key = sha1(str(str(datetime.utcnow().isoformat()) +
                                 str(random.uniform(0, 1))).encode('UTF-8')).hexdigest()
+        # Always issue a fresh tag, a stale in-memory instance must never write
+        # back a tag that an agent may still be holding.
+        self.manifest_tag = uuid.uuid4().hex
         super(Client, self).save(*args, **kwargs)
+        Client.forget(self._loaded_api_key)
+        Client.forget(self.api_key)
+        self._loaded_api_key = self.api_key
+    
+    @staticmethod
+    def get_version_key(api_key):
+        return 'cmdb:client:{}'.format(api_key)
+    
+    @staticmethod
+    def forget(api_key):
+        """
+        Drop the client with `api_key` from the api key cache, along with its
+        version, so every process sharing the manifest cache reloads it.
+        """
+        client_cache.delete(api_key)
+        caches[getattr(settings, 'CMDB_MANIFEST_CACHE', 'default')].delete(Client.get_version_key(api_key))
+    
+    @staticmethod
+    def touch_manifest(client_id):
+        """
+        Issue a new manifest tag for the client, invalidating the ETag agents
+        hold for its poll manifest.
+        """
+        Client.objects.filter(pk=client_id).update(manifest_tag=uuid.uuid4().hex)
+    
+    def get_manifest_etag(self, inline_max=0):
+        """
+        Return the ETag of the client's poll manifest, or None if it has no
+        tag yet. Clients from the api key cache don't carry their tag, as it
+        changes with every configuration change, so it is read on demand.
+        Manifests with the content of files of up to `inline_max` bytes
+        differ from those without, so their ETags do too.
+        """
+        if not self.manifest_tag:
+            self.manifest_tag = Client.objects.filter(pk=self.pk).values_list('manifest_tag', flat=True).first()
+        if not self.manifest_tag:
+            return None
+        if inline_max:
+            return '"{}-i{}"'.format(self.manifest_tag, inline_max)
+        return '"{}"'.format(self.manifest_tag)
     
     @staticmethod
     def new_client(name):
@@ -70,17 +183,36 @@ class Client(models.Model):
     
     @staticmethod
     def get_by_api_key(api_key):
-        c = Client.objects.get(api_key=api_key)
-        return c
+        """
+        Return the client for `api_key`, from the api key cache when it can.
+        Cached entries are only used at the client's current version, read
+        from the manifest cache. Raises `Client.DoesNotExist` for unknown
+        keys, which aren't cached.
+        """
+        cache = caches[getattr(settings, 'CMDB_MANIFEST_CACHE', 'default')]
+        version_key = Client.get_version_key(api_key)
+        version = cache.get(version_key)
+        entry = client_cache.get(api_key)
+        if entry is None or version is None or entry[0] != version:
+            fields = Client.objects.filter(api_key=api_key).values(
+                'id', 'client_name', 'api_key', 'date_created', 'is_disabled', 'is_blacklisted').get()
+            if version is None:
+                # Another process may be loading the client too, whichever
+                # version is stored first is the one both go by.
+                cache.add(version_key, uuid.uuid4().hex, getattr(settings, 'CMDB_MANIFEST_CACHE_TIMEOUT', 3600))
+                version = cache.get(version_key)
+            entry = (version, fields)
+            client_cache.set(api_key, entry)
+        return Client(**entry[1])
     
     @staticmethod
     def get_config_status(api_key):
         try:
-            c = Client.objects.get(api_key=api_key)
+            c = Client.get_by_api_key(api_key)
         except:
             return {'error': 'Could not get client for `api_key`.'}
         
-        configs = c.configuration_set.all()
+        configs = c.configuration_set.select_related('current_file')
         
         data = {
             'name': c.client_name,
@@ -101,19 +233,65 @@ class Client(models.Model):
             if config.is_disabled:
                 data['configurations'].append(c_dict)
                 continue
-            try:
-                config_file = config.configurationfile_set.order_by('-revision')[0]
-            except IndexError:
-                config_file = ConfigurationFile()
+            config_file = config.get_current_file()
             c_dict['revision'] = config_file.revision
             c_dict['sha1_checksum'] = config_file.sha1_checksum
             c_dict['mtime'] = config_file.mtime
-            c_dict['content_length'] = len(config_file.content)
+            c_dict['content_length'] = config_file.content_length
             data['configurations'].append(c_dict)
         
         return data
     
-    def get_managed_configuration(self):
+    def get_cached(self, name, build):
+        """
+        Return `build()`, cached in the `CMDB_MANIFEST_CACHE` cache.
+        
+        Entries are keyed by the client's manifest tag, and every write that
+        can change what they hold issues a new tag, so a write invalidates
+        them as soon as it is committed, in every process sharing the cache.
+        Entries under old tags are never read again and expire on their own.
+        """
+        if self.get_manifest_etag() is None:
+            return build()
+        cache = caches[getattr(settings, 'CMDB_MANIFEST_CACHE', 'default')]
+        key = 'cmdb:{}:{}:{}'.format(name, self.pk, self.manifest_tag)
+        data = cache.get(key)
+        if data is None:
+            data = build()
+            cache.set(key, data, getattr(settings, 'CMDB_MANIFEST_CACHE_TIMEOUT', 3600))
+        return data
+    
+    def get_cached_json(self, name, build):
+        """
+        Return `build()` serialized as JSON bytes, cached like `get_cached`.
+        """
+        return self.get_cached(name, lambda: json.dumps(build()).encode('UTF-8'))
+    
+    def get_hash_tree(self):
+        """
+        Return a `HashTree` over the path, sha1 and revision of the client's
+        enabled configurations, which agents walk to find what changed. Trees
+        of hosts tracking many files can be larger than a memcached item, in
+        which case they are built for every request.
+        """
+        def build():
+            confs = self.configuration_set.filter(is_disabled=False, current_file__isnull=False)
+            return HashTree(confs.values_list('file_path', 'current_file__sha1_checksum', 'current_file__revision'))
+        return self.get_cached('tree', build)
+    
+    def get_config_status_json(self):
+        return self.get_cached_json('status', lambda: Client.get_config_status(self.api_key))
+    
+    def get_managed_configuration_json(self, inline_max=0):
+        return self.get_cached_json('manifest:{}'.format(inline_max),
+                                    lambda: self.get_managed_configuration(inline_max))
+    
+    def get_managed_configuration(self, inline_max=0):
+        """
+        Return the client's poll manifest. The content of files of up to
+        `inline_max` bytes is included in their entries, see
+        `get_manifest_entries`.
+        """
         details = {
             'client_name': self.client_name,
             'date_created': str(self.date_created),
@@ -123,29 +301,75 @@ class Client(models.Model):
         if self.is_disabled or self.is_blacklisted:
             return details
         
-        details['configurations'] = []
-        confs = self.configuration_set.all()
+        details['configurations'] = Client.get_manifest_entries(
+            self.configuration_set.select_related('current_file'), inline_max)
+        details['configuration_count'] = len(details['configurations'])
+        return details
+    
+    @staticmethod
+    def get_manifest_entries(confs, inline_max=0):
+        """
+        Return the manifest entries of `confs`. Entries of files of up to
+        `inline_max` bytes carry their content, like fetch payloads, so
+        agents needn't fetch them; it is loaded with a single query.
+        """
+        confs = list(confs)
+        if inline_max > 0:
+            Blob.warm_cache([conf.current_file.blob_id for conf in confs
+                             if conf.current_file is not None and not conf.is_disabled
+                             and conf.current_file.content_length <= inline_max])
+        return [conf.get_manifest_entry(inline_max) for conf in confs]
+    
+    def get_latest_change_id(self):
+        """
+        Return the id of the client's latest `ConfigurationChange`, the
+        cursor of its configurations as they are now, or None.
+        """
+        return self.configurationchange_set.order_by('-id').values_list('id', flat=True).first()
+    
+    def get_configuration_changes(self, cursor=0, inline_max=0):
+        """
+        Return the manifest entries of the configurations that changed after
+        `cursor`, the paths of those that were removed, and the new cursor.
         
-        file_count = 0
+        Cursors are `ConfigurationChange` ids, so they only ever increase. A
+        `cursor` of 0 returns every configuration, like the full manifest.
+        Files of up to `inline_max` bytes are returned with their content.
+        A `cursor` past the latest change, as from before the database was
+        restored, is answered with that latest change's id, lower than the
+        one given, for the agent to find what changed another way.
+        """
+        details = {
+            'client_name': self.client_name,
+            'date_created': str(self.date_created),
+            'is_disabled': self.is_disabled,
+            'is_blacklisted': self.is_blacklisted,
+            'cursor': cursor,
+        }
+        if self.is_disabled or self.is_blacklisted:
+            return details
         
-        for conf in confs:
-            file_count += 1
-            configuration = {}
-            configuration['file_path'] = conf.file_path
-            configuration['is_disabled'] = conf.is_disabled
-            configuration['is_binary'] = conf.is_binary
-            configuration['is_encrypted'] = conf.is_encrypted
-            if not conf.is_disabled:
-                try:
-                    conf_file = conf.configurationfile_set.order_by('-revision')[0]
-                except IndexError:
-                    conf_file = ConfigurationFile()
-                configuration['revision'] = conf_file.revision
-                configuration['sha1_checksum'] = conf_file.sha1_checksum
-                configuration['mtime'] = conf_file.mtime
-            details['configurations'].append(configuration)
+        latest = self.get_latest_change_id()
+        details['is_full'] = cursor == 0
+        details['configurations'] = []
+        details['removed'] = []
+        if latest is None or latest <= cursor:
+            details['cursor'] = latest or 0
+            return details
+        details['cursor'] = latest
+        
+        confs = self.configuration_set.select_related('current_file')
+        if cursor > 0:
+            changes = self.configurationchange_set.filter(id__gt=cursor, id__lte=latest)
+            confs = confs.filter(id__in=changes.values('configuration_id'))
+            removed = set(changes.values_list('file_path', flat=True).distinct())
+        else:
+            removed = set()
         
-        details['configuration_count'] = file_count
+        details['configurations'] = Client.get_manifest_entries(confs, inline_max)
+        for entry in details['configurations']:
+            removed.discard(entry['file_path'])
+        details['removed'] = sorted(removed)
         return details
     
     def fetch_configuration(self, file_path):
@@ -156,28 +380,121 @@ class Client(models.Model):
             'is_encrypted': None,
             'is_case_sensitive': None,
         }
-        config = self.configuration_set.filter(file_path=file_path)
-        if len(config) == 0:
-            return {'error': 'Remote file not found.'}
-        if len(config) > 1:
-            return {'error': 'Multiple files found.'}
-        if len(config) == 1:
-            config = config[0]
-            details['file_path'] = config.file_path
-            details['is_disabled'] = config.is_disabled
-            details['is_binary'] = config.is_binary
-            details['is_encrypted'] = config.is_encrypted
-            details['is_case_sensitive'] = config.is_case_sensitive
-            if not config.is_disabled:
-                conf_file = config.configurationfile_set.order_by('-revision')[0]
-                details['mtime'] = conf_file.mtime
-                details['sha1_checksum'] = conf_file.sha1_checksum
-                details['content'] = conf_file.content
-                details['content_length'] = len(conf_file.content)
-                details['revision'] = conf_file.revision
+        try:
+            config = self.get_configuration(file_path)
+        except ConfigurationException as e:
+            return {'error': str(e)}
+        details.update(config.get_fetch_details())
         return details
     
+    def get_configuration(self, file_path):
+        """
+        Return the configuration tracking `file_path`, with its latest revision
+        loaded. Its content comes from the content cache, and is only read
+        from the database on a miss.
+        """
+        config = self.find_configurations([file_path]).get(file_path, None)
+        if config is None:
+            raise ConfigurationException('Remote file not found.')
+        return config
+    
+    def find_configurations(self, file_paths):
+        """
+        Return the configurations tracking `file_paths`, with their latest
+        revision loaded, in a dict keyed by the paths asked for.
+        
+        Paths are matched against `Configuration.path_key`, so configurations
+        of case-insensitive hosts are found whatever the case of the path,
+        with index lookups only.
+        """
+        keys = set(file_paths) | set(p.lower() for p in file_paths)
+        candidates = {}
+        for config in self.configuration_set.filter(path_key__in=keys).select_related('current_file'):
+            candidates[config.path_key] = config
+        found = {}
+        for file_path in file_paths:
+            for key in (file_path, file_path.lower()):
+                config = candidates.get(key, None)
+                if config is not None and config.path_key == Configuration.get_path_key(file_path, config.is_case_sensitive):
+                    found[file_path] = config
+                    break
+        return found
+    
+    def fetch_configurations(self, files, inline_max=None):
+        """
+        Yield the fetch details of many files, in the order they were asked
+        for, using a fixed number of queries per chunk of files.
+        
+        `files` is a list of file paths or of `{'file_path': str,
+        'revision': int}` dicts; a missing revision means the latest one.
+        Given `inline_max`, latest revisions are returned as manifest entries
+        instead, with the content of files of up to `inline_max` bytes only.
+        """
+        chunk_size = 500
+        for start in range(0, len(files), chunk_size):
+            chunk = []
+            for f in files[start:start + chunk_size]:
+                if isinstance(f, dict):
+                    chunk.append((str(f.get('file_path', '')), f.get('revision')))
+                else:
+                    chunk.append((str(f), None))
+            
+            configs = self.find_configurations([p for p, r in chunk])
+            blob_ids = [c.current_file.blob_id for c in configs.values() if c.current_file_id is not None
+                        and (inline_max is None or c.current_file.content_length <= inline_max)]
+            
+            revisions = {}
+            pinned = [r for p, r in chunk if r is not None]
+            if pinned:
+                conf_files = ConfigurationFile.objects.filter(
+                    configuration__in=list(configs.values()), revision__in=pinned)
+                for conf_file in conf_files:
+                    revisions[(conf_file.configuration_id, conf_file.revision)] = conf_file
+                    blob_ids.append(conf_file.blob_id)
+            
+            # Only the content that isn't cached yet is read, in one query.
+            Blob.warm_cache(blob_ids)
+            
+            for file_path, revision in chunk:
+                config = configs.get(file_path, None)
+                if config is None:
+                    yield {'file_path': file_path, 'error': 'Remote file not found.'}
+                    continue
+                conf_file = None
+                if revision is not None:
+                    conf_file = revisions.get((config.id, revision))
+                    if conf_file is None:
+                        yield {'file_path': file_path, 'error': 'Revision r{} not found.'.format(revision)}
+                        continue
+                elif inline_max is not None:
+                    yield config.get_manifest_entry(inline_max)
+                    continue
+                yield config.get_fetch_details(conf_file)
+    
     def push_configuration(self, **kwargs):
+        return self.push_configurations([kwargs])[0]
+    
+    def push_configurations(self, files):
+        """
+        Push many files at once. Every file is checked on its own and gets its
+        own result dict, but all new revisions are written in one transaction
+        and the configurations are looked up with a fixed number of queries.
+        """
+        chunk_size = 500
+        paths = [kwargs.get('file_path') for kwargs in files if isinstance(kwargs.get('file_path'), str)]
+        
+        with transaction.atomic():
+            configs = {}
+            for start in range(0, len(paths), chunk_size):
+                configs.update(self.find_configurations(paths[start:start + chunk_size]))
+            results = []
+            for kwargs in files:
+                result = self._push_configuration(configs, kwargs)
+                result.setdefault('file_path', kwargs.get('file_path'))
+                results.append(result)
+            return results
+    
+    def _push_configuration(self, configs, kwargs):
         for atr in ('file_path', 'is_binary', 'is_encrypted',
                     'is_case_sensitive', 'content', 'sha1_checksum', 'mtime'):
             if atr not in kwargs:
@@ -190,48 +507,41 @@ class Client(models.Model):
         content = kwargs.get('content')
         mtime = kwargs.get('mtime')
         
-        if not is_case_sensitive == True:
-            file_path = file_path.lower()
-        
-        config = self.configuration_set.filter(file_path=file_path)
-        if len(config) == 0:
+        config = configs.get(file_path, None)
+        if config is None:
             return {'error': 'File on remote server not found.'}
-        if len(config) > 1:
-            return {'error': 'Multiple files on remote server found.'}
-        if len(config) == 1:
-            config = config[0]
+        file_path = config.file_path
         
         if config.is_disabled:
             return {'error': 'Configuration file `{}` is disabled.'.format(file_path)}
         
-        if is_binary == True:
-            calculated_sha1_checksum = sha1(content).hexdigest()
-        elif is_binary == False:
-            calculated_sha1_checksum = sha1(content.encode('UTF-8')).hexdigest()
-        if calculated_sha1_checksum != sha1_checksum:
+        # Uploaded content arrives spooled with its sha1, content pushed as
+        # JSON as text.
+        if Blob.checksum(content) != sha1_checksum:
             return {'error': 'Checksum mismatch for file `{}`, aborting.'.format(file_path)}
         
         try:
-            try:
-                conf_file = config.configurationfile_set.order_by('-revision')[0]
-            except IndexError:
-                conf_file = ConfigurationFile()
-                conf_file.configuration = config
+            # A savepoint per file, so one failed write doesn't take the rest
+            # of a bulk push down with it.
+            with transaction.atomic():
+                conf_file = config.get_current_file()
+                if conf_file.id is None:
+                    conf_file.configuration = config
+                    conf_file.save()
+                if mtime < conf_file.mtime:
+                    return {'error': 'Modified timestamp of pushed file is older than configuration, aborting.'}
+                if mtime == conf_file.mtime:
+                    return {'error': 'Files are the same age, aborting.'}
+                conf_file.mtime = int(mtime)
+                conf_file.content = content
+                conf_file.sha1_checksum = sha1_checksum
                 conf_file.save()
-            if mtime < conf_file.mtime:
-                return {'error': 'Modified timestamp of pushed file is older than configuration, aborting.'}
-            if mtime == conf_file.mtime:
-                return {'error': 'Files are the same age, aborting.'}
-            conf_file.mtime = int(mtime)
-            conf_file.content = content
-            conf_file.sha1_checksum = sha1_checksum
-            conf_file.save()
-            return {
-                'file_path': file_path,
-                'mtime': int(mtime),
-                'sha1_checksum': sha1_checksum,
-                'revision': conf_file.revision
-            }
+                return {
+                    'file_path': file_path,
+                    'mtime': int(mtime),
+                    'sha1_checksum': sha1_checksum,
+                    'revision': conf_file.revision
+                }
         except Exception as e:
             return {'error': str(e)}
 
@@ -243,9 +553,15 @@ class Configuration(models.Model):
     is_encrypted = models.BooleanField(default=False)
     is_case_sensitive = models.BooleanField(default=True)
     is_disabled = models.BooleanField(default=False)
+    current_file = models.ForeignKey('ConfigurationFile', null=True, blank=True,
+                                     related_name='+', on_delete=models.SET_NULL)
+    revision_count = models.PositiveIntegerField(default=0)
+    # `file_path` as it is looked up: lowercased for case-insensitive hosts.
+    path_key = models.CharField(max_length=516, editable=False)
     
     class Meta:
         managed = True
+        unique_together = (('client', 'path_key'),)
     
     
     def __unicode__(self):
@@ -256,23 +572,102 @@ class Configuration(models.Model):
         return self.__unicode__()
     
     
+    def save(self, *args, **kwargs):
+        self.path_key = Configuration.get_path_key(self.file_path, self.is_case_sensitive)
+        super(Configuration, self).save(*args, **kwargs)
+    
+    
+    @staticmethod
+    def get_path_key(file_path, is_case_sensitive):
+        if is_case_sensitive:
+            return file_path
+        return file_path.lower()
+    
+    
+    def get_current_file(self):
+        """
+        Return the latest `ConfigurationFile` revision of this configuration.
+        
+        Reads the `current_file` pointer maintained by `ConfigurationFile.save`,
+        so callers that `select_related('current_file')` get the latest revision
+        of every configuration without one extra query per file. Falls back to
+        an empty `ConfigurationFile` when no revision has been saved yet.
+        """
+        if self.current_file_id is None:
+            return ConfigurationFile()
+        return self.current_file
+    
+    
+    def get_fetch_details(self, conf_file=None):
+        """
+        Return the details and content of `conf_file`, the latest revision by
+        default, as sent to agents by the fetch endpoints.
+        """
+        details = {
+            'file_path': self.file_path,
+            'is_disabled': self.is_disabled,
+            'is_binary': self.is_binary,
+            'is_encrypted': self.is_encrypted,
+            'is_case_sensitive': self.is_case_sensitive,
+        }
+        if not self.is_disabled:
+            if conf_file is None:
+                conf_file = self.get_current_file()
+            details['mtime'] = conf_file.mtime
+            details['sha1_checksum'] = conf_file.sha1_checksum
+            content = conf_file.content
+            if isinstance(content, bytes):
+                details['content'] = base64.b64encode(content).decode('ascii')
+                details['content_encoding'] = 'base64'
+            else:
+                details['content'] = content
+            details['content_length'] = conf_file.content_length
+            details['revision'] = conf_file.revision
+        return details
+    
+    
+    def get_manifest_entry(self, inline_max=0):
+        """
+        Return the manifest entry of this configuration. Files of up to
+        `inline_max` bytes get the full fetch details instead.
+        """
+        if not self.is_disabled and inline_max > 0 and self.current_file_id is not None:
+            conf_file = self.get_current_file()
+            if conf_file.content_length <= inline_max:
+                return self.get_fetch_details(conf_file)
+        entry = {
+            'file_path': self.file_path,
+            'is_disabled': self.is_disabled,
+            'is_binary': self.is_binary,
+            'is_encrypted': self.is_encrypted,
+        }
+        if not self.is_disabled:
+            conf_file = self.get_current_file()
+            entry['revision'] = conf_file.revision
+            entry['sha1_checksum'] = conf_file.sha1_checksum
+            entry['blob_token'] = Blob.get_token(conf_file.sha1_checksum)
+            entry['mtime'] = conf_file.mtime
+            entry['content_length'] = conf_file.content_length
+        return entry
+    
+    
     @staticmethod
-    def add(client, file_path, mtime, case_sensitive, payload):
-        if not case_sensitive:
-            file_path = file_path.lower()
+    def add(client, file_path, mtime, case_sensitive, payload, is_binary=False):
+        path_key = Configuration.get_path_key(file_path, case_sensitive)
         try:
-            conf = Configuration.objects.get(client=client, file_path=file_path)
+            conf = Configuration.objects.get(client=client, path_key=path_key)
             raise ConfigurationException('Configuration for `{}` already exists.'.format(file_path))
         except ConfigurationException:
             raise
         except Exception:
             try:
-                conf = Configuration(client=client, file_path=file_path, is_case_sensitive=case_sensitive)
+                conf = Configuration(client=client, file_path=file_path, is_case_sensitive=case_sensitive,
+                                     is_binary=is_binary)
                 conf.save()
             except:
                 raise ConfigurationException('Could not add new configuration for `{}`'.format(file_path))
             try:
-                confFile = ConfigurationFile(configuration=conf, sha1_checksum=sha1(payload.encode('UTF-8')).hexdigest(), mtime=mtime, content=payload)
+                confFile = ConfigurationFile(configuration=conf, sha1_checksum=Blob.checksum(payload), mtime=mtime, content=payload)
                 confFile.save()
             except Exception as e:
                 try:
@@ -285,10 +680,9 @@ class Configuration(models.Model):
     
     @staticmethod
     def remove(client, file_path, mtime, case_sensitive, payload):
-        if not case_sensitive:
-            file_path = file_path.lower()
+        path_key = Configuration.get_path_key(file_path, case_sensitive)
         try:
-            conf = Configuration.objects.get(client=client, file_path=file_path)
+            conf = Configuration.objects.get(client=client, path_key=path_key)
         except Exception:
             raise ConfigurationException('Configuration for `{}` doesn\'t exist.'.format(file_path))
         try:
@@ -299,28 +693,372 @@ class Configuration(models.Model):
             return False
 
 
+class Blob(models.Model):
+    """
+    File content, stored once and keyed by its sha1. Every revision of every
+    client carrying byte-identical content points at the same blob.
+    
+    Blobs that are no longer the latest revision of any configuration are
+    re-encoded as a line delta against the revision that replaced them, so
+    long histories cost little more than their changes. `delta_height` is
+    the longest delta chain resolving through this blob; a blob whose height
+    would reach `CMDB_DELTA_KEYFRAME_INTERVAL` stays whole as a keyframe, which
+    bounds the cost of rebuilding any revision. Latest revisions are always
+    stored whole so reading them is a single read.
+    
+    New blobs are compressed with `CMDB_BLOB_CODEC` into `data`, or kept there
+    as is with the `raw` codec when compression doesn't make them smaller;
+    `codec` names the encoding of each row, and rows with an empty codec keep
+    their text in `content` as they always have. Content is bytes throughout,
+    so binary files are stored like any other; only text is delta encoded.
+    """
+    sha1_checksum = models.CharField(max_length=40, primary_key=True)
+    content = models.TextField(blank=True)
+    codec = models.CharField(max_length=8, blank=True, default='')
+    data = models.BinaryField(null=True)
+    base = models.ForeignKey('self', null=True, blank=True, related_name='+', on_delete=models.PROTECT)
+    delta_height = models.PositiveIntegerField(default=0)
+    
+    def __unicode__(self):
+        return '{} {}'.format(self.sha1_checksum, self.get_stored()[:25].decode('UTF-8', 'replace'))
+    
+    def __str__(self):
+        return self.__unicode__()
+    
+    @staticmethod
+    def get_token(sha1_checksum):
+        """
+        Return the token of the shared blob URL of `sha1_checksum`. Only the
+        server can compute it, so the URL grants access to that content
+        alone and can be served to whoever holds it, without an api key.
+        """
+        return salted_hmac('clients.Blob.get_token', sha1_checksum).hexdigest()
+    
+    @staticmethod
+    def checksum(content):
+        if isinstance(content, UploadedContent):
+            return content.sha1_checksum
+        if isinstance(content, str):
+            content = content.encode('UTF-8')
+        return sha1(content).hexdigest()
+    
+    @staticmethod
+    def store(content):
+        """
+        Return the blob holding `content`, text, bytes or `UploadedContent`,
+        creating it if it doesn't exist. The blob is stored whole, as it is
+        about to become a latest revision.
+        """
+        if isinstance(content, str):
+            content = content.encode('UTF-8')
+        sha1_checksum = Blob.checksum(content)
+        try:
+            # Only whether it exists and is whole matters, not what it holds.
+            blob = Blob.objects.defer('content', 'data').get(sha1_checksum=sha1_checksum)
+        except Blob.DoesNotExist:
+            blob = Blob(sha1_checksum=sha1_checksum)
+            blob.set_stored(content)
+            try:
+                with transaction.atomic():
+                    blob.save(force_insert=True)
+            except IntegrityError:
+                # Somebody else stored the same content at the same time.
+                blob = Blob.objects.get(sha1_checksum=sha1_checksum)
+        if blob.base_id is not None:
+            blob.set_stored(content)
+            blob.base = None
+            blob.save()
+        return blob
+    
+    def get_stored(self):
+        """
+        Return the bytes this row stores, decoded: the whole content, or the
+        delta against `base`.
+        """
+        if self.codec == '':
+            return self.content.encode('UTF-8')
+        return compression.decode(self.codec, bytes(self.data))
+    
+    def set_stored(self, data, codec=None):
+        if codec is None:
+            codec = getattr(settings, 'CMDB_BLOB_CODEC', 'gzip')
+        if isinstance(data, UploadedContent):
+            # Compress uploads as they are read back, they are only read
+            # whole if compression doesn't help.
+            encoded = compression.encode_file(codec, data.open()) if codec != '' else None
+            if encoded is None or len(encoded) >= data.size:
+                codec = 'raw'
+                encoded = data.read()
+        else:
+            encoded = compression.encode(codec, data) if codec != '' else data
+            if len(encoded) >= len(data):
+                codec = 'raw'
+                encoded = data
+        self.codec = codec
+        self.data = encoded
+        self.content = ''
+    
+    def get_stored_size(self):
+        if self.codec == '':
+            return len(self.content.encode('UTF-8'))
+        return len(self.data)
+    
+    def get_encoded(self, codec):
+        """
+        Return the stored bytes if this blob is held whole and encoded with
+        `codec`, so they can be sent as is, or None.
+        """
+        if self.base_id is None and self.codec == codec:
+            return bytes(self.data)
+        return None
+    
+    @staticmethod
+    def warm_cache(blob_ids):
+        """
+        Load the content of the blobs in `blob_ids` that aren't in the content
+        cache with a single query.
+        """
+        missing = [blob_id for blob_id in set(blob_ids) if blob_id is not None and blob_id not in content_cache]
+        if missing:
+            for blob in Blob.objects.filter(pk__in=missing):
+                content_cache.set(blob.pk, blob.get_content())
+    
+    def get_content(self):
+        """
+        Return the full content of this blob as bytes, applying at most
+        `CMDB_DELTA_KEYFRAME_INTERVAL - 1` deltas.
+        """
+        chain = []
+        blob = self
+        while blob.base_id is not None:
+            chain.append(blob.get_stored().decode('UTF-8'))
+            blob = blob.base
+        content = blob.get_stored()
+        if not chain:
+            return content
+        content = content.decode('UTF-8')
+        for delta in reversed(chain):
+            content = apply_delta(content, delta)
+        return content.encode('UTF-8')
+    
+    @staticmethod
+    def deltify(blob_id, base_id):
+        """
+        Re-encode the blob `blob_id`, which was just replaced by `base_id` as
+        the latest revision of a configuration, as a delta against it.
+        """
+        if blob_id is None or blob_id == base_id:
+            return False
+        if Configuration.objects.filter(current_file__blob=blob_id).exists():
+            # Still the latest revision of another configuration.
+            return False
+        blob = Blob.objects.get(pk=blob_id)
+        if blob.base_id is not None:
+            return False
+        height = blob.delta_height + 1
+        if height >= getattr(settings, 'CMDB_DELTA_KEYFRAME_INTERVAL', 16):
+            # Keyframe, keep it whole.
+            return False
+        base = Blob.objects.get(pk=base_id)
+        if base.base_id is not None:
+            return False
+        content = blob.get_stored()
+        try:
+            delta = make_delta(base.get_stored().decode('UTF-8'), content.decode('UTF-8')).encode('UTF-8')
+        except UnicodeDecodeError:
+            # Binary content, keep it whole.
+            return False
+        if len(delta) >= len(content):
+            return False
+        blob.set_stored(delta)
+        blob.base = base
+        blob.save()
+        Blob.objects.filter(pk=base_id, delta_height__lt=height).update(delta_height=height)
+        return True
+
+
 class ConfigurationFile(models.Model):
     configuration = models.ForeignKey('Configuration')
     updated_at = models.DateTimeField(auto_now_add=True)
     revision = models.PositiveIntegerField(default=1)
     sha1_checksum = models.CharField(max_length=40)
     mtime = models.PositiveIntegerField(default=0)
-    content = models.TextField()
+    content_length = models.PositiveIntegerField(default=0)
+    blob = models.ForeignKey('Blob', on_delete=models.PROTECT)
+    
+    # Content assigned to this revision but not yet stored in a blob.
+    _content = None
     
     class Meta:
         ordering = ['-revision']
+        unique_together = (('configuration', 'revision'),)
     
     def __unicode__(self):
-        return '{} r{} {}'.format(str(self.configuration), self.revision, self.content[:25])
+        return '{} r{} {}'.format(str(self.configuration), self.revision, self.data[:25].decode('UTF-8', 'replace'))
     
     def __str__(self):
         return self.__unicode__()
     
+    @property
+    def data(self):
+        """
+        The content of this revision as bytes.
+        """
+        if self._content is not None:
+            if isinstance(self._content, str):
+                return self._content.encode('UTF-8')
+            if isinstance(self._content, UploadedContent):
+                return self._content.read()
+            return self._content
+        if self.blob_id is None:
+            return b''
+        data = content_cache.get(self.blob_id)
+        if data is None:
+            data = self.blob.get_content()
+            content_cache.set(self.blob_id, data)
+        return data
+    
+    def get_encoded(self, codec):
+        """
+        Return the content of this revision as stored with `codec`, or None
+        if it isn't held that way. See `Blob.get_encoded`.
+        """
+        if self.blob_id is None:
+            return None
+        key = (self.blob_id, codec)
+        data = content_cache.get(key)
+        if data is None:
+            # An empty value remembers that the blob isn't held with `codec`.
+            data = self.blob.get_encoded(codec) or b''
+            content_cache.set(key, data)
+        return data or None
+    
+    @property
+    def content(self):
+        """
+        The content of this revision, as text if it is UTF-8 and as bytes if
+        it isn't, the same way the agent reads local files.
+        """
+        if isinstance(self._content, str):
+            return self._content
+        data = self.data
+        try:
+            return data.decode('UTF-8')
+        except UnicodeDecodeError:
+            return data
+    
+    @content.setter
+    def content(self, value):
+        self._content = value
+    
     def save(self, *args, **kwargs):
-        if self.id:
-            latest_revision =  ConfigurationFile.objects.filter(configuration=self.configuration).order_by('-revision')[0].revision
-            self.id = None
-            self.revision = latest_revision + 1
-            self.sha1_checksum = sha1(self.content.encode('UTF-8')).hexdigest()
-            self.mtime = int(time.time())
-        super(ConfigurationFile, self).save(*args, **kwargs)
+        with transaction.atomic():
+            # Take the next revision from the configuration's counter. The
+            # update locks the configuration until this revision is committed,
+            # so concurrent saves get consecutive revisions, never the same one.
+            confs = Configuration.objects.filter(pk=self.configuration_id)
+            confs.update(revision_count=models.F('revision_count') + 1)
+            self.revision, previous_blob_id = confs.values_list('revision_count', 'current_file__blob').get()
+            if self.id:
+                self.id = None
+                self.sha1_checksum = Blob.checksum(self._content if self._content is not None else self.data)
+                self.mtime = int(time.time())
+            if isinstance(self._content, UploadedContent):
+                # Uploads are stored straight from their spooled file, and
+                # not cached, as they may be large.
+                self.blob = Blob.store(self._content)
+                self.content_length = self._content.size
+                self._content = None
+            elif self._content is not None or self.blob_id is None:
+                data = self.data
+                self.blob = Blob.store(data)
+                self.content_length = len(data)
+                self._content = None
+                # Latest revisions are about to be fetched.
+                content_cache.set(self.blob_id, data)
+            if not self.sha1_checksum:
+                self.sha1_checksum = self.blob_id
+            super(ConfigurationFile, self).save(*args, **kwargs)
+            # Keep the latest revision pointer on the configuration up to date
+            # so manifests can be built without a per-file "latest revision"
+            # query.
+            confs.update(current_file=self)
+            Blob.deltify(previous_blob_id, self.blob_id)
+
+
+class ConfigurationChange(models.Model):
+    """
+    Log of configuration changes. Its ids are the cursors handed out by
+    `Client.get_configuration_changes`, which only needs the latest change of
+    each configuration and path, so older ones are dropped as they are
+    superseded and the log stays about as long as the configurations.
+    """
+    client = models.ForeignKey('Client')
+    configuration_id = models.PositiveIntegerField()
+    file_path = models.CharField(max_length=516)
+    
+    class Meta:
+        ordering = ['id']
+    
+    def __unicode__(self):
+        return '#{} {}'.format(self.id, self.file_path)
+    
+    def __str__(self):
+        return self.__unicode__()
+    
+    @staticmethod
+    def record(client_id, configuration_id, file_path):
+        with transaction.atomic():
+            # Lock the client's row before taking an id, so the changes of a
+            # client commit in id order and a cursor can't get ahead of a
+            # change still being written.
+            Client.touch_manifest(client_id)
+            change = ConfigurationChange.objects.create(client_id=client_id, configuration_id=configuration_id,
+                                                        file_path=file_path)
+            ConfigurationChange.objects.filter(client_id=client_id, configuration_id=configuration_id,
+                                               file_path=file_path, id__lt=change.id).delete()
+
+
+# Deletes collect everything they cascade to and send every pre_delete before
+# deleting anything, whether they start from an instance or a queryset, so
+# these see the whole cascade coming.
+@receiver(pre_delete, sender=Client)
+def client_deleting(sender, instance, **kwargs):
+    _get_deleting('clients').add(instance.pk)
+
+
+@receiver(pre_delete, sender=Configuration)
+def configuration_deleting(sender, instance, **kwargs):
+    _get_deleting('configurations').add(instance.pk)
+
+
+@receiver(post_delete, sender=Client)
+def client_deleted(sender, instance, **kwargs):
+    _get_deleting('clients').discard(instance.pk)
+    Client.forget(instance._loaded_api_key)
+    Client.forget(instance.api_key)
+
+
+@receiver(post_save, sender=Configuration)
+@receiver(post_delete, sender=Configuration)
+def configuration_changed(sender, instance, **kwargs):
+    if kwargs.get('signal') is post_delete:
+        _get_deleting('configurations').discard(instance.pk)
+        if instance.client_id in _get_deleting('clients'):
+            return
+    ConfigurationChange.record(instance.client_id, instance.id, instance.file_path)
+
+
+@receiver(post_save, sender=ConfigurationFile)
+@receiver(post_delete, sender=ConfigurationFile)
+def configuration_file_changed(sender, instance, **kwargs):
+    if kwargs.get('signal') is post_delete and instance.configuration_id in _get_deleting('configurations'):
+        return
+    conf = Configuration.objects.filter(pk=instance.configuration_id).first()
+    if conf is None:
+        return
+    if kwargs.get('signal') is post_delete and conf.current_file_id is None:
+        # The latest revision was deleted, point at the one before it.
+        latest = conf.configurationfile_set.order_by('-revision').first()
+        Configuration.objects.filter(pk=conf.pk).update(current_file=latest)
+    ConfigurationChange.record(conf.client_id, conf.id, conf.file_path)
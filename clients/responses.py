@@ -0,0 +1,10 @@
+import json
+
+from django.http import HttpResponse
+
+
+def error_msg(msg, status=200):
+    return HttpResponse(json.dumps({'error': msg}), content_type='application/json', status=status)
+
+def debug_msg(msg):
+    return HttpResponse(json.dumps({'debug': msg}), content_type='application/json')
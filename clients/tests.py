@@ -1,3 +1,795 @@
-from django.test import TestCase
+import base64
+import gzip
+import json
+import threading
+from hashlib import sha1
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.test import Client as TestClient
+
+from clients.models import Client, Configuration, ConfigurationFile, ConfigurationChange, Blob, ConfigurationException
+from clients.models import client_cache, content_cache
+from clients.cache import LRUCache
+from cmdb_agent.lib import hash_tree
+from cmdb_agent.lib.hash_tree import HashTree
+
+
+def make_client(name='test-client.example.com', file_count=0):
+    client = Client(client_name=name, is_disabled=False)
+    client.save()
+    for i in range(file_count):
+        conf = Configuration.objects.create(client=client, file_path='/etc/test/{}.conf'.format(i))
+        ConfigurationFile(configuration=conf, content='setting = {}\n'.format(i), mtime=100 + i).save()
+    return client
+
+
+class PollManifestTests(TestCase):
+    def test_manifest_query_count_is_constant(self):
+        small = make_client('small.example.com', file_count=10)
+        large = make_client('large.example.com', file_count=200)
+        with self.assertNumQueries(1):
+            small.get_managed_configuration()
+        with self.assertNumQueries(1):
+            large.get_managed_configuration()
+    
+    def test_manifest_reports_latest_revision(self):
+        client = make_client(file_count=1)
+        conf_file = Configuration.objects.get(client=client).get_current_file()
+        conf_file.content = 'setting = changed\n'
+        conf_file.save()
+        manifest = client.get_managed_configuration()
+        self.assertEqual(manifest['configuration_count'], 1)
+        self.assertEqual(manifest['configurations'][0]['revision'], 2)
+        self.assertEqual(manifest['configurations'][0]['sha1_checksum'], conf_file.sha1_checksum)
+
+
+class PollViewTests(TestCase):
+    def test_poll_honours_if_none_match(self):
+        client = make_client(file_count=2)
+        response = self.client.get('/clients/poll/', {'api_key': client.api_key})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        
+        response = self.client.get('/clients/poll/', {'api_key': client.api_key}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        
+        conf_file = Configuration.objects.filter(client=client)[0].get_current_file()
+        conf_file.content = 'setting = changed\n'
+        conf_file.save()
+        response = self.client.get('/clients/poll/', {'api_key': client.api_key}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+    
+    def test_manifest_is_cached_until_a_write(self):
+        client = make_client(file_count=2)
+        response = self.client.get('/clients/poll/', {'api_key': client.api_key})
+        with self.assertNumQueries(1):
+            cached = self.client.get('/clients/poll/', {'api_key': client.api_key})
+        self.assertEqual(cached.content, response.content)
+        
+        conf_file = Configuration.objects.filter(client=client)[0].get_current_file()
+        conf_file.content = 'setting = changed\n'
+        conf_file.save()
+        response = self.client.get('/clients/poll/', {'api_key': client.api_key})
+        self.assertNotEqual(response.content, cached.content)
+        revisions = [c['revision'] for c in json.loads(response.content.decode('UTF-8'))['configurations']]
+        self.assertIn(2, revisions)
+    
+    def test_small_files_are_inlined(self):
+        client = make_client(file_count=2)
+        conf_file = Configuration.objects.get(client=client, file_path='/etc/test/1.conf').get_current_file()
+        conf_file.content = 'setting = much longer than the others\n'
+        conf_file.save()
+        content_cache.clear()
+        for path, params in (('/clients/poll/', {}), ('/clients/changes/', {'cursor': 0})):
+            params.update({'api_key': client.api_key, 'inline': 16})
+            response = self.client.get(path, params)
+            entries = dict((c['file_path'], c) for c in json.loads(response.content.decode('UTF-8'))['configurations'])
+            self.assertEqual(entries['/etc/test/0.conf']['content'], 'setting = 0\n')
+            self.assertEqual(entries['/etc/test/0.conf']['revision'], 1)
+            self.assertNotIn('content', entries['/etc/test/1.conf'])
+        response = self.client.get('/clients/poll/', {'api_key': client.api_key, 'inline': -1})
+        self.assertIn('error', json.loads(response.content.decode('UTF-8')))
+    
+    def test_etag_depends_on_what_is_inlined(self):
+        client = make_client(file_count=1)
+        for path in ('/clients/poll/', '/clients/changes/'):
+            plain = self.client.get(path, {'api_key': client.api_key})
+            inlined = self.client.get(path, {'api_key': client.api_key, 'inline': 4096})
+            self.assertNotEqual(plain['ETag'], inlined['ETag'])
+            response = self.client.get(path, {'api_key': client.api_key, 'inline': 4096},
+                                       HTTP_IF_NONE_MATCH=plain['ETag'])
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('content', json.loads(response.content.decode('UTF-8'))['configurations'][0])
+            response = self.client.get(path, {'api_key': client.api_key, 'inline': 4096},
+                                       HTTP_IF_NONE_MATCH=inlined['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+
+class ConfigurationChangesTests(TestCase):
+    def test_changes_since_cursor(self):
+        client = make_client(file_count=3)
+        full = client.get_configuration_changes(0)
+        self.assertTrue(full['is_full'])
+        self.assertEqual(len(full['configurations']), 3)
+        cursor = full['cursor']
+        
+        unchanged = client.get_configuration_changes(cursor)
+        self.assertEqual(unchanged['configurations'], [])
+        self.assertEqual(unchanged['cursor'], cursor)
+        
+        conf = Configuration.objects.get(client=client, file_path='/etc/test/1.conf')
+        conf_file = conf.get_current_file()
+        conf_file.content = 'setting = changed\n'
+        conf_file.save()
+        Configuration.objects.get(client=client, file_path='/etc/test/2.conf').delete()
+        
+        changed = client.get_configuration_changes(cursor)
+        self.assertGreater(changed['cursor'], cursor)
+        self.assertEqual([c['file_path'] for c in changed['configurations']], ['/etc/test/1.conf'])
+        self.assertEqual(changed['configurations'][0]['revision'], 2)
+        self.assertEqual(changed['removed'], ['/etc/test/2.conf'])
+    
+    def test_cursor_past_the_latest_change(self):
+        client = make_client(file_count=1)
+        cursor = client.get_configuration_changes(0)['cursor']
+        details = client.get_configuration_changes(cursor + 10)
+        self.assertEqual(details['cursor'], cursor)
+        self.assertEqual(details['configurations'], [])
+    
+    def test_only_the_latest_change_is_kept(self):
+        client = make_client(file_count=1)
+        conf = Configuration.objects.get(client=client)
+        cursor = client.get_configuration_changes(0)['cursor']
+        for i in range(3):
+            conf_file = conf.get_current_file()
+            conf_file.content = 'setting = {}\n'.format(i)
+            conf_file.save()
+            conf = Configuration.objects.get(pk=conf.pk)
+        self.assertEqual(ConfigurationChange.objects.filter(configuration_id=conf.pk).count(), 1)
+        changed = client.get_configuration_changes(cursor)
+        self.assertEqual(changed['configurations'][0]['revision'], 4)
+    
+    def test_deleting_a_configuration_records_one_change(self):
+        client = make_client(file_count=2)
+        query_counts = []
+        for i, revisions in enumerate((2, 10)):
+            conf = Configuration.objects.get(client=client, file_path='/etc/test/{}.conf'.format(i))
+            for r in range(revisions - 1):
+                conf_file = conf.get_current_file()
+                conf_file.content = 'setting = {}\n'.format(r)
+                conf_file.save()
+                conf = Configuration.objects.get(pk=conf.pk)
+            conf_id = conf.pk
+            with CaptureQueriesContext(connection) as queries:
+                conf.delete()
+            query_counts.append(len(queries))
+            self.assertEqual(ConfigurationChange.objects.filter(configuration_id=conf_id).count(), 1)
+        self.assertEqual(query_counts[0], query_counts[1])
+    
+    def test_bulk_deletes_record_one_change_each(self):
+        client = make_client(file_count=3)
+        for conf in Configuration.objects.filter(client=client):
+            for r in range(3):
+                conf_file = conf.get_current_file()
+                conf_file.content = 'setting = {}\n'.format(r)
+                conf_file.save()
+                conf = Configuration.objects.get(pk=conf.pk)
+        cursor = client.get_configuration_changes(0)['cursor']
+        with CaptureQueriesContext(connection) as queries:
+            Configuration.objects.filter(client=client).exclude(file_path='/etc/test/0.conf').delete()
+        inserts = [q for q in queries if 'INSERT INTO "clients_configurationchange"' in q['sql']]
+        self.assertEqual(len(inserts), 2)
+        changes = ConfigurationChange.objects.filter(client=client, id__gt=cursor)
+        self.assertEqual(sorted(changes.values_list('file_path', flat=True)), ['/etc/test/1.conf', '/etc/test/2.conf'])
+        self.assertEqual(client.get_configuration_changes(cursor)['removed'], ['/etc/test/1.conf', '/etc/test/2.conf'])
+    
+    def test_deleting_a_client_records_nothing(self):
+        client = make_client(file_count=3)
+        client_id = client.pk
+        with CaptureQueriesContext(connection) as queries:
+            client.delete()
+        self.assertFalse(ConfigurationChange.objects.filter(client_id=client_id).exists())
+        self.assertFalse([q for q in queries if 'INSERT' in q['sql']])
+        
+        other = make_client('other.example.com', file_count=2)
+        Client.objects.filter(pk=other.pk).delete()
+        self.assertFalse(ConfigurationChange.objects.filter(client_id=other.pk).exists())
+
+
+class FetchManyViewTests(TestCase):
+    def test_fetch_many_streams_every_file(self):
+        # Agents don't send CSRF tokens.
+        self.client = TestClient(enforce_csrf_checks=True)
+        client = make_client(file_count=3)
+        conf_file = Configuration.objects.get(client=client, file_path='/etc/test/0.conf').get_current_file()
+        conf_file.content = 'setting = changed\n'
+        conf_file.save()
+        files = ['/etc/test/0.conf', {'file_path': '/etc/test/0.conf', 'revision': 1},
+                 '/etc/test/2.conf', '/etc/test/missing.conf']
+        response = self.client.post('/clients/fetch_many/', json.dumps({'api_key': client.api_key, 'files': files}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('UTF-8').splitlines()
+        payloads = [json.loads(line) for line in lines]
+        self.assertEqual([p['file_path'] for p in payloads], ['/etc/test/0.conf', '/etc/test/0.conf',
+                                                              '/etc/test/2.conf', '/etc/test/missing.conf'])
+        self.assertEqual(payloads[0]['content'], 'setting = changed\n')
+        self.assertEqual(payloads[1]['revision'], 1)
+        self.assertEqual(payloads[1]['content'], 'setting = 0\n')
+        self.assertEqual(payloads[2]['content'], 'setting = 2\n')
+        self.assertIn('error', payloads[3])
+    
+    def test_inline_returns_manifest_entries(self):
+        client = make_client(file_count=2)
+        conf_file = Configuration.objects.get(client=client, file_path='/etc/test/1.conf').get_current_file()
+        conf_file.content = 'setting = much longer than the others\n'
+        conf_file.save()
+        files = ['/etc/test/0.conf', '/etc/test/1.conf']
+        response = self.client.post('/clients/fetch_many/', json.dumps({'api_key': client.api_key, 'files': files,
+                                                                         'inline': 16}),
+                                    content_type='application/json')
+        payloads = [json.loads(line) for line in b''.join(response.streaming_content).decode('UTF-8').splitlines()]
+        self.assertEqual(payloads[0]['content'], 'setting = 0\n')
+        self.assertNotIn('content', payloads[1])
+        self.assertEqual(payloads[1]['sha1_checksum'], conf_file.sha1_checksum)
+        self.assertEqual(payloads[1]['revision'], 2)
+
+
+class PushManyViewTests(TestCase):
+    def test_push_many_returns_per_file_results(self):
+        client = make_client(file_count=2)
+        content = 'setting = pushed\n'
+        checksum = sha1(content.encode('UTF-8')).hexdigest()
+        files = [
+            {'file_path': '/etc/test/0.conf', 'mtime': 1000, 'content': content, 'sha1_checksum': checksum,
+             'is_case_sensitive': True, 'is_binary': False, 'is_encrypted': False},
+            {'file_path': '/etc/test/1.conf', 'mtime': 1000, 'content': content, 'sha1_checksum': '0' * 40,
+             'is_case_sensitive': True, 'is_binary': False, 'is_encrypted': False},
+            {'file_path': '/etc/test/2.conf', 'mtime': 'soon'},
+        ]
+        response = self.client.post('/clients/push_many/', json.dumps({'api_key': client.api_key, 'files': files}),
+                                    content_type='application/json')
+        results = json.loads(response.content.decode('UTF-8'))['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['revision'], 2)
+        self.assertIn('Checksum mismatch', results[1]['error'])
+        self.assertEqual(results[1]['file_path'], '/etc/test/1.conf')
+        self.assertIn('error', results[2])
+        conf = Configuration.objects.get(client=client, file_path='/etc/test/0.conf')
+        self.assertEqual(conf.get_current_file().content, content)
+    
+    def test_gzip_request_body(self):
+        client = make_client(file_count=1)
+        content = 'setting = pushed\n'
+        files = [{'file_path': '/etc/test/0.conf', 'mtime': 1000, 'content': content,
+                  'sha1_checksum': sha1(content.encode('UTF-8')).hexdigest(),
+                  'is_case_sensitive': True, 'is_binary': False, 'is_encrypted': False}]
+        body = gzip.compress(json.dumps({'api_key': client.api_key, 'files': files}).encode('UTF-8'))
+        response = self.client.post('/clients/push_many/', body, content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(json.loads(response.content.decode('UTF-8'))['results'][0]['revision'], 2)
+        
+        response = self.client.post('/clients/push_many/', b'not gzip', content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content.decode('UTF-8')))
+        
+        response = self.client.post('/clients/push_many/', body[:-8], content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content.decode('UTF-8')))
+
+
+class BlobTests(TestCase):
+    def test_identical_content_is_stored_once(self):
+        first = make_client('first.example.com', file_count=2)
+        second = make_client('second.example.com', file_count=2)
+        self.assertEqual(Blob.objects.count(), 2)
+        conf_file = Configuration.objects.get(client=first, file_path='/etc/test/0.conf').get_current_file()
+        conf_file.content = 'setting = 1\n'
+        conf_file.save()
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertEqual(conf_file.blob_id, Blob.checksum('setting = 1\n'))
+        self.assertEqual(ConfigurationFile.objects.get(pk=conf_file.pk).content, 'setting = 1\n')
+
+
+class DeltaHistoryTests(TestCase):
+    def test_old_revisions_are_deltas_and_rebuild(self):
+        client = make_client()
+        conf = Configuration.objects.create(client=client, file_path='/etc/test/history.conf')
+        body = ['line {}\n'.format(i) for i in range(50)]
+        history = [''.join(body)]
+        conf_file = ConfigurationFile(configuration=conf, content=history[0])
+        conf_file.save()
+        for revision in range(2, 41):
+            body[revision] = 'changed {}\n'.format(revision)
+            history.append(''.join(body))
+            conf_file.content = history[-1]
+            conf_file.save()
+        
+        latest = Configuration.objects.select_related('current_file__blob').get(pk=conf.pk).get_current_file()
+        self.assertIsNone(latest.blob.base_id)
+        for revision, content in enumerate(history, 1):
+            conf_file = ConfigurationFile.objects.get(configuration=conf, revision=revision)
+            self.assertEqual(conf_file.content, content)
+            deltas = 0
+            blob = conf_file.blob
+            while blob.base_id is not None:
+                deltas += 1
+                blob = blob.base
+            self.assertLess(deltas, 16)
+        self.assertLess(Blob.objects.filter(base=None).count(), 10)
+
+
+class CompressionTests(TestCase):
+    def test_compressed_blob_is_sent_as_stored(self):
+        client = make_client()
+        conf = Configuration.objects.create(client=client, file_path='/etc/test/big.conf')
+        content = ''.join('setting_{} = value\n'.format(i) for i in range(500))
+        ConfigurationFile(configuration=conf, content=content).save()
+        blob = Blob.objects.get(pk=Blob.checksum(content))
+        self.assertEqual(blob.codec, 'gzip')
+        self.assertEqual(blob.content, '')
+        self.assertEqual(blob.get_stored(), content.encode('UTF-8'))
+        
+        params = {'api_key': client.api_key, 'file_path': '/etc/test/big.conf', 'raw': '1'}
+        response = self.client.get('/clients/fetch/', params, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(b''.join(response.streaming_content), bytes(blob.data))
+        gzip_etag = response['ETag']
+        response = self.client.get('/clients/fetch/', params)
+        self.assertEqual(b''.join(response.streaming_content), content.encode('UTF-8'))
+        etag = response['ETag']
+        self.assertNotEqual(gzip_etag, etag)
+        
+        # Ranges are resumed from the representation If-Range names.
+        for url in ('/clients/fetch/', '/clients/blob/{}/'.format(blob.pk)):
+            response = self.client.get(url, params, HTTP_ACCEPT_ENCODING='gzip', HTTP_X_CMDB_API_KEY=client.api_key,
+                                       HTTP_RANGE='bytes=10-', HTTP_IF_RANGE=gzip_etag)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(b''.join(response.streaming_content), bytes(blob.data)[10:])
+            response = self.client.get(url, params, HTTP_ACCEPT_ENCODING='gzip', HTTP_X_CMDB_API_KEY=client.api_key,
+                                       HTTP_RANGE='bytes=10-', HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 206)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(b''.join(response.streaming_content), content.encode('UTF-8')[10:])
+    
+    def test_uncompressed_rows_keep_working(self):
+        Blob.objects.create(sha1_checksum=Blob.checksum('old row\n'), content='old row\n')
+        self.assertEqual(Blob.objects.get(pk=Blob.checksum('old row\n')).get_stored(), b'old row\n')
+
+
+class RawFetchTests(TestCase):
+    def setUp(self):
+        self.api_client = make_client(file_count=1)
+        self.params = {'api_key': self.api_client.api_key, 'file_path': '/etc/test/0.conf', 'raw': '1'}
+        self.content = b'setting = 0\n'
+    
+    def test_metadata_in_headers(self):
+        response = self.client.get('/clients/fetch/', self.params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['X-CMDB-Revision'], '1')
+        self.assertEqual(response['X-CMDB-SHA1-Checksum'], sha1(self.content).hexdigest())
+        self.assertEqual(response['X-CMDB-Mtime'], '100')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+    
+    def test_range_resumes_download(self):
+        etag = '"{}"'.format(sha1(self.content).hexdigest())
+        response = self.client.get('/clients/fetch/', self.params, HTTP_RANGE='bytes=4-', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 4-{}/{}'.format(len(self.content) - 1, len(self.content)))
+        self.assertEqual(b''.join(response.streaming_content), self.content[4:])
+        
+        response = self.client.get('/clients/fetch/', self.params, HTTP_RANGE='bytes=4-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        
+        response = self.client.get('/clients/fetch/', self.params, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+
+
+class BlobViewTests(TestCase):
+    def setUp(self):
+        self.api_client = make_client(file_count=1)
+        self.content = b'setting = 0\n'
+        self.url = '/clients/blob/{}/'.format(sha1(self.content).hexdigest())
+    
+    def test_blob_is_cacheable_forever(self):
+        response = self.client.get(self.url, HTTP_X_CMDB_API_KEY=self.api_client.api_key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['ETag'], '"{}"'.format(sha1(self.content).hexdigest()))
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+        
+        response = self.client.get(self.url, HTTP_X_CMDB_API_KEY=self.api_client.api_key,
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+    
+    def test_blob_with_its_token_is_shared(self):
+        entry = Configuration.objects.get(client=self.api_client).get_manifest_entry()
+        self.assertEqual(entry['blob_token'], Blob.get_token(sha1(self.content).hexdigest()))
+        url = '{}{}/'.format(self.url, entry['blob_token'])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertNotIn('X-CMDB-Api-Key', response['Vary'])
+        
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('public', response['Cache-Control'])
+        
+        response = self.client.get('{}{}/'.format(self.url, Blob.get_token('0' * 40)))
+        self.assertEqual(response.status_code, 404)
+    
+    def test_blob_of_another_client_is_not_found(self):
+        other = make_client('other.example.com')
+        response = self.client.get(self.url, HTTP_X_CMDB_API_KEY=other.api_key)
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('error', json.loads(response.content.decode('UTF-8')))
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        self.api_client = make_client(file_count=1)
+        self.content = bytes(range(256)) * 64
+    
+    def test_raw_push_stores_binary_content(self):
+        params = {
+            'api_key': self.api_client.api_key,
+            'file_path': '/etc/test/0.conf',
+            'mtime': '200',
+            'sha1_checksum': sha1(self.content).hexdigest(),
+            'is_case_sensitive': 'true',
+            'is_binary': 'true',
+        }
+        url = '/clients/push/?' + '&'.join('{}={}'.format(k, v) for k, v in params.items())
+        response = self.client.post(url, self.content, content_type='application/octet-stream')
+        self.assertEqual(json.loads(response.content.decode('UTF-8'))['revision'], 2)
+        
+        conf_file = Configuration.objects.get(client=self.api_client).get_current_file()
+        self.assertEqual(conf_file.content_length, len(self.content))
+        # Compressed as it was read back from the spooled upload.
+        self.assertEqual(conf_file.blob.codec, 'gzip')
+        self.assertEqual(conf_file.data, self.content)
+        response = self.client.get('/clients/fetch/', {'api_key': self.api_client.api_key,
+                                                       'file_path': '/etc/test/0.conf', 'raw': '1'})
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        
+        response = self.client.post(url.replace('mtime=200', 'mtime=300'), b'tampered',
+                                    content_type='application/octet-stream')
+        self.assertIn('Checksum mismatch', json.loads(response.content.decode('UTF-8'))['error'])
+    
+    def test_multipart_add(self):
+        upload = SimpleUploadedFile('logo.png', self.content)
+        response = self.client.post('/clients/add/', {
+            'api_key': self.api_client.api_key,
+            'type': 'configuration',
+            'file_path': '/etc/test/logo.png',
+            'mtime': '100',
+            'is_case_sensitive': 'true',
+            'is_binary': 'true',
+            'content': upload,
+        })
+        details = json.loads(response.content.decode('UTF-8'))
+        self.assertEqual(details['sha1_checksum'], sha1(self.content).hexdigest())
+        
+        conf = Configuration.objects.get(file_path='/etc/test/logo.png')
+        self.assertTrue(conf.is_binary)
+        details = conf.get_fetch_details()
+        self.assertEqual(details['content_encoding'], 'base64')
+        self.assertEqual(base64.b64decode(details['content']), self.content)
+    
+    def test_raw_add_requires_case_sensitivity(self):
+        params = {'api_key': self.api_client.api_key, 'file_path': '/etc/test/raw.bin', 'mtime': '100'}
+        url = '/clients/add/?' + '&'.join('{}={}'.format(k, v) for k, v in params.items())
+        response = self.client.post(url, self.content, content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Configuration.objects.filter(file_path='/etc/test/raw.bin').exists())
+        
+        response = self.client.post(url + '&is_case_sensitive=true', self.content,
+                                    content_type='application/octet-stream')
+        self.assertEqual(json.loads(response.content.decode('UTF-8'))['content_length'], len(self.content))
+        self.assertTrue(Configuration.objects.get(file_path='/etc/test/raw.bin').is_case_sensitive)
+
+
+class ClientCacheTests(TestCase):
+    def setUp(self):
+        client_cache.clear()
+        self.api_client = make_client()
+    
+    def test_cached_lookup_skips_the_database(self):
+        Client.get_by_api_key(self.api_client.api_key)
+        with self.assertNumQueries(0):
+            client = Client.get_by_api_key(self.api_client.api_key)
+        self.assertEqual(client.pk, self.api_client.pk)
+        self.assertEqual(client_cache.stats()['hits'], 1)
+        self.assertEqual(client_cache.stats()['misses'], 1)
+    
+    def test_save_invalidates(self):
+        Client.get_by_api_key(self.api_client.api_key)
+        self.api_client.is_blacklisted = True
+        self.api_client.save()
+        self.assertTrue(Client.get_by_api_key(self.api_client.api_key).is_blacklisted)
+        
+        Client.disable_client(self.api_client.api_key)
+        self.assertTrue(Client.get_by_api_key(self.api_client.api_key).is_disabled)
+        
+        api_key = self.api_client.api_key
+        self.api_client.delete()
+        with self.assertRaises(Client.DoesNotExist):
+            Client.get_by_api_key(api_key)
+    
+    def test_save_invalidates_other_processes(self):
+        Client.get_by_api_key(self.api_client.api_key)
+        stale = client_cache.get(self.api_client.api_key)
+        self.api_client.is_blacklisted = True
+        self.api_client.save()
+        # The entry another process still holds for the client.
+        client_cache.set(self.api_client.api_key, stale)
+        self.assertTrue(Client.get_by_api_key(self.api_client.api_key).is_blacklisted)
+        with self.assertNumQueries(0):
+            Client.get_by_api_key(self.api_client.api_key)
+    
+    def test_changing_the_key_forgets_the_old_one(self):
+        old_key = self.api_client.api_key
+        Client.get_by_api_key(old_key)
+        self.api_client.api_key = 'f' * 40
+        self.api_client.save()
+        with self.assertRaises(Client.DoesNotExist):
+            Client.get_by_api_key(old_key)
+        self.assertEqual(Client.get_by_api_key('f' * 40).pk, self.api_client.pk)
+
+
+class ContentCacheTests(TestCase):
+    def test_byte_budget_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', b'aaaa')
+        cache.set('b', b'bbbb')
+        cache.get('a')
+        cache.set('c', b'cccc')
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.size, 8)
+        cache.set('d', b'd' * 11)
+        self.assertNotIn('d', cache)
+    
+    def test_fetch_reads_content_from_cache(self):
+        client = make_client(file_count=1)
+        content_cache.clear()
+        params = {'api_key': client.api_key, 'file_path': '/etc/test/0.conf'}
+        self.client.get('/clients/fetch/', params)
+        with self.assertNumQueries(1):
+            response = self.client.get('/clients/fetch/', params)
+        self.assertEqual(json.loads(response.content.decode('UTF-8'))['content'], 'setting = 0\n')
+        self.assertEqual(content_cache.stats()['hits'], 1)
+
+
+class RevisionAllocationTests(TransactionTestCase):
+    def setUp(self):
+        name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite' and (name == ':memory:' or 'mode=memory' in name):
+            self.skipTest('Needs a file-backed test database that separate connections share.')
+        self.api_client = make_client(file_count=1)
+    
+    def test_parallel_writes_get_distinct_revisions(self):
+        conf = Configuration.objects.get(client=self.api_client)
+        writes = 20
+        errors = []
+        
+        def write(i):
+            try:
+                ConfigurationFile(configuration_id=conf.id, content='setting = {}\n'.format(i), mtime=1000 + i).save()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+        
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(writes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(errors, [])
+        conf = Configuration.objects.get(pk=conf.pk)
+        revisions = sorted(conf.configurationfile_set.values_list('revision', flat=True))
+        self.assertEqual(revisions, list(range(1, writes + 2)))
+        self.assertEqual(conf.revision_count, writes + 1)
+        self.assertEqual(conf.current_file.revision, writes + 1)
+
+
+class QueryPlanTests(TestCase):
+    """
+    Run every endpoint and check that none of the queries it makes has to
+    scan a whole table.
+    """
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plans are checked with SQLite.')
+        client_cache.clear()
+        content_cache.clear()
+        self.api_client = make_client(file_count=3)
+        make_client('other.example.com', file_count=3)
+        conf_file = Configuration.objects.filter(client=self.api_client)[0].get_current_file()
+        conf_file.content = 'setting = changed\n'
+        conf_file.save()
+        self.api_key = self.api_client.api_key
+    
+    def record(self, method, path, data, **kwargs):
+        statements = []
+        execute = CursorWrapper.execute
+        
+        def record_execute(cursor, sql, params=None):
+            statements.append((sql, params))
+            return execute(cursor, sql, params)
+        
+        with mock.patch.object(CursorWrapper, 'execute', record_execute):
+            response = getattr(self.client, method)(path, data, **kwargs)
+            if getattr(response, 'streaming', False):
+                b''.join(response.streaming_content)
+        return statements
+    
+    def full_scans(self, statements):
+        scans = []
+        cursor = connection.cursor()
+        for sql, params in statements:
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            for row in cursor.fetchall():
+                detail = row[-1]
+                if detail.startswith('SCAN') and detail != 'SCAN CONSTANT ROW':
+                    scans.append('{}\n    {}'.format(detail, sql))
+        return scans
+    
+    def assertNoFullScans(self, method, path, data, **kwargs):
+        statements = self.record(method, path, data, **kwargs)
+        self.assertTrue(statements)
+        self.assertEqual(self.full_scans(statements), [])
+    
+    def push_data(self, content, mtime):
+        return {
+            'file_path': '/etc/test/1.conf', 'mtime': mtime, 'content': content,
+            'sha1_checksum': sha1(content.encode('UTF-8')).hexdigest(),
+            'is_case_sensitive': True, 'is_binary': False, 'is_encrypted': False,
+        }
+    
+    def test_read_endpoints(self):
+        self.assertNoFullScans('get', '/clients/poll/', {'api_key': self.api_key})
+        self.assertNoFullScans('get', '/clients/changes/', {'api_key': self.api_key})
+        self.assertNoFullScans('get', '/clients/changes/', {'api_key': self.api_key, 'cursor': 2})
+        self.assertNoFullScans('get', '/clients/changes/', {'api_key': self.api_key, 'inline': 4096})
+        self.assertNoFullScans('get', '/clients/tree/', {'api_key': self.api_key})
+        conf_file = Configuration.objects.filter(client=self.api_client)[0].get_current_file()
+        self.assertNoFullScans('get', '/clients/blob/{}/'.format(conf_file.blob_id), {'api_key': self.api_key})
+        self.assertNoFullScans('get', '/clients/blob/{}/{}/'.format(conf_file.blob_id, Blob.get_token(conf_file.blob_id)),
+                               {})
+        self.assertNoFullScans('get', '/clients/status/', {'api_key': self.api_key})
+        self.assertNoFullScans('get', '/clients/info/', {'api_key': self.api_key})
+        self.assertNoFullScans('get', '/clients/fetch/', {'api_key': self.api_key, 'file_path': '/etc/test/0.conf'})
+        self.assertNoFullScans('get', '/clients/fetch/', {'api_key': self.api_key, 'file_path': '/etc/test/0.conf',
+                                                          'raw': '1'})
+        files = ['/etc/test/1.conf', {'file_path': '/etc/test/0.conf', 'revision': 1}]
+        self.assertNoFullScans('post', '/clients/fetch_many/', json.dumps({'api_key': self.api_key, 'files': files}),
+                               content_type='application/json')
+    
+    def test_write_endpoints(self):
+        data = self.push_data('setting = pushed\n', 200)
+        data['api_key'] = self.api_key
+        self.assertNoFullScans('post', '/clients/push/', json.dumps(data), content_type='application/json')
+        files = [self.push_data('setting = pushed again\n', 300)]
+        self.assertNoFullScans('post', '/clients/push_many/', json.dumps({'api_key': self.api_key, 'files': files}),
+                               content_type='application/json')
+        configuration = {'file_path': '/etc/test/new.conf', 'mtime': 100, 'case_sensitive': True,
+                         'payload': 'setting = new\n'}
+        self.assertNoFullScans('post', '/clients/add/', json.dumps({
+            'api_key': self.api_key, 'type': 'configuration', 'configuration': configuration}),
+            content_type='application/json')
+        self.assertNoFullScans('post', '/clients/remove/', json.dumps({
+            'api_key': self.api_key, 'type': 'configuration', 'configuration': configuration}),
+            content_type='application/json')
+
+
+class ContentLengthTests(TestCase):
+    def test_status_reports_length_without_loading_content(self):
+        client = make_client(file_count=2)
+        client_cache.clear()
+        content_cache.clear()
+        Client.get_by_api_key(client.api_key)
+        with self.assertNumQueries(1):
+            status = Client.get_config_status(client.api_key)
+        self.assertEqual([c['content_length'] for c in status['configurations']], [12, 12])
+        self.assertEqual(content_cache.stats()['misses'], 0)
+
+
+class PathKeyTests(TestCase):
+    def setUp(self):
+        self.client_obj = make_client()
+        Configuration.add(self.client_obj, 'C:\\Windows\\System.ini', 100, False, 'setting = 0\n')
+    
+    def test_case_insensitive_paths_match_any_case(self):
+        conf = Configuration.objects.get(client=self.client_obj)
+        self.assertEqual(conf.file_path, 'C:\\Windows\\System.ini')
+        self.assertEqual(conf.path_key, 'c:\\windows\\system.ini')
+        with self.assertNumQueries(1):
+            found = self.client_obj.find_configurations(['c:\\WINDOWS\\system.INI', '/etc/missing.conf'])
+        self.assertEqual(list(found.values()), [conf])
+        with self.assertRaises(ConfigurationException):
+            Configuration.add(self.client_obj, 'c:\\windows\\system.ini', 100, False, 'setting = 1\n')
+    
+    def test_case_sensitive_paths_match_exactly(self):
+        Configuration.add(self.client_obj, '/etc/Test.conf', 100, True, 'setting = 0\n')
+        Configuration.add(self.client_obj, '/etc/test.conf', 100, True, 'setting = 1\n')
+        found = self.client_obj.find_configurations(['/etc/test.conf', '/etc/TEST.conf'])
+        self.assertEqual(list(found), ['/etc/test.conf'])
+        self.assertEqual(found['/etc/test.conf'].get_current_file().content, 'setting = 1\n')
+
+
+class HashTreeTests(TestCase):
+    def walk(self, api_key, known):
+        changed, removed, requests = [], [], 0
+        prefixes = ['']
+        while prefixes:
+            requests += 1
+            response = self.client.get('/clients/tree/', {'api_key': api_key, 'prefix': prefixes})
+            prefixes = []
+            for node in json.loads(response.content.decode('UTF-8'))['nodes']:
+                descend, node_changed, node_removed = known.diff(node)
+                prefixes.extend(descend)
+                changed.extend(node_changed)
+                removed.extend(node_removed)
+        return changed, removed, requests
+    
+    def test_walk_finds_only_what_changed(self):
+        client = make_client(file_count=300)
+        confs = Configuration.objects.filter(client=client).select_related('current_file')
+        entries = [(c.file_path, c.current_file.sha1_checksum, c.current_file.revision) for c in confs]
+        known = HashTree(entries)
+        self.assertEqual(client.get_hash_tree().root, known.root)
+        self.assertEqual(self.walk(client.api_key, known), ([], [], 1))
+        
+        conf_file = Configuration.objects.get(client=client, file_path='/etc/test/7.conf').get_current_file()
+        conf_file.content = 'setting = changed\n'
+        conf_file.save()
+        Configuration.objects.get(client=client, file_path='/etc/test/8.conf').delete()
+        changed, removed, requests = self.walk(client.api_key, known)
+        self.assertEqual(changed, [('/etc/test/7.conf', conf_file.sha1_checksum, 2)])
+        self.assertEqual(removed, ['/etc/test/8.conf'])
+        self.assertLessEqual(requests, hash_tree.DEPTH + 1)
+    
+    def test_root_carries_the_change_cursor(self):
+        client = make_client(file_count=2)
+        response = self.client.get('/clients/tree/', {'api_key': client.api_key})
+        cursor = json.loads(response.content.decode('UTF-8'))['cursor']
+        self.assertEqual(cursor, client.get_configuration_changes(0)['cursor'])
+    
+    def test_only_the_root_is_not_modified(self):
+        client = make_client(file_count=2)
+        etag = self.client.get('/clients/tree/', {'api_key': client.api_key})['ETag']
+        response = self.client.get('/clients/tree/', {'api_key': client.api_key}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        
+        prefix = '0'
+        response = self.client.get('/clients/tree/', {'api_key': client.api_key, 'prefix': prefix},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEqual(json.loads(response.content.decode('UTF-8'))['nodes'][0]['prefix'], prefix)
+    
+    def test_invalid_prefix_is_refused(self):
+        client = make_client(file_count=1)
+        response = self.client.get('/clients/tree/', {'api_key': client.api_key, 'prefix': 'xyz'})
+        self.assertIn('error', json.loads(response.content.decode('UTF-8')))
@@ -15,6 +15,13 @@ urlpatterns = patterns('',
     url(r'^add/$', 'clients.views.add', name='add'),
     url(r'^remove/$', 'clients.views.remove', name='remove'),
     url(r'^poll/$', 'clients.views.poll', name='poll'),
+    url(r'^changes/$', 'clients.views.changes', name='changes'),
+    url(r'^tree/$', 'clients.views.tree', name='tree'),
     url(r'^fetch/$', 'clients.views.fetch', name='fetch'),
+    url(r'^fetch_many/$', 'clients.views.fetch_many', name='fetch_many'),
+    url(r'^blob/(?P<sha1_checksum>[0-9a-f]{40})/$', 'clients.views.blob', name='blob'),
+    url(r'^blob/(?P<sha1_checksum>[0-9a-f]{40})/(?P<token>[0-9a-f]{40})/$', 'clients.views.blob', name='shared_blob'),
     url(r'^push/$', 'clients.views.push', name='push'),
+    url(r'^push_many/$', 'clients.views.push_many', name='push_many'),
+    url(r'^cache_stats/$', 'clients.views.cache_stats', name='cache_stats'),
 )
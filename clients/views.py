@@ -1,24 +1,27 @@
 import json
+import os
+import tempfile
+from hashlib import sha1
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 
-from clients.models import Client, Configuration, ConfigurationFile
-from clients.models import ClientException
+from clients.models import Blob, Client, Configuration, ConfigurationFile
+from clients.models import ClientException, ConfigurationException, UploadedContent
+from clients.models import client_cache, content_cache
+from clients.responses import error_msg, debug_msg
 
 from cmdb_agent.lib import lib
+from cmdb_agent.lib import hash_tree
 
 ###########
 # Helpers
 ###########
 
-def error_msg(msg):
-    return HttpResponse(json.dumps({'error': msg}), content_type='application/json')
-
-def debug_msg(msg):
-    return HttpResponse(json.dumps({'debug': msg}), content_type='application/json')
-
 def status_msg(name, date_created, is_disabled, is_blacklisted, api_key=''):
     msg_dict = {
         'name': name,
@@ -44,7 +47,9 @@ def info_msg(client):
     return HttpResponse(json.dumps(msg_dict), content_type='application/json')
 
 def config_status_msg(config_status):
-    return HttpResponse(json.dumps(config_status), content_type='application/json')
+    if not isinstance(config_status, bytes):
+        config_status = json.dumps(config_status)
+    return HttpResponse(config_status, content_type='application/json')
 
 def unregister_msg(name, is_disabled):
     return HttpResponse(json.dumps({'fqdn': name, 'is_disabled': is_disabled}), content_type='application/json')
@@ -52,12 +57,289 @@ def unregister_msg(name, is_disabled):
 def configuration_added_msg(details):
     return HttpResponse(json.dumps(details), content_type='application/json')
 
-def poll_msg(details):
-    return HttpResponse(json.dumps(details), content_type='application/json')
+def poll_msg(details, etag=None):
+    # Manifests may come already serialized from the manifest cache.
+    if not isinstance(details, bytes):
+        details = json.dumps(details)
+    response = HttpResponse(details, content_type='application/json')
+    if etag:
+        response['ETag'] = etag
+    return response
+
+def not_modified_msg(etag):
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    return response
+
+def changes_msg(details, etag=None):
+    return poll_msg(details, etag)
+
+def tree_msg(details, etag=None):
+    return poll_msg(details, etag)
 
 def fetch_msg(details):
     return HttpResponse(json.dumps(details), content_type='application/json')
 
+def parse_range(header, length):
+    '''
+    Return the `(start, end)` byte offsets (end exclusive) asked for by a
+    single range `Range` header, None if the whole body should be sent, or
+    False if the range can't be satisfied.
+    '''
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first == '':
+            suffix = int(last)
+            if suffix <= 0:
+                return False
+            return (max(length - suffix, 0), length)
+        start = int(first)
+        end = int(last) + 1 if last else length
+    except ValueError:
+        return None
+    if start >= length or end <= start:
+        return False
+    return (start, min(end, length))
+
+def stream_bytes(data, start, end, chunk_size=64 * 1024):
+    for offset in range(start, end, chunk_size):
+        yield data[offset:min(offset + chunk_size, end)]
+
+def raw_content_msg(request, config, conf_file):
+    headers = {
+        'ETag': '"{}"'.format(conf_file.sha1_checksum),
+        'Accept-Ranges': 'bytes',
+        'Vary': 'Accept-Encoding',
+        'X-CMDB-File-Path': config.file_path,
+        'X-CMDB-Revision': str(conf_file.revision),
+        'X-CMDB-SHA1-Checksum': conf_file.sha1_checksum,
+        'X-CMDB-Mtime': str(conf_file.mtime),
+        'X-CMDB-Is-Binary': str(config.is_binary),
+        'X-CMDB-Is-Encrypted': str(config.is_encrypted),
+    }
+    return content_msg(request, conf_file, headers, gzip_etag=get_blob_etag(conf_file.sha1_checksum, 'gzip'))
+
+BLOB_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+SHARED_BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def blob_msg(request, conf_file, is_shared=False):
+    # The content behind a sha1 never changes, so it may be kept for good.
+    # Blobs asked for with an api key are only for clients holding a
+    # revision of them, which a shared cache can't check, so only private
+    # caches may store them. Those asked for with their token are for
+    # whoever holds it, so any cache may. The gzip variant gets its own
+    # strong ETag, as its bytes differ.
+    headers = {
+        'ETag': get_blob_etag(conf_file.blob_id),
+        'Cache-Control': SHARED_BLOB_CACHE_CONTROL if is_shared else BLOB_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+        'Vary': 'Accept-Encoding' if is_shared else 'Accept-Encoding, X-CMDB-Api-Key',
+        'X-CMDB-SHA1-Checksum': conf_file.blob_id,
+    }
+    return content_msg(request, conf_file, headers, gzip_etag=get_blob_etag(conf_file.blob_id, 'gzip'))
+
+def blob_not_modified_msg(etag, is_shared=False):
+    response = not_modified_msg(etag)
+    response['Cache-Control'] = SHARED_BLOB_CACHE_CONTROL if is_shared else BLOB_CACHE_CONTROL
+    return response
+
+def content_msg(request, conf_file, headers, gzip_etag=None):
+    '''
+    Return the content of `conf_file` with `headers`, gzip encoded as stored
+    when the client accepts it, or the byte range asked for. The gzip bytes
+    are a representation of their own, sent with `gzip_etag`, and a range
+    is taken from whichever representation If-Range names.
+    '''
+    etag = headers.get('ETag')
+    
+    # A range is only honoured against the revision and representation it
+    # was started on.
+    range_header = request.META.get('HTTP_RANGE', '')
+    if_range = request.META.get('HTTP_IF_RANGE', '')
+    is_gzip = False
+    if range_header and if_range:
+        if gzip_etag and if_range == gzip_etag:
+            is_gzip = True
+        elif if_range != etag:
+            range_header = ''
+    if not range_header:
+        is_gzip = bool(gzip_etag) and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    
+    # Gzip blobs go out exactly as stored, without being decompressed and
+    # compressed again.
+    data = conf_file.get_encoded('gzip') if is_gzip else None
+    if data is None:
+        if is_gzip and range_header:
+            # Not held as gzip, the whole content is sent instead.
+            range_header = ''
+        is_gzip = False
+        data = conf_file.data
+    
+    byte_range = parse_range(range_header, len(data)) if range_header else None
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(len(data))
+        return response
+    start, end = byte_range or (0, len(data))
+    response = StreamingHttpResponse(stream_bytes(data, start, end), content_type='application/octet-stream')
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, len(data))
+    response['Content-Length'] = str(end - start)
+    for header, value in headers.items():
+        response[header] = value
+    if is_gzip:
+        response['Content-Encoding'] = 'gzip'
+        response['ETag'] = gzip_etag
+    return response
+
+def fetch_many_msg(details_iter):
+    # One JSON document per line, so neither side has to hold every file of
+    # the batch in memory at once.
+    lines = (json.dumps(details) + '\n' for details in details_iter)
+    return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+def cache_stats_msg(stats):
+    return HttpResponse(json.dumps(stats), content_type='application/json')
+
+def push_many_msg(results):
+    return HttpResponse(json.dumps({'results': results}), content_type='application/json')
+
+def check_push_fields(obj):
+    '''
+    Return an error message if `obj` is not a well formed pushed file, or
+    None if it is.
+    '''
+    # file_path
+    file_path = obj.get('file_path', None)
+    if not isinstance(file_path, str):
+        return 'Invalid `file_path`.'
+    if len(file_path) == 0:
+        return '`file_path` cannot be an empty string.'
+    
+    # mtime
+    mtime = obj.get('mtime', None)
+    if mtime is None:
+        return 'Invalid `mtime`.'
+    if not isinstance(mtime, int):
+        return '`mtime` must be an integer.'
+    
+    # sha1_checksum
+    sha1_checksum = obj.get('sha1_checksum', None)
+    if sha1_checksum is None:
+        return 'Invalid `sha1_checksum`.'
+    
+    # content
+    content = obj.get('content', None)
+    if content is None:
+        return 'Invalid `content`.'
+    
+    # is_case_sensitive
+    is_case_sensitive = obj.get('is_case_sensitive', None)
+    if is_case_sensitive is None:
+        return 'Invalid `is_case_sensitive`.'
+    if not isinstance(is_case_sensitive, bool):
+        return '`case_sensitive` must be boolean.'
+    
+    return None
+
+def is_upload(request):
+    '''
+    Return True if the request body is file content sent as is, either raw
+    or as a multipart form, rather than a JSON document.
+    '''
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+    return content_type in ('application/octet-stream', 'multipart/form-data')
+
+def get_upload_flag(meta, name, default=None):
+    value = meta.get(name, None)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+def get_upload_metadata(request):
+    '''
+    Return the fields sent with an upload, from the query string of a raw
+    upload or the form fields of a multipart one, as a pushed file object
+    without its content.
+    '''
+    if request.META.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+        meta = request.POST
+    else:
+        meta = request.GET
+    obj = {
+        'api_key': meta.get('api_key', ''),
+        'file_path': meta.get('file_path', None),
+        'mtime': meta.get('mtime', None),
+        'sha1_checksum': meta.get('sha1_checksum', None),
+        'is_case_sensitive': get_upload_flag(meta, 'is_case_sensitive'),
+        'is_binary': get_upload_flag(meta, 'is_binary', False),
+        'is_encrypted': get_upload_flag(meta, 'is_encrypted', False),
+    }
+    try:
+        obj['mtime'] = int(obj['mtime'])
+    except (TypeError, ValueError):
+        pass
+    return obj
+
+def read_upload(request, chunk_size=64 * 1024):
+    '''
+    Return the content of a raw or multipart upload as `UploadedContent`,
+    and its sha1. The body is read and hashed a chunk at a time into a
+    spooled temporary file, which blobs are stored from without holding it in
+    memory whole, and uploads over `CMDB_UPLOAD_MAX_SIZE` are refused before
+    they are read.
+    '''
+    max_size = getattr(settings, 'CMDB_UPLOAD_MAX_SIZE', 64 * 1024 * 1024)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > max_size:
+        raise ConfigurationException('Upload is larger than {} bytes.'.format(max_size))
+    
+    if request.META.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+        upload = request.FILES.get('content', None)
+        if upload is None:
+            raise ConfigurationException('Could not find `content` file in upload.')
+        chunks = upload.chunks(chunk_size)
+    else:
+        chunks = iter(lambda: request.read(chunk_size), b'')
+    
+    h = sha1()
+    size = 0
+    fh = tempfile.SpooledTemporaryFile(max_size=chunk_size * 16)
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                raise ConfigurationException('Upload is larger than {} bytes.'.format(max_size))
+            h.update(chunk)
+            fh.write(chunk)
+    except:
+        fh.close()
+        raise
+    return UploadedContent(fh, h.hexdigest(), size), h.hexdigest()
+
+def get_blob_etag(sha1_checksum, codec=None):
+    if codec:
+        return '"{}.{}"'.format(sha1_checksum, codec)
+    return '"{}"'.format(sha1_checksum)
+
+def get_inline_max(request):
+    '''
+    Return the size, in bytes, up to which the agent asked for file content
+    to be inlined in a manifest with `inline`, capped at
+    `CMDB_INLINE_MAX_SIZE`. Raises ValueError if `inline` isn't a
+    non-negative integer.
+    '''
+    inline_max = int(request.GET.get('inline', 0))
+    if inline_max < 0:
+        raise ValueError()
+    return min(inline_max, getattr(settings, 'CMDB_INLINE_MAX_SIZE', 64 * 1024))
+
 #########
 # Views
 #########
@@ -105,7 +387,7 @@ def info(request):
         if len(api_key) != 40:
             return error_msg('info: Invalid `api_key`.')
         try:
-            client = Client.objects.get(api_key=api_key)
+            client = Client.get_by_api_key(api_key)
             return info_msg(client)
         except:
             return error_msg('info: Client for `api_key` {} doesn\'t exist.'.format(api_key))
@@ -117,8 +399,8 @@ def status(request):
         if len(api_key) != 40:
             return error_msg('status: Invalid `api_key`.')
         try:
-            config_status = Client.get_config_status(api_key)
-            return config_status_msg(config_status)
+            client = Client.get_by_api_key(api_key)
+            return config_status_msg(client.get_config_status_json())
         except:
             return error_msg('status: Client for `api_key` doesn\'t exist.')
 
@@ -126,7 +408,23 @@ def status(request):
 @csrf_exempt
 def add(request):
     if request.method == 'POST':
-        obj = json.loads(request.body.decode('UTF-8'))
+        upload = is_upload(request)
+        if upload:
+            meta = get_upload_metadata(request)
+            if meta.get('is_case_sensitive') is None:
+                return error_msg('Invalid `is_case_sensitive`.', status=400)
+            obj = {
+                'api_key': meta.get('api_key'),
+                'type': request.GET.get('type', request.POST.get('type', 'configuration')),
+                'configuration': {
+                    'file_path': meta.get('file_path'),
+                    'mtime': meta.get('mtime'),
+                    'case_sensitive': meta.get('is_case_sensitive'),
+                    'is_binary': meta.get('is_binary'),
+                },
+            }
+        else:
+            obj = json.loads(request.body.decode('UTF-8'))
         if 'api_key' not in obj:
             return error_msg('Could not find `api_key` key in object.')
         try:
@@ -164,7 +462,15 @@ def add(request):
                     return error_msg('`mtime` must be a numerical string or an integer.')
             
             # Get `payload`
-            if 'payload' not in obj.get('configuration'):
+            if upload:
+                try:
+                    payload, sha1_checksum = read_upload(request)
+                except ConfigurationException as e:
+                    return error_msg(str(e))
+                if meta.get('sha1_checksum') not in (None, sha1_checksum):
+                    payload.close()
+                    return error_msg('Checksum mismatch for file `{}`, aborting.'.format(file_path))
+            elif 'payload' not in obj.get('configuration'):
                 return error_msg('Could not find `payload` key in object.configuration.')
             else:
                 try:
@@ -181,18 +487,30 @@ def add(request):
                 except:
                     return error_msg('`case_sensitive` must be boolean.')
             
+            # Get `is_binary`
+            is_binary = bool(obj.get('configuration').get('is_binary', False))
+            
             details = {
                 'file_path': file_path,
                 'mtime': mtime,
                 'case_sensitive': case_sensitive,
                 'payload': payload,
+                'is_binary': is_binary,
             }
             
             try:
                 Configuration.add(client, **details)
             except Exception as e:
                 return error_msg(str(e))
+            finally:
+                if upload:
+                    payload.close()
             
+            if upload:
+                # Don't echo uploaded content back.
+                del details['payload']
+                details['sha1_checksum'] = sha1_checksum
+                details['content_length'] = payload.size
             return configuration_added_msg(details)
         else:
             return error_msg('Could not understand the type: `{}`.'.format(obj.get('type')))
@@ -283,12 +601,91 @@ def poll(request):
         if len(api_key) != 40:
             return error_msg('Invalid `api_key`.')
         
+        try:
+            inline_max = get_inline_max(request)
+        except ValueError:
+            return error_msg('`inline` must be a non-negative integer.')
+        
+        try:
+            client = Client.get_by_api_key(api_key)
+        except:
+            return error_msg('Client for `api_key` doesn\'t exist.')
+        
+        etag = client.get_manifest_etag(inline_max)
+        if etag and etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return not_modified_msg(etag)
+        
+        return poll_msg(client.get_managed_configuration_json(inline_max), etag)
+
+def changes(request):
+    if request.method == 'GET':
+        api_key = request.GET.get('api_key', '')
+        if len(api_key) != 40:
+            return error_msg('Invalid `api_key`.')
+        
+        try:
+            cursor = int(request.GET.get('cursor', 0))
+            if cursor < 0:
+                raise ValueError()
+        except ValueError:
+            return error_msg('`cursor` must be a non-negative integer.')
+        
+        try:
+            inline_max = get_inline_max(request)
+        except ValueError:
+            return error_msg('`inline` must be a non-negative integer.')
+        
+        try:
+            client = Client.get_by_api_key(api_key)
+        except:
+            return error_msg('Client for `api_key` doesn\'t exist.')
+        
+        etag = client.get_manifest_etag(inline_max)
+        if etag and etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return not_modified_msg(etag)
+        
+        return changes_msg(client.get_configuration_changes(cursor, inline_max), etag)
+
+def tree(request):
+    '''
+    Return nodes of the client's hash tree, those at each `prefix` given or
+    the root. Agents compare them with their own tree and ask again for the
+    children whose hashes differ, one request per level.
+    '''
+    if request.method == 'GET':
+        api_key = request.GET.get('api_key', '')
+        if len(api_key) != 40:
+            return error_msg('Invalid `api_key`.')
+        
+        prefixes = request.GET.getlist('prefix') or ['']
+        for prefix in prefixes:
+            if not hash_tree.is_prefix(prefix):
+                return error_msg('Invalid `prefix` `{}`.'.format(prefix))
+        
         try:
             client = Client.get_by_api_key(api_key)
         except:
             return error_msg('Client for `api_key` doesn\'t exist.')
         
-        return poll_msg(client.get_managed_configuration())
+        # The manifest ETag stands for the root only. It is the one agents
+        # remember, and a 304 for any other prefix would vouch for whatever
+        # nodes the agent last saw there, however old.
+        etag = client.get_manifest_etag() if prefixes == [''] else None
+        if etag and etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return not_modified_msg(etag)
+        
+        details = {
+            'is_disabled': client.is_disabled,
+            'is_blacklisted': client.is_blacklisted,
+        }
+        if not (client.is_disabled or client.is_blacklisted):
+            # Read before the tree, the cursor is never ahead of it, so
+            # agents can ask `/clients/changes/` what changed after it.
+            details['cursor'] = client.get_latest_change_id() or 0
+            tree = client.get_hash_tree()
+            details['depth'] = tree.depth
+            details['nodes'] = [tree.get_node(prefix) for prefix in prefixes]
+        return tree_msg(details, etag)
 
 def fetch(request):
     if request.method == 'GET':
@@ -304,14 +701,68 @@ def fetch(request):
         except:
             return error_msg('Client for `api_key` doesn\'t exist.')
         
+        if request.GET.get('raw', ''):
+            try:
+                config = client.get_configuration(file_path)
+            except ConfigurationException as e:
+                return error_msg(str(e))
+            if config.is_disabled:
+                return error_msg('Configuration file `{}` is disabled.'.format(file_path))
+            return raw_content_msg(request, config, config.get_current_file())
+        
         try:
             return fetch_msg(client.fetch_configuration(file_path))
         except Exception as e:
             return error_msg('Could not fetch `{}`: {}'.format(file_path, str(e)))
 
 
+def blob(request, sha1_checksum, token=None):
+    '''
+    Return the content with sha1 `sha1_checksum`. The URL names the content,
+    so responses may be kept forever.
+    
+    With the `token` of the content, from the manifest entries of the files
+    that have it, the URL is shared by every host and needs no api key, so a
+    cache in front of the server can answer for it. Without, the content is
+    only returned if it is a revision of one of the client's enabled
+    configurations, whose api key is read from the `X-CMDB-Api-Key` header.
+    '''
+    if request.method == 'GET' and token is not None:
+        if not constant_time_compare(token, Blob.get_token(sha1_checksum)):
+            return error_msg('Remote file not found.', status=404)
+        
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        for etag in (get_blob_etag(sha1_checksum), get_blob_etag(sha1_checksum, 'gzip')):
+            if etag in if_none_match:
+                return blob_not_modified_msg(etag, is_shared=True)
+        
+        conf_file = ConfigurationFile.objects.filter(blob_id=sha1_checksum).first()
+        if conf_file is None:
+            return error_msg('Remote file not found.', status=404)
+        return blob_msg(request, conf_file, is_shared=True)
+    elif request.method == 'GET':
+        api_key = request.META.get('HTTP_X_CMDB_API_KEY', '') or request.GET.get('api_key', '')
+        if len(api_key) != 40:
+            return error_msg('Invalid `api_key`.')
+        
+        try:
+            client = Client.get_by_api_key(api_key)
+        except:
+            return error_msg('Client for `api_key` doesn\'t exist.')
+        
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        for etag in (get_blob_etag(sha1_checksum), get_blob_etag(sha1_checksum, 'gzip')):
+            if etag in if_none_match:
+                return blob_not_modified_msg(etag)
+        
+        conf_file = ConfigurationFile.objects.filter(
+            blob_id=sha1_checksum, configuration__client=client, configuration__is_disabled=False).first()
+        if conf_file is None:
+            return error_msg('Remote file not found.', status=404)
+        return blob_msg(request, conf_file)
+
 @csrf_exempt
-def push(request):
+def fetch_many(request):
     if request.method == 'POST':
         obj = json.loads(request.body.decode('UTF-8'))
         
@@ -323,38 +774,111 @@ def push(request):
         except:
             return error_msg('Client for `api_key` doesn\'t exist.')
         
-        # file_path
-        file_path = obj.get('file_path', None)
-        if file_path is None:
-            return error_msg('Invalid `file_path`.')
-        if len(file_path) == 0:
-            return error_msg('`file_path` cannot be an empty string.')
-        
-        # mtime
-        mtime = obj.get('mtime', None)
-        if mtime is None:
-            return error_msg('Invalid `mtime`.')
-        if not isinstance(mtime, int):
-            return error_msg('`mtime` must be an integer.')
-        
-        # sha1_checksum
-        sha1_checksum = obj.get('sha1_checksum', None)
-        if sha1_checksum is None:
-            return error_msg('Invalid `sha1_checksum`.')
-        
-        # content
-        content = obj.get('content', None)
-        if content is None:
-            return error_msg('Invalid `content`.')
-        
-        # is_case_sensitive
-        is_case_sensitive = obj.get('is_case_sensitive', None)
-        if is_case_sensitive is None:
-            return error_msg('Invalid `is_case_sensitive`.')
-        if not isinstance(is_case_sensitive, bool):
-            return error_msg('`case_sensitive` must be boolean.')
+        files = obj.get('files', None)
+        if not isinstance(files, list):
+            return error_msg('`files` must be a list of file paths or `{file_path, revision}` objects.')
+        
+        # With `inline`, only the content of small files is sent, like poll.
+        inline_max = obj.get('inline', None)
+        if inline_max is not None:
+            if not isinstance(inline_max, int) or inline_max < 0:
+                return error_msg('`inline` must be a non-negative integer.')
+            inline_max = min(inline_max, getattr(settings, 'CMDB_INLINE_MAX_SIZE', 64 * 1024))
+        
+        return fetch_many_msg(client.fetch_configurations(files, inline_max))
+    else:
+        return error_msg('Invalid method.')
+
+
+@csrf_exempt
+def push(request):
+    if request.method == 'POST':
+        upload = is_upload(request)
+        if upload:
+            obj = get_upload_metadata(request)
+        else:
+            obj = json.loads(request.body.decode('UTF-8'))
+        
+        api_key = obj.get('api_key', '')
+        if len(api_key) != 40:
+            return error_msg('Invalid `api_key`.')
+        try:
+            client = Client.get_by_api_key(api_key)
+        except:
+            return error_msg('Client for `api_key` doesn\'t exist.')
+        
+        if upload:
+            # Only read the body once the client is known, and refuse content
+            # that doesn't match its checksum before it gets near the database.
+            try:
+                obj['content'], sha1_checksum = read_upload(request)
+            except ConfigurationException as e:
+                return error_msg(str(e))
+            if sha1_checksum != obj.get('sha1_checksum'):
+                obj['content'].close()
+                return error_msg('Checksum mismatch for file `{}`, aborting.'.format(obj.get('file_path')))
+        
+        error = check_push_fields(obj)
+        if error is not None:
+            return error_msg(error)
+        file_path = obj.get('file_path')
         
         try:
             return fetch_msg(client.push_configuration(**obj))
         except Exception as e:
             return error_msg('Could not push `{}`: {}'.format(file_path, str(e)))
+        finally:
+            if upload:
+                obj['content'].close()
+
+
+@csrf_exempt
+def push_many(request):
+    if request.method == 'POST':
+        obj = json.loads(request.body.decode('UTF-8'))
+        
+        api_key = obj.get('api_key', '')
+        if len(api_key) != 40:
+            return error_msg('Invalid `api_key`.')
+        try:
+            client = Client.get_by_api_key(api_key)
+        except:
+            return error_msg('Client for `api_key` doesn\'t exist.')
+        
+        files = obj.get('files', None)
+        if not isinstance(files, list):
+            return error_msg('`files` must be a list of file objects.')
+        
+        # Files that fail validation get their error in place, the rest are
+        # pushed together.
+        results = [None] * len(files)
+        valid = []
+        for i, f in enumerate(files):
+            error = check_push_fields(f) if isinstance(f, dict) else 'Each file must be an object.'
+            if error is not None:
+                results[i] = {'error': error}
+                if isinstance(f, dict):
+                    results[i]['file_path'] = f.get('file_path')
+            else:
+                valid.append(i)
+        
+        try:
+            pushed = client.push_configurations([files[i] for i in valid])
+        except Exception as e:
+            return error_msg('Could not push files: {}'.format(str(e)))
+        for i, result in zip(valid, pushed):
+            results[i] = result
+        
+        return push_many_msg(results)
+    else:
+        return error_msg('Invalid method.')
+
+
+@staff_member_required
+def cache_stats(request):
+    # Caches are per process, so say which process answered.
+    return cache_stats_msg({
+        'pid': os.getpid(),
+        'clients': client_cache.stats(),
+        'content': content_cache.stats(),
+    })
@@ -40,6 +40,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'clients.middleware.GzipRequestMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -61,6 +62,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db', 'db.sqlite3'),
+        # Tests run against a file rather than SQLite's default in-memory
+        # database, so that separate connections share it, as the tests of
+        # concurrent writes need.
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
     }
 }
 
@@ -82,3 +89,62 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.7/howto/static-files/
 
 STATIC_URL = '/dev/jsawyer/cmdb/static/'
+
+
+# CMDB
+# Old revisions are stored as deltas, with a whole copy (keyframe) at least
+# every CMDB_DELTA_KEYFRAME_INTERVAL revisions.
+
+CMDB_DELTA_KEYFRAME_INTERVAL = 16
+
+# Codec new file content is stored with, 'raw' stores it uncompressed. gzip
+# content can be sent as is to agents that accept gzip.
+
+CMDB_BLOB_CODEC = 'gzip'
+
+# Largest file, in bytes, accepted by the raw and multipart upload paths of
+# push and add.
+
+CMDB_UPLOAD_MAX_SIZE = 64 * 1024 * 1024
+
+# Clients resolved from api keys are cached in each process, for up to
+# CMDB_CLIENT_CACHE_SIZE keys, and checked against a version kept in the
+# CMDB_MANIFEST_CACHE cache. Saving or deleting a client drops its version, so
+# with a shared cache such as memcached every process reloads it on its next
+# request. With a per-process cache, other processes pick the change up within
+# CMDB_CLIENT_CACHE_TTL seconds.
+
+CMDB_CLIENT_CACHE_SIZE = 10000
+CMDB_CLIENT_CACHE_TTL = 60
+
+# File content served by the fetch endpoints is cached in each process, up to
+# CMDB_CONTENT_CACHE_SIZE bytes. It is keyed by sha1, so it never goes stale.
+
+CMDB_CONTENT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Poll and changes responses include the content of files of up to the size
+# agents ask for with `inline`, capped at CMDB_INLINE_MAX_SIZE bytes.
+
+CMDB_INLINE_MAX_SIZE = 64 * 1024
+
+# Serialized poll manifests and status reports are cached in the
+# CMDB_MANIFEST_CACHE cache for up to CMDB_MANIFEST_CACHE_TIMEOUT seconds.
+# Entries are keyed by manifest tag, so they are correct with any backend; a
+# shared one such as memcached lets every mod_wsgi process use the same
+# entries instead of building its own:
+#     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#     'LOCATION': '127.0.0.1:11211',
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'manifests': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'cmdb-manifests',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+CMDB_MANIFEST_CACHE = 'manifests'
+CMDB_MANIFEST_CACHE_TIMEOUT = 3600
@@ -6,13 +6,24 @@ import lib.lib
 from lib.register import register, unregister
 from lib.status import info, status
 from lib.poll import sync
+from lib.daemon import daemon
 from lib.scheduled_task import install_scheduled_task, remove_scheduled_task
 from lib.file import add, remove, disable
 from lib.configuration import genconfig
+from lib.session import get_session
+from lib.local_index import get_index
 
 
 config = lib.lib.check_config(lib.lib.get_config('config'), sys.argv)
 
+# Every command sends its requests through the one session, so a whole run
+# reuses the same few connections.
+get_session(config)
+
+# Likewise the one index of local files, loaded before any worker threads
+# start.
+get_index(config)
+
 cmd_list = (
     ('register', '', 'Register this host with CMDB.'),
     ('unregister', '', 'Unregister this host with CMDB.'),
@@ -24,6 +35,7 @@ cmd_list = (
     ('remove', 'FILE', 'Remove a configuration FILE for this host.'),
     ('disable', 'FILE', 'Disable a configuration FILE for this host.'),
     ('sync', '[FILE]', 'Sync CMDB managed files. If FILE is specified, only sync that FILE.'),
+    ('daemon', '', 'Stay running, pushing local changes as they are made and polling CMDB.'),
     ('install_scheduled_task', '', 'Install the CMDB polling script as a scheduled task.'),
     ('remove_scheduled_task', '', 'Remove the CMDB polling script scheduled task.'),
 )
@@ -86,6 +98,8 @@ def main(args):
             status(less_args, config)
         elif arg1 == 'sync':
             sync(less_args, config)
+        elif arg1 == 'daemon':
+            daemon(less_args, config)
         elif arg1 == 'install_scheduled_task':
             install_scheduled_task(less_args, config)
         elif arg1 == 'remove_scheduled_task':
@@ -7,10 +7,10 @@ import json
 
 # 3rd Party
 from cryptography.fernet import Fernet
-import requests
 
 # Local
 import lib.lib as lib
+from lib.session import get_session
 
 # Local exceptions
 class ConfigError(Exception): pass
@@ -75,12 +75,9 @@ class Config(object):
             return self.local_config.get('content')
         with open(file_path, 'rb') as fh:
             buf = fh.read()
-        try:
-            buf.decode('UTF-8')
-            with open(file_path, 'r') as fh:
-                buf = fh.read()
-        except:
-            pass
+        text = lib.decode_text(buf)
+        if text is not None:
+            return text
         return buf
     
     def _get_remote_content(self, file_path=None):
@@ -140,7 +137,7 @@ class Config(object):
         path = '/clients/fetch/'
         url = lib.get_config_url(self.agent_config, path)
         api_key = lib.get_config_api_key(self.agent_config)
-        req = requests.get(url, params={'api_key': api_key, 'file_path': self.file_path})
+        req = get_session().get(url, params={'api_key': api_key, 'file_path': self.file_path})
         payload = lib.get_response_body(req)
         payload = json.loads(payload)
         
@@ -241,7 +238,7 @@ class Config(object):
         data = self.local_config.copy()
         data['api_key'] = lib.get_config_api_key(self.agent_config)
         
-        req = requests.post(url, data=json.dumps(data))
+        req = get_session().post(url, data=json.dumps(data))
         resp_body = lib.get_response_body(req)
         payload = json.loads(resp_body)
         lib.check_for_error(payload)
@@ -293,7 +290,7 @@ class BaseConfigFile(object):
         self.config_dict = None
 
         if isinstance(config_dict, dict):
-            self.config_dict = check_config(config_dict)
+            self.config_dict = lib.check_config(config_dict)
         try:
             self.stat = self.path.resolve().stat()
         except:
@@ -435,8 +432,9 @@ class BaseConfigFile(object):
 
 
 class LocalConfigFile(BaseConfigFile):
-    def __init__(self, file_path, config_dict=None, *args, **kwargs):
+    def __init__(self, file_path, config_dict=None, index=None, *args, **kwargs):
         self.config_file_type = 'local'
+        self.index = index
         super(LocalConfigFile, self).__init__(file_path, config_dict, *args, **kwargs)
     
     def read(self, binary=False):
@@ -444,27 +442,38 @@ class LocalConfigFile(BaseConfigFile):
             return None
         with open(str(self.path), 'rb') as fh:
             buf = fh.read()
-        try:
-            if binary == True:
-                raise Exception('Forcing binary mode.')
-            buf = buf.decode('UTF-8')
-            # buf had no problems decoding, let's flag this as non-binary and
-            # re-read the file in text mode to take care of line endings
-            # automagically.
-            with open(str(self.path), 'r') as fh:
-                buf = fh.read()
+        # Decode the bytes already read the way text mode would, taking care
+        # of line endings, rather than reading the file again.
+        text = None if binary == True else lib.decode_text(buf)
+        if text is not None:
+            buf = text
             self.config['is_binary'] = False
-        except:
+        else:
             self.config['is_binary'] = True
         self.config['is_encrypted'] = False
         self.config['is_case_sensitive'] = self.is_case_sensitive()
         self.config['is_disabled'] = False
         self.config['mtime'] = int(self.stat.st_mtime)
-        self.config['sha1_checksum'] = self.checksum()
         self.config['content'] = buf
         self.config['content_length'] = len(buf)
+        self.config['sha1_checksum'] = self.checksum()
         return buf
     
+    def read_index(self):
+        '''
+        Fill in everything but the content from the index, which only reads
+        the file if it changed since it was last hashed. The index is keyed by
+        the path the file is managed as, not the one it resolves to.
+        '''
+        entry = self.index.lookup(self.config.get('file_path'), self.stat)
+        self.config['is_binary'] = entry[4] is None
+        self.config['is_encrypted'] = False
+        self.config['is_case_sensitive'] = self.is_case_sensitive()
+        self.config['is_disabled'] = False
+        self.config['mtime'] = int(self.stat.st_mtime)
+        self.config['content_length'] = entry[0]
+        self.config['sha1_checksum'] = entry[3] if entry[4] is None else entry[4]
+    
     def is_case_sensitive(self):
         cs = True
         temp_handle, temp_path = tempfile.mkstemp()
@@ -482,7 +491,10 @@ class LocalConfigFile(BaseConfigFile):
                 self.is_file_not_found = False
             except:
                 self.is_file_not_found = True
-            self.read(self.binary_mode)
+            if self.index is not None and self.is_file_not_found == False and self.binary_mode == False:
+                self.read_index()
+            else:
+                self.read(self.binary_mode)
             self.is_resolved = True
             return self.is_resolved
         except:
@@ -497,7 +509,7 @@ class LocalConfigFile(BaseConfigFile):
         if self.is_encoded == False:
             self.config['content'] = base64.b64encode(self.config.get('content'))
             self.is_encoded = True
-        req = requests.post(url, params={'api_key': api_key, 'file_path': self.config.get('file_path')})
+        req = get_session().post(url, params={'api_key': api_key, 'file_path': self.config.get('file_path')})
         payload = get_response_body(req)
         payload = json.loads(payload)
 
@@ -509,12 +521,18 @@ class RemoteConfigFile(BaseConfigFile):
     
     def read(self, binary_mode=False):
         path = '/clients/fetch/'
-        url = get_config_url(self.config_dict, path)
-        api_key = get_config_api_key(self.config_dict)
-        req = requests.get(url, params={'api_key': api_key, 'file_path': self.config.get('file_path')})
-        payload = get_response_body(req)
+        url = lib.get_config_url(self.config_dict, path)
+        api_key = lib.get_config_api_key(self.config_dict)
+        req = get_session().get(url, params={'api_key': api_key, 'file_path': self.config.get('file_path')})
+        payload = lib.get_response_body(req)
         payload = json.loads(payload)
-        
+        return self.load(payload)
+    
+    def load(self, payload):
+        '''
+        Fill in this remote file from a fetch payload the caller already has,
+        e.g. one entry of a `/clients/fetch_many/` response.
+        '''
         if payload.get('error') is not None:
             self.is_file_not_found = True
             return None
@@ -526,10 +544,13 @@ class RemoteConfigFile(BaseConfigFile):
         self.config['mtime'] = payload.get('mtime', -1)
         self.config['sha1_checksum'] = payload.get('sha1_checksum')
         self.config['content'] = payload.get('content')
+        if payload.get('content_encoding') == 'base64':
+            self.config['content'] = base64.b64decode(payload.get('content'))
         self.config['content_length'] = payload.get('content_length')
         self.is_file_not_found = False
-
-        return payload.get('content')
+        self.is_resolved = True
+        
+        return self.config.get('content')
     
     def resolve(self):
         try:
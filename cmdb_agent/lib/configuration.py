@@ -51,6 +51,12 @@ PORT = {port}
 URI = '{uri}'
 API_KEY = '{api_key}'
 POLL_LOG_FILE = 'poll.log'
+INLINE_MAX_SIZE = 4096
+TIMEOUT = (10, 300)
+GZIP_REQUESTS = True
+SYNC_WORKERS = 8
+POLL_INTERVAL = 300
+PUSH_DELAY = 2
 ENCRYPTION_KEY = '{encryption_key}'
 
 # End config
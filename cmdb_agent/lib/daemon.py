@@ -0,0 +1,72 @@
+# System
+import time
+
+# 3rd Party
+import requests
+
+# Local
+import lib.lib
+from lib.lib import log
+from lib.poll import run_sync, sync_local_changes
+from lib.watch import get_watcher, InotifyWatcher
+
+
+def daemon(args, config):
+    '''
+    Stay resident, keeping managed files in sync as they change: local
+    changes are pushed `PUSH_DELAY` seconds after the last write to them, and
+    the server is polled every `POLL_INTERVAL` seconds. Files are watched
+    with inotify where available, and scanned every `SCAN_INTERVAL` seconds
+    otherwise.
+    '''
+    poll_interval = config.get('POLL_INTERVAL', 300)
+    push_delay = config.get('PUSH_DELAY', 2)
+    
+    watcher = get_watcher([], config.get('SCAN_INTERVAL', 10))
+    if isinstance(watcher, InotifyWatcher):
+        log('Daemon started, watching files with inotify.', name='DAEMON')
+    else:
+        log('Daemon started, scanning files every {} seconds.'.format(watcher.scan_interval), name='DAEMON')
+    
+    next_poll = time.time()
+    pending = {}
+    try:
+        while True:
+            now = time.time()
+            if now >= next_poll:
+                next_poll = now + poll_interval
+                daemon_step(run_sync, config)
+                watcher.set_paths(lib.lib.load_state(config).get('entries', {}).keys())
+            
+            # Push files once they have been left alone for `push_delay`
+            # seconds, so a burst of writes is pushed once.
+            due = [p for p, t in pending.items() if now - t >= push_delay]
+            if due:
+                for file_path in due:
+                    del pending[file_path]
+                daemon_step(sync_local_changes, config, due)
+            
+            timeout = next_poll - time.time()
+            if pending:
+                timeout = min(timeout, min(pending.values()) + push_delay - time.time())
+            for file_path in watcher.wait(timeout):
+                pending[file_path] = time.time()
+    except KeyboardInterrupt:
+        log('Daemon stopped.', name='DAEMON')
+    finally:
+        watcher.close()
+
+
+def daemon_step(func, config, *args):
+    '''
+    Run one sync or push, logging rather than raising any error, whether
+    talking to the server or reading files, so the daemon carries on and
+    tries again later.
+    '''
+    try:
+        return func(config, *args)
+    except requests.exceptions.RequestException as e:
+        log('Could not reach the server: {}'.format(str(e)), level='ERROR', name='DAEMON')
+    except Exception as e:
+        log('Sync failed: {}: {}'.format(type(e).__name__, str(e)), level='ERROR', name='DAEMON')
+    return None
@@ -5,11 +5,9 @@ from datetime import datetime
 from hashlib import sha1
 from pathlib import Path
 
-# 3rd Party
-import requests
-
 # Local
 import lib.lib
+from lib.session import get_session
 
 
 def add(args, config):
@@ -26,32 +24,21 @@ def add(args, config):
         print('Missing file `{}` on filesystem, cannot add to CMDB.'.format(file_path))
         sys.exit(1)
     
-    try:
-        buf = None
-        with open(file_path, 'r') as fh:
-            buf = fh.read()
-    except UnicodeDecodeError as e:
-        print('File `{}` is not a text file, aborting.'.format(file_path))
-        sys.exit(1)
-    
-    try:
-        buf.encode('UTF-8')
-    except:
-        print('File `{}` is not a text file, aborting.'.format(file_path))
-        sys.exit(1)
-    
-    data = {
+    # Upload the file as is, text or binary, streaming it from disk.
+    body, sha1_checksum, is_binary = lib.lib.get_upload_body(file_path)
+    params = {
         'api_key': api_key,
         'type': 'configuration',
-        'configuration': {
-            'file_path': file_path,
-            'case_sensitive': lib.lib.is_case_sensitive(),
-            'mtime': int(st.st_mtime),
-            'payload': buf,
-        }
+        'file_path': file_path,
+        'is_case_sensitive': lib.lib.is_case_sensitive(),
+        'is_binary': is_binary,
+        'mtime': int(st.st_mtime),
+        'sha1_checksum': sha1_checksum,
     }
     
-    req = requests.post(url, data=json.dumps(data))
+    with body:
+        req = get_session().post(url, params=params, data=body,
+                            headers={'Content-Type': 'application/octet-stream'})
     resp_body = lib.lib.get_response_body(req)
     obj = json.loads(resp_body)
     lib.lib.check_for_error(obj)
@@ -98,7 +85,7 @@ def remove(args, config):
         }
     }
     
-    req = requests.post(url, data=json.dumps(data))
+    req = get_session().post(url, data=json.dumps(data))
     resp_body = lib.lib.get_response_body(req)
     obj = json.loads(resp_body)
     lib.lib.check_for_error(obj)
@@ -0,0 +1,126 @@
+# System
+from hashlib import sha1
+
+
+# Entries are bucketed DEPTH hex digits deep, 65536 buckets, enough to keep
+# buckets small for hosts tracking hundreds of thousands of files.
+DEPTH = 4
+
+# Nodes holding up to LEAF_SIZE entries are sent with their entries rather
+# than their children, which saves round-trips near the bottom of the tree.
+LEAF_SIZE = 64
+
+HEX_DIGITS = '0123456789abcdef'
+
+
+def get_bucket(file_path, depth=DEPTH):
+    return sha1(file_path.encode('UTF-8')).hexdigest()[:depth]
+
+def is_prefix(prefix, depth=DEPTH):
+    return len(prefix) <= depth and all(c in HEX_DIGITS for c in prefix)
+
+
+class HashTree(object):
+    '''
+    A hash tree over (file_path, sha1_checksum, revision) entries.
+    
+    Entries are bucketed by the prefix of the sha1 of their path, so the
+    server and an agent put a path in the same bucket whatever else either of
+    them tracks, and the tree is balanced however the files are laid out on
+    disk. A bucket's hash covers its entries and every other node's hash
+    covers its non-empty children, so two trees can only differ below nodes
+    whose hashes differ. Empty nodes have no hash.
+    '''
+    def __init__(self, entries, depth=DEPTH):
+        self.depth = depth
+        self.buckets = {}
+        for file_path, sha1_checksum, revision in entries:
+            self.buckets.setdefault(get_bucket(file_path, depth), []).append(
+                (file_path, sha1_checksum, revision))
+        
+        self.hashes = {}
+        self.counts = {}
+        level = {}
+        for prefix, bucket in self.buckets.items():
+            bucket.sort()
+            h = sha1()
+            for entry in bucket:
+                h.update('{}\0{}\0{}\n'.format(*entry).encode('UTF-8'))
+            level[prefix] = h.hexdigest()
+            self.counts[prefix] = len(bucket)
+        self.hashes.update(level)
+        for _ in range(depth):
+            children = {}
+            for prefix in sorted(level):
+                children.setdefault(prefix[:-1], []).append(prefix[-1] + level[prefix])
+                self.counts[prefix[:-1]] = self.counts.get(prefix[:-1], 0) + self.counts[prefix]
+            level = dict((prefix, sha1(''.join(c).encode('ascii')).hexdigest()) for prefix, c in children.items())
+            self.hashes.update(level)
+    
+    def __len__(self):
+        return self.counts.get('', 0)
+    
+    @property
+    def root(self):
+        return self.hashes.get('', None)
+    
+    def get_hash(self, prefix):
+        return self.hashes.get(prefix, None)
+    
+    def get_children(self, prefix):
+        if len(prefix) >= self.depth:
+            return {}
+        return dict((c, self.hashes[prefix + c]) for c in HEX_DIGITS if prefix + c in self.hashes)
+    
+    def get_entries(self, prefix):
+        '''
+        Return the entries below `prefix`, sorted by bucket then path.
+        '''
+        if prefix not in self.hashes:
+            return []
+        if len(prefix) == self.depth:
+            return list(self.buckets[prefix])
+        entries = []
+        for c in HEX_DIGITS:
+            entries.extend(self.get_entries(prefix + c))
+        return entries
+    
+    def get_node(self, prefix, leaf_size=LEAF_SIZE):
+        '''
+        Return the node at `prefix` as sent to agents: its hash and either its
+        children's hashes or, for buckets and nodes of up to `leaf_size`
+        entries, its entries.
+        '''
+        node = {'prefix': prefix, 'hash': self.get_hash(prefix)}
+        if len(prefix) == self.depth or self.counts.get(prefix, 0) <= leaf_size:
+            node['entries'] = [list(entry) for entry in self.get_entries(prefix)]
+        else:
+            node['children'] = self.get_children(prefix)
+        return node
+    
+    def diff(self, node):
+        '''
+        Compare this tree with `node` of another tree. Returns the prefixes of
+        the children worth descending into, the other tree's entries that
+        differ from this one's, and the paths below the node only this tree
+        has.
+        '''
+        prefix = node.get('prefix')
+        if node.get('hash') == self.get_hash(prefix):
+            return [], [], []
+        if 'entries' in node:
+            mine = dict((e[0], tuple(e)) for e in self.get_entries(prefix))
+            theirs = [tuple(e) for e in node.get('entries')]
+            changed = [e for e in theirs if mine.get(e[0]) != e]
+            paths = set(e[0] for e in theirs)
+            return [], changed, sorted(p for p in mine if p not in paths)
+        descend = []
+        only_mine = []
+        children = node.get('children', {})
+        for c in HEX_DIGITS:
+            if c in children:
+                if children[c] != self.get_hash(prefix + c):
+                    descend.append(prefix + c)
+            elif prefix + c in self.hashes:
+                only_mine.extend(e[0] for e in self.get_entries(prefix + c))
+        return descend, [], sorted(only_mine)
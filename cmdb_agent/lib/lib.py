@@ -4,7 +4,10 @@ from pathlib import Path
 from hashlib import sha1
 from datetime import datetime
 import base64
+import codecs
+import io
 import json
+import threading
 
 # 3rd Party
 from cryptography.fernet import Fernet
@@ -103,13 +106,23 @@ def get_config_uri(config):
         uri=config.get('URI'))
 
 def get_response_body(request):
+    '''
+    Return the body of `request` as JSON text. An error response that isn't
+    a JSON error is saved to `err_file` and reported as one, so callers can
+    always `json.loads` the result and check it for an error.
+    '''
     err_file = r'c:\cmdb_error.html'
-    resp_body = request.content.decode('UTF-8')
+    resp_body = request.content.decode('UTF-8', 'replace')
     if request.status_code != 200:
+        try:
+            if 'error' in json.loads(resp_body):
+                return resp_body
+        except (ValueError, TypeError):
+            pass
         with open(err_file, 'w') as fh:
             fh.write(resp_body)
         print('There was an error, check `{}`.'.format(err_file))
-        return {'error': 'There was an error, check `{}`.'.format(err_file)}
+        return json.dumps({'error': 'The server responded {}, check `{}`.'.format(request.status_code, err_file)})
         #sys.exit(1)
     return resp_body
 
@@ -136,6 +149,107 @@ def check_for_error(dictionary):
         return
         #sys.exit(1)
 
+def file_checksum(file_path, chunk_size=64 * 1024):
+    '''
+    Return the sha1 of a file's bytes, reading it a chunk at a time.
+    '''
+    h = sha1()
+    with open(file_path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_checksums(file_path, chunk_size=64 * 1024):
+    '''
+    Return `(sha1_checksum, text_sha1_checksum)` of a file in one read: the
+    sha1 of its bytes, and the sha1 of its content as read in text mode, with
+    '\n' line endings, or None if it isn't UTF-8 text.
+    '''
+    h = sha1()
+    text_h = sha1()
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('UTF-8')(), translate=True)
+    with open(file_path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            h.update(chunk)
+            if text_h is not None:
+                try:
+                    text_h.update(decoder.decode(chunk).encode('UTF-8'))
+                except UnicodeDecodeError:
+                    text_h = None
+    if text_h is not None:
+        try:
+            text_h.update(decoder.decode(b'', final=True).encode('UTF-8'))
+        except UnicodeDecodeError:
+            text_h = None
+    return h.hexdigest(), text_h.hexdigest() if text_h is not None else None
+
+def decode_text(buf):
+    '''
+    Return `buf` decoded as it would be read from a file in text mode, or
+    None if it isn't UTF-8 text.
+    '''
+    try:
+        return io.TextIOWrapper(io.BytesIO(buf), encoding='UTF-8').read()
+    except UnicodeDecodeError:
+        return None
+
+class TextUploadBody(object):
+    '''
+    A UTF-8 text file as it is uploaded: read a chunk at a time, with its
+    line endings translated to '\n' as text mode would, whatever the OS.
+    Raises UnicodeDecodeError from `read` if the file isn't UTF-8 text. Its
+    length, which requests sends as the Content-Length, is `size`, once
+    known.
+    '''
+    def __init__(self, file_path, size=None, chunk_size=64 * 1024):
+        self.fh = open(file_path, 'rb')
+        self.size = size
+        self.chunk_size = chunk_size
+        self.decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('UTF-8')(), translate=True)
+        self.buf = b''
+        self.is_eof = False
+    
+    def __len__(self):
+        return self.size
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def read(self, size=-1):
+        while not self.is_eof and (size is None or size < 0 or len(self.buf) < size):
+            chunk = self.fh.read(self.chunk_size)
+            self.is_eof = not chunk
+            self.buf += self.decoder.decode(chunk, final=self.is_eof).encode('UTF-8')
+        if size is None or size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+    
+    def close(self):
+        self.fh.close()
+
+def get_upload_body(file_path, chunk_size=64 * 1024):
+    '''
+    Return `(body, sha1_checksum, is_binary)` for uploading a file: a file
+    object to stream the content from, the sha1 of that content and whether
+    it isn't UTF-8 text. Text files are stored with '\n' line endings on
+    every OS, so their content is that of a `TextUploadBody` and their sha1
+    the text sha1 the index keeps. Binary files are uploaded as they are.
+    '''
+    h = sha1()
+    size = 0
+    try:
+        with TextUploadBody(file_path, chunk_size=chunk_size) as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b''):
+                h.update(chunk)
+                size += len(chunk)
+    except UnicodeDecodeError:
+        return open(file_path, 'rb'), file_checksum(file_path, chunk_size), True
+    return TextUploadBody(file_path, size, chunk_size), h.hexdigest(), False
+
 def is_case_sensitive():
     cs = True
     temp_handle, temp_path = tempfile.mkstemp()
@@ -145,7 +259,7 @@ def is_case_sensitive():
     os.unlink(temp_path)
     return cs
 
-def check_local_file(config):
+def check_local_file(config, index=None):
     '''
     input:
     
@@ -192,6 +306,10 @@ def check_local_file(config):
     Where file is the remote file name
     
     Where # is the revision of the remote file
+    
+    Given the agent's `LocalIndex` as `index`, the checksum of a file that
+    hasn't changed since it was last hashed comes from the index instead of
+    reading the file.
     '''
     line = ''
     
@@ -209,9 +327,15 @@ def check_local_file(config):
         mtime = 0
     
     try:
-        with open(file_path, 'r') as fh:
-            buf = fh.read()
-        sha1_checksum = sha1(buf.encode('UTF-8')).hexdigest()
+        if index is not None:
+            # The index is keyed by the managed path, like the sync state.
+            sha1_checksum = index.checksum(config.get('file_path'), config.get('is_binary') == True)
+        elif config.get('is_binary') == True:
+            sha1_checksum = file_checksum(file_path)
+        else:
+            with open(file_path, 'r') as fh:
+                buf = fh.read()
+            sha1_checksum = sha1(buf.encode('UTF-8')).hexdigest()
         if sha1_checksum == config.get('sha1_checksum'):
             checksums_match = True
         else:
@@ -273,7 +397,66 @@ def check_local_file(config):
 def get_config_log_file_path(config):
     return os.path.join(config.get('AGENT_ROOT_DIR'), config.get('POLL_LOG_FILE'))
 
+def get_config_state_file_path(config):
+    return os.path.join(config.get('AGENT_ROOT_DIR'), config.get('STATE_FILE', 'agent_state.json'))
+
+def get_config_index_file_path(config):
+    return os.path.join(config.get('AGENT_ROOT_DIR'), config.get('INDEX_FILE', 'agent_index.json'))
+
+def load_state(config):
+    '''
+    Return the agent state saved by the last sync (manifest ETag, etc.), or
+    an empty dict if there is none or it can't be read.
+    '''
+    try:
+        with open(get_config_state_file_path(config), 'r') as fh:
+            state = json.load(fh)
+        if isinstance(state, dict):
+            return state
+    except:
+        pass
+    return {}
+
+def save_state(config, state):
+    state_file_path = get_config_state_file_path(config)
+    temp_path = '{}.tmp'.format(state_file_path)
+    with open(temp_path, 'w') as fh:
+        json.dump(state, fh)
+    os.replace(temp_path, state_file_path)
+
+# Output of the calls running under `capture` on each thread.
+_captured = threading.local()
+
+def capture(func, *args, **kwargs):
+    '''
+    Call `func`, collecting what it logs and echoes on this thread instead of
+    writing it out, so work done in parallel can be reported in order with
+    `replay`. Returns the collected output and what `func` returned.
+    '''
+    _captured.output = []
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        output = _captured.output
+        _captured.output = None
+    return output, result
+
+def replay(output):
+    for func, args in output:
+        func(*args)
+
+def echo(msg):
+    output = getattr(_captured, 'output', None)
+    if output is not None:
+        output.append((echo, (msg,)))
+        return
+    print(msg)
+
 def log(msg, level='INFO', stdout=True, name='SYNC'):
+    output = getattr(_captured, 'output', None)
+    if output is not None:
+        output.append((log, (msg, level, stdout, name)))
+        return
     log_file_path = get_config_log_file_path(get_config('config'))
     now = datetime.now().isoformat(' ')
     
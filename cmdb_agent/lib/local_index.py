@@ -0,0 +1,117 @@
+# System
+import os
+import json
+import threading
+import time
+
+# Local
+import lib.lib
+
+
+# Files modified this recently are hashed but not indexed: a change made
+# within the timestamp granularity of the filesystem could leave their stat
+# data as it is, as git's index calls racily clean.
+RACY_SECONDS = 2
+
+
+class LocalIndex(object):
+    '''
+    What the agent knows about each tracked file on disk, like git's index:
+    the size, mtime_ns and inode it had when it was last hashed, its sha1 and
+    the revision it was last synced at.
+    
+    A file whose stat data is unchanged is taken to be unchanged, so its
+    checksums come from the index without reading it. Each entry keeps the
+    sha1 of the file's bytes and, for UTF-8 text, of its content as read in
+    text mode, since the agent compares text files by the latter.
+    '''
+    def __init__(self, index_file_path=None):
+        self.index_file_path = index_file_path
+        self.entries = {}
+        self.is_changed = False
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def load(cls, config):
+        '''
+        Return the index saved by the last run, or an empty one if there is
+        none or it can't be read.
+        '''
+        index = cls(lib.lib.get_config_index_file_path(config))
+        try:
+            with open(index.index_file_path, 'r') as fh:
+                data = json.load(fh)
+            if isinstance(data, dict) and data.get('version') == 1:
+                index.entries = dict((p, list(e)) for p, e in data.get('entries', {}).items())
+        except:
+            pass
+        return index
+    
+    def save(self):
+        if not self.is_changed or self.index_file_path is None:
+            return
+        with self._lock:
+            data = {'version': 1, 'entries': dict(self.entries)}
+            self.is_changed = False
+        temp_path = '{}.tmp'.format(self.index_file_path)
+        with open(temp_path, 'w') as fh:
+            json.dump(data, fh)
+        os.replace(temp_path, self.index_file_path)
+    
+    def lookup(self, file_path, st=None):
+        '''
+        Return the entry of `file_path`, `[size, mtime_ns, inode, sha1,
+        text_sha1, revision]`, hashing the file only if its stat data changed
+        since it was indexed. Raises `OSError` if the file can't be read.
+        '''
+        if st is None:
+            st = os.stat(file_path)
+        with self._lock:
+            entry = self.entries.get(file_path, None)
+        if entry is not None and entry[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+            return entry
+        
+        sha1_checksum, text_sha1_checksum = lib.lib.file_checksums(file_path)
+        revision = entry[5] if entry is not None else None
+        entry = [st.st_size, st.st_mtime_ns, st.st_ino, sha1_checksum, text_sha1_checksum, revision]
+        if st.st_mtime_ns < (time.time() - RACY_SECONDS) * 1e9:
+            with self._lock:
+                self.entries[file_path] = entry
+                self.is_changed = True
+        return entry
+    
+    def checksum(self, file_path, is_binary):
+        '''
+        Return the sha1 the agent compares `file_path` by: of its bytes for
+        binary files, of its text otherwise, None if it isn't text.
+        '''
+        entry = self.lookup(file_path)
+        return entry[3] if is_binary else entry[4]
+    
+    def set_revision(self, file_path, revision):
+        with self._lock:
+            entry = self.entries.get(file_path, None)
+            if entry is not None and entry[5] != revision:
+                entry[5] = revision
+                self.is_changed = True
+    
+    def discard(self, file_path):
+        with self._lock:
+            if self.entries.pop(file_path, None) is not None:
+                self.is_changed = True
+
+
+_index = None
+
+def get_index(config=None):
+    '''
+    Return the index shared by the whole agent run, loading it with `config`,
+    or the agent config file, on first use. The first call must come from the
+    main thread, before any worker pool uses the index.
+    '''
+    global _index
+    if _index is None:
+        if config is None:
+            config = lib.lib.get_config('config')
+        _index = LocalIndex.load(config)
+    return _index
@@ -1,7 +1,9 @@
 # System
 import os, sys, socket, json, tempfile
+import base64
 from hashlib import sha1
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # 3rd Party
 import requests
@@ -10,85 +12,527 @@ import requests
 import lib.lib
 from lib.lib import log
 from lib.lib import get_input
+from lib.config_file import LocalConfigFile, RemoteConfigFile
+from lib.hash_tree import HashTree
+from lib.local_index import get_index
+from lib.session import get_session
 
 
 def sync(args, config):
-    path = '/clients/poll/'
-    url = lib.lib.get_config_url(config, path)
+    sys.exit(run_sync(config))
+
+
+def run_sync(config):
+    '''
+    Sync every managed file with the server once. Returns the exit status of
+    the `sync` command: 0, or 1 if this host has been disabled or a file
+    couldn't be synced.
+    '''
     api_key = lib.lib.get_config_api_key(config)
-    req = requests.get(url, params={'api_key': api_key})
-    payload = lib.lib.get_response_body(req)
-    payload = json.loads(payload)
-    lib.lib.check_for_error(payload)
+    state = lib.lib.load_state(config)
+    # Load the index here rather than from the first worker thread to use it.
+    get_index(config)
+    # The changes since the saved cursor come in one request, and the server
+    # keeps each file's latest change, so the cursor never misses one.
+    # Walking the hash tree, which also returns a cursor, is the fallback for
+    # when it can't be used: the state of an agent from before cursors, or a
+    # cursor the server hasn't reached, as after its database was restored
+    # from a backup.
+    cursor = state.get('cursor', 0)
+    if state.get('entries') is not None and not cursor:
+        req, payload = get_tree_changes(config, api_key, state)
+    else:
+        req, payload = get_changes(config, api_key, state)
+        if payload.get('cursor', cursor) < cursor and state.get('entries') is not None:
+            log('The server\'s change log is behind the last sync, walking the hash tree...')
+            cursor = payload.get('cursor')
+            req, payload = get_tree_changes(config, api_key, state)
+            payload.setdefault('cursor', cursor)
+    
+    # The path, sha1 and revision of every file as of its last sync, which
+    # the agent's hash tree is built from.
+    synced = state.setdefault('entries', {})
     
     if payload.get('is_disabled', False) or payload.get('is_blacklisted', False):
         log('Exiting: this host has been disabled.')
-        sys.exit(1)
+        return 1
+    if 'error' in payload:
+        log('Exiting: the server could not list the configurations.')
+        return 1
     
-    conf_count = payload.get('configuration_count', 0)
+    configs = payload.get('configurations', [])
     
-    if conf_count == 0:
-        log('Exiting: there are no configurations to update.')
-        sys.exit(0)
+    for file_path in payload.get('removed', []):
+        log('      R    `- {} is no longer managed, ignoring...'.format(file_path))
+        synced.pop(file_path, None)
+        get_index().discard(file_path)
     
-    configs = payload.get('configurations', [])
+    # Files the server didn't report, even with a 304, may still have been
+    # edited here.
+    handled = set(c.get('file_path') for c in configs) | set(payload.get('missing', []))
+    configs = configs + get_local_changes(config, api_key, synced, [p for p in synced if p not in handled])
     
-    if len(configs) != conf_count:
-        log('Exiting: configuration count does not match the number of returned configurations.')
-        sys.exit(1)
-    
-    for configuration in configs:
-        file_path = configuration.get('file_path')
-        remote_file = lib.lib.RemoteConfigFile(file_path, config)
-        remote_file.resolve()
-        local_file = lib.lib.LocalConfigFile(file_path, config)
-        local_file.resolve()
-        print('Remote config: {}'.format(remote_file.config))
-        print('Local config: {}'.format(local_file.config))
-        log(lib.lib.check_local_file(configuration))
+    if len(configs) == 0:
+        if req.status_code == 304:
+            log('Exiting: configurations have not changed since the last sync.')
+            return 0
+        if payload.get('is_full', False):
+            log('Exiting: there are no configurations to update.')
+        else:
+            log('Exiting: no configurations have changed since the last sync.')
+        save_sync_state(config, state, req, payload)
+        return 0
+    
+    failed, is_pushed = sync_files(config, api_key, synced, configs)
+    failed.extend(payload.get('missing', []))
+    
+    # Only remember the cursor and ETag once every file has been fetched,
+    # otherwise the next poll would be told nothing changed and the files
+    # that failed would never be fetched. Failed pushes needn't hold them
+    # back, local changes are found again by the next sync.
+    if failed:
+        log('Exiting: {} file(s) could not be synced and will be retried.'.format(len(failed)))
+        get_index().save()
+        lib.lib.save_state(config, state)
+        return 1
+    save_sync_state(config, state, req, payload)
+    return 0 if is_pushed else 1
+
+
+def sync_files(config, api_key, synced, configs):
+    '''
+    Bring the files of the manifest entries `configs` in line with the
+    server, recording those synced in `synced`. Returns the paths of the
+    files that couldn't be synced and whether every push went through.
+    '''
+    # Local files are read and hashed in one pool while transfers run in
+    # another, SYNC_WORKERS at a time, so a sync takes about as long as its
+    # slowest transfers. What each file reports is logged in manifest order.
+    to_push = []
+    failed = []
+    is_pushed = True
+    hash_workers = config.get('HASH_WORKERS', os.cpu_count() or 1)
+    with ThreadPoolExecutor(hash_workers) as hash_pool, ThreadPoolExecutor(config.get('SYNC_WORKERS', 8)) as pool:
+        futures = []
+        for configuration in configs:
+            local_future = None
+            if configuration.get('is_disabled') != True:
+                local_future = hash_pool.submit(resolve_local_file, configuration.get('file_path'), config)
+            futures.append(pool.submit(lib.lib.capture, try_sync_file, config, api_key, configuration, local_future))
         
-        if remote_file.config.get('is_disabled') == True:
-            #if configuration.get('is_disabled', True):
-            log('      D    `- {} is disabled, skipping...'.format(configuration.get('file_path')))
+        for configuration, future in zip(configs, futures):
+            output, (outcome, details) = future.result()
+            lib.lib.replay(output)
+            if outcome == 'synced':
+                record_synced(synced, details)
+            elif outcome == 'pushed':
+                is_pushed = record_synced(synced, details) and is_pushed
+            elif outcome == 'disabled':
+                synced.pop(configuration.get('file_path'), None)
+            elif outcome == 'push':
+                to_push.append(configuration.get('file_path'))
+            else:
+                failed.append(configuration.get('file_path'))
+    
+    is_pushed = push_text_files(config, api_key, synced, to_push) and is_pushed
+    return failed, is_pushed
+
+
+def push_text_files(config, api_key, synced, file_paths):
+    '''
+    Send every newer local text file in one request. Returns False if any of
+    them couldn't be pushed.
+    '''
+    if len(file_paths) > 1:
+        push_many_url = lib.lib.get_config_url(config, '/clients/push_many/')
+        results = push_many(push_many_url, api_key, file_paths)
+        recorded = [record_synced(synced, result) for result in results]
+        return len(results) == len(file_paths) and all(recorded)
+    elif len(file_paths) == 1:
+        push_url = lib.lib.get_config_url(config, '/clients/push/')
+        return record_synced(synced, push(push_url, api_key, file_paths[0]))
+    return True
+
+
+def get_local_changes(config, api_key, synced, file_paths):
+    '''
+    Return the manifest entries of those of `file_paths` whose content
+    differs from what they were last synced at, so they are compared with the
+    server like the files it reported: pushed if they are newer and fetched
+    again if they are older or were removed. Checksums come from the index,
+    so only files whose stat data changed are read.
+    '''
+    index = get_index()
+    changed = []
+    for file_path in sorted(file_paths):
+        if file_path not in synced:
             continue
-        
-        if local_file.is_file_not_found == True:
-            log('      E    `- {} could not be found, fetching...'.format(file_path))
-        if local_file < remote_file:
-            log('      F    `- {} is older than the server, fetching...'.format(file_path))
-            fetch_url = lib.lib.get_config_url(config, '/clients/fetch/')
-            fetch(fetch_url, api_key, file_path, configuration.get('mtime', 0))
-        elif local_file == remote_file:
+        try:
+            entry = index.lookup(file_path)
+        except OSError:
+            changed.append(file_path)
+            continue
+        # Text files reach the server as their bytes or as their text,
+        # either sha1 is the one they were synced at.
+        if synced[file_path][0] not in (entry[3], entry[4]):
+            changed.append(file_path)
+    if not changed:
+        return []
+    fetch_many_url = lib.lib.get_config_url(config, '/clients/fetch_many/')
+    payloads = fetch_many(fetch_many_url, api_key, changed, inline=config.get('INLINE_MAX_SIZE', 4096))
+    return [payloads.get(p) for p in changed if p in payloads]
+
+
+def sync_local_changes(config, file_paths):
+    '''
+    Sync those of `file_paths` that changed on disk since they were last
+    synced, without polling the server first. Returns the paths that
+    couldn't be synced.
+    '''
+    api_key = lib.lib.get_config_api_key(config)
+    state = lib.lib.load_state(config)
+    get_index(config)
+    synced = state.setdefault('entries', {})
+    configs = get_local_changes(config, api_key, synced, file_paths)
+    if not configs:
+        return []
+    failed, is_pushed = sync_files(config, api_key, synced, configs)
+    get_index().save()
+    lib.lib.save_state(config, state)
+    return failed
+
+
+def resolve_local_file(file_path, config):
+    local_file = LocalConfigFile(file_path, config, index=get_index())
+    local_file.resolve()
+    return local_file
+
+
+def try_sync_file(config, api_key, configuration, local_future):
+    '''
+    Run `sync_file`, logging what it raises with the rest of the file's
+    output and counting the file as failed, so a file that can't be read or
+    written doesn't stop the others from being synced.
+    '''
+    try:
+        return sync_file(config, api_key, configuration, local_future)
+    except Exception as e:
+        log('      E    `- {} could not be synced: {}: {}'.format(
+            configuration.get('file_path'), type(e).__name__, str(e)), level='ERROR')
+        return None, None
+
+
+def sync_file(config, api_key, configuration, local_future):
+    '''
+    Bring one file in line with its manifest entry, given the future of its
+    resolved `LocalConfigFile`. Runs in a worker thread. Returns an outcome
+    and its details: ('synced', what to record), ('pushed', the push result),
+    ('disabled', None), ('push', None) for a text file to push with the
+    others, or (None, None) if the file couldn't be synced.
+    
+    The comparison only needs the sha1 and mtime of the manifest entry;
+    content is downloaded once, for files that differ, unless it came
+    inlined in the manifest.
+    '''
+    file_path = configuration.get('file_path')
+    # Wait for the file to be hashed, so the status line below takes its
+    # checksum from the index rather than hashing it a second time.
+    local_file = local_future.result() if local_future is not None else None
+    log(lib.lib.check_local_file(configuration, get_index()))
+    
+    if configuration.get('is_disabled') == True:
+        log('      D    `- {} is disabled, skipping...'.format(file_path))
+        return 'disabled', None
+    
+    remote_file = RemoteConfigFile(file_path, config)
+    remote_file.load(configuration)
+    
+    if local_file.is_file_not_found == True:
+        log('      E    `- {} could not be found, fetching...'.format(file_path))
+        if download(config, api_key, configuration):
+            return 'synced', configuration
+    elif local_file.checksum() == remote_file.checksum():
+        if local_file.config.get('mtime') == remote_file.config.get('mtime'):
             log('      I    `- {} is same age as the server, ignoring...'.format(file_path))
-        elif local_file > remote_file:
-            log('      P         `- {} is newer than the server, pushing...'.format(file_path))
-            push_url = fetch_url = lib.lib.get_config_url(config, '/clients/push/')
-            push(push_url, api_key, file_path)
+        else:
+            log('      T    `- {} is the same as on the server, setting its mtime...'.format(file_path))
+            os.utime(file_path, (configuration.get('mtime'), configuration.get('mtime')))
+        return 'synced', configuration
+    elif local_file < remote_file:
+        log('      F    `- {} is older than the server, fetching...'.format(file_path))
+        if download(config, api_key, configuration):
+            return 'synced', configuration
+    elif local_file > remote_file:
+        log('      P         `- {} is newer than the server, pushing...'.format(file_path))
+        if local_file.is_binary() == True:
+            # Binary files can't go in a bulk JSON push, upload them.
+            return 'pushed', push(lib.lib.get_config_url(config, '/clients/push/'), api_key, file_path)
+        return 'push', None
+    else:
+        log('      E    `- {} differs from the server but is the same age, skipping...'.format(file_path))
+    return None, None
+
+
+def get_changes(config, api_key, state):
+    '''
+    Return the response of `/clients/changes/` and its payload, every file
+    on the first sync and those changed since the saved cursor after that.
+    '''
+    url = lib.lib.get_config_url(config, '/clients/changes/')
+    cursor = state.get('cursor', 0)
+    headers = {}
+    if state.get('manifest_etag'):
+        headers['If-None-Match'] = state.get('manifest_etag')
+    # Ask for small files to be sent with the manifest, so a typical sync
+    # needs no fetch requests at all.
+    params = {'api_key': api_key, 'cursor': cursor, 'inline': config.get('INLINE_MAX_SIZE', 4096)}
+    req = get_session().get(url, params=params, headers=headers)
+    if req.status_code == 304:
+        return req, {}
+    payload = json.loads(lib.lib.get_response_body(req))
+    lib.lib.check_for_error(payload)
+    return req, payload
 
-def fetch(url, api_key, file_path, mtime):
+
+def get_tree_changes(config, api_key, state, batch_size=256):
+    '''
+    Find the files that changed since the last sync by comparing the server's
+    hash tree with one built from the synced entries, asking only for the
+    children of nodes whose hashes differ. That is one request per level of
+    the tree, however many files there are.
+    
+    Returns the response for the root, whose ETag is the one to remember,
+    and a payload like the one of `/clients/changes/`, with the manifest
+    entries of the changed files as its configurations, those that couldn't
+    be fetched as `missing` and the cursor the root was sent with.
+    '''
+    url = lib.lib.get_config_url(config, '/clients/tree/')
+    entries = [(p, e[0], e[1]) for p, e in state.get('entries', {}).items()]
+    known = HashTree(entries)
+    headers = {}
+    if state.get('manifest_etag'):
+        headers['If-None-Match'] = state.get('manifest_etag')
+    
+    root_req = None
+    cursor = None
+    changed = []
+    removed = []
+    prefixes = ['']
+    while prefixes:
+        nodes = []
+        for start in range(0, len(prefixes), batch_size):
+            params = {'api_key': api_key, 'prefix': prefixes[start:start + batch_size]}
+            req = get_session().get(url, params=params, headers=headers)
+            if root_req is None:
+                # The tree may change while it is walked; keeping the root's
+                # ETag makes the next sync walk it again if it did.
+                root_req = req
+                headers = {}
+                if req.status_code == 304:
+                    return req, {}
+            payload = json.loads(lib.lib.get_response_body(req))
+            lib.lib.check_for_error(payload)
+            if payload.get('is_disabled', False) or payload.get('is_blacklisted', False) or 'error' in payload:
+                return root_req, payload
+            if cursor is None:
+                cursor = payload.get('cursor')
+            if payload.get('depth') != known.depth:
+                known = HashTree(entries, payload.get('depth'))
+            nodes.extend(payload.get('nodes', []))
+        prefixes = []
+        for node in nodes:
+            descend, node_changed, node_removed = known.diff(node)
+            prefixes.extend(descend)
+            changed.extend(entry[0] for entry in node_changed)
+            removed.extend(node_removed)
+    
+    configurations = []
+    if changed:
+        fetch_many_url = lib.lib.get_config_url(config, '/clients/fetch_many/')
+        payloads = fetch_many(fetch_many_url, api_key, changed, inline=config.get('INLINE_MAX_SIZE', 4096))
+        configurations = [payloads.get(p) for p in changed if p in payloads]
+    missing = [p for p in changed if p not in set(c.get('file_path') for c in configurations)]
+    payload = {'configurations': configurations, 'removed': sorted(removed), 'is_full': False, 'missing': missing}
+    if cursor is not None:
+        payload['cursor'] = cursor
+    return root_req, payload
+
+
+def record_synced(synced, details):
+    '''
+    Remember the sha1 and revision a file was synced at from a manifest
+    entry, fetch payload or push result. Returns False if `details` is an
+    error or missing.
+    '''
+    if details and details.get('sha1_checksum') and 'error' not in details:
+        synced[details.get('file_path')] = [details.get('sha1_checksum'), details.get('revision')]
+        get_index().set_revision(details.get('file_path'), details.get('revision'))
+        return True
+    return False
+
+
+def save_sync_state(config, state, req, payload):
+    get_index().save()
+    state['manifest_etag'] = req.headers.get('ETag')
+    state['cursor'] = payload.get('cursor', state.get('cursor', 0))
+    lib.lib.save_state(config, state)
+
+def fetch(url, api_key, file_path, mtime, attempts=3, configuration=None):
+    '''
+    Download `file_path` from `url`, the raw fetch URL, or, given its
+    manifest entry as `configuration`, the blob URL of its content, which
+    needs no `api_key` if it carries the content's token.
+    '''
     #log('Fetch: {}, {}, {}, {}'.format(url, api_key, file_path, mtime))
     #log('Fetching `{}` from server...'.format(file_path))
-    req = requests.get(url, params={'api_key': api_key, 'file_path': file_path})
-    resp_body = lib.lib.get_response_body(req)
-    payload = json.loads(resp_body)
-    lib.lib.check_for_error(payload)
-    #log('Payload: {}'.format(payload))
-    with open(file_path, 'w') as fh:
-        fh.write(payload.get('content'))
+    
+    # Download the raw file into a part file next to it, resuming from where
+    # an interrupted transfer stopped, and only replace the file once the
+    # download is complete and its checksum matches.
+    if configuration is None:
+        params = {'api_key': api_key, 'file_path': file_path, 'raw': '1'}
+        auth_headers = {}
+    else:
+        # Blob URLs carry no api key, so they are shared by every host, and
+        # those with a token need none at all.
+        params = {}
+        auth_headers = {'X-CMDB-Api-Key': api_key} if api_key else {}
+    part_path = '{}.cmdb-part'.format(file_path)
+    etag = None
+    headers = {}
+    written = 0
+    
+    with open(part_path, 'wb') as fh:
+        for attempt in range(attempts):
+            range_headers = dict(auth_headers)
+            if written and etag:
+                range_headers.update({'Range': 'bytes={}-'.format(written), 'If-Range': etag})
+            try:
+                req = get_session().get(url, params=params, headers=range_headers, stream=True)
+                if req.headers.get('Content-Type', '').startswith('application/json'):
+                    payload = json.loads(lib.lib.get_response_body(req))
+                    lib.lib.check_for_error(payload)
+                    break
+                if req.status_code == 200:
+                    # Whole body, either a fresh download or the file changed
+                    # on the server since the interrupted one.
+                    fh.seek(0)
+                    fh.truncate()
+                    written = 0
+                elif req.status_code != 206:
+                    log('Fetch of `{}` failed with status {}.'.format(file_path, req.status_code))
+                    break
+                # requests decodes gzip responses, so `written` counts bytes
+                # of the content itself, which the identity ETag names.
+                headers = req.headers
+                if headers.get('X-CMDB-SHA1-Checksum'):
+                    etag = '"{}"'.format(headers.get('X-CMDB-SHA1-Checksum'))
+                for chunk in req.iter_content(64 * 1024):
+                    fh.write(chunk)
+                    written += len(chunk)
+                break
+            except requests.exceptions.RequestException as e:
+                log('Fetch of `{}` interrupted after {} bytes ({}), resuming...'.format(file_path, written, str(e)))
+    
+    sha1_checksum = headers.get('X-CMDB-SHA1-Checksum')
+    if sha1_checksum is None or lib.lib.file_checksum(part_path) != sha1_checksum:
+        log('Fetch of `{}` failed, the downloaded file is incomplete.'.format(file_path))
+        os.unlink(part_path)
+        return False
+    
+    if configuration is None:
+        configuration = {
+            'file_path': file_path,
+            'mtime': int(headers.get('X-CMDB-Mtime', mtime)),
+            'sha1_checksum': sha1_checksum,
+            'revision': int(headers.get('X-CMDB-Revision', -1)),
+            'is_disabled': False,
+            'is_binary': headers.get('X-CMDB-Is-Binary') == 'True',
+            'is_encrypted': headers.get('X-CMDB-Is-Encrypted') == 'True',
+        }
+    
+    if configuration.get('is_binary') != True and os.linesep != '\n':
+        # Text files are stored with '\n' line endings, write them out with
+        # the local ones as text mode always has.
+        with open(part_path, 'r', encoding='UTF-8', newline='') as fh:
+            buf = fh.read()
+        with open(part_path, 'w', encoding='UTF-8') as fh:
+            fh.write(buf)
+    os.replace(part_path, file_path)
     os.utime(file_path, (mtime, mtime))
     
-    print(lib.lib.check_local_file(payload))
+    lib.lib.echo(lib.lib.check_local_file(configuration, get_index()))
+    return True
 
 
-def push(url, api_key, file_path):
-    #log('Push: {}, {}, {}'.format(url, api_key, file_path))
-    #log('Pushing `{}` to server...'.format(file_path))
+def fetch_many(url, api_key, file_paths, inline=None):
+    '''
+    Fetch many files in one request. Returns a dict of fetch payloads keyed by
+    file path; files the server could not return are logged and left out.
+    With `inline`, the payloads are manifest entries carrying the content of
+    files of up to `inline` bytes only.
+    '''
+    data = {'api_key': api_key, 'files': file_paths}
+    if inline is not None:
+        data['inline'] = inline
+    req = get_session().post(url, data=json.dumps(data), stream=True)
+    if req.headers.get('Content-Type', '').startswith('application/json'):
+        # Errors about the request as a whole come back as a single document.
+        payload = json.loads(lib.lib.get_response_body(req))
+        lib.lib.check_for_error(payload)
+        return {}
+    payloads = {}
+    for line in req.iter_lines():
+        if not line:
+            continue
+        payload = json.loads(line.decode('UTF-8'))
+        if 'error' in payload:
+            log('Fetch error for `{}`: {}'.format(payload.get('file_path'), payload.get('error')))
+            continue
+        payloads[payload.get('file_path')] = payload
+    return payloads
+
+
+def download(config, api_key, configuration):
+    '''
+    Write out the file of manifest entry `configuration`, from the content
+    inlined in it or else from the blob URL of its content.
+    '''
+    file_path = configuration.get('file_path')
+    if 'content' in configuration:
+        write_local_file(file_path, configuration, configuration.get('mtime', 0))
+        return True
+    # Content addressed URLs are the same for every host, and content this
+    # host already has is answered with a 304. With the token of the content
+    # the URL needs no api key, so a shared cache in front of the server can
+    # answer for it.
+    sha1_checksum = configuration.get('sha1_checksum')
+    if configuration.get('blob_token'):
+        path = '/clients/blob/{}/{}/'.format(sha1_checksum, configuration.get('blob_token'))
+        return fetch(lib.lib.get_config_url(config, path), None, file_path, configuration.get('mtime', 0),
+                     configuration=configuration)
+    blob_url = lib.lib.get_config_url(config, '/clients/blob/{}/'.format(sha1_checksum))
+    return fetch(blob_url, api_key, file_path, configuration.get('mtime', 0), configuration=configuration)
+
+
+def write_local_file(file_path, payload, mtime):
+    if payload.get('content_encoding') == 'base64':
+        with open(file_path, 'wb') as fh:
+            fh.write(base64.b64decode(payload.get('content')))
+    else:
+        with open(file_path, 'w') as fh:
+            fh.write(payload.get('content'))
+    os.utime(file_path, (mtime, mtime))
     
+    lib.lib.echo(lib.lib.check_local_file(payload, get_index()))
+
+
+def get_push_data(file_path):
     try:
         mtime = os.stat(file_path).st_mtime
     except:
         log('Push abort, could not stat `{}`'.format(file_path))
-        return False
+        return None
     
     buf = ''
     with open(file_path, 'r') as fh:
@@ -96,19 +540,67 @@ def push(url, api_key, file_path):
     
     sha1_checksum = sha1(buf.encode('UTF-8')).hexdigest()
     
-    data = {
-        'api_key': api_key,
+    return {
         'file_path': file_path,
         'mtime': int(mtime),
         'content': buf,
         'sha1_checksum': sha1_checksum,
-        'case_sensitive': lib.lib.is_case_sensitive(),
+        'is_case_sensitive': lib.lib.is_case_sensitive(),
+        'is_binary': False,
+        'is_encrypted': False,
     }
+
+
+def push(url, api_key, file_path):
+    #log('Push: {}, {}, {}'.format(url, api_key, file_path))
+    #log('Pushing `{}` to server...'.format(file_path))
     
-    req = requests.post(url, data=json.dumps(data))
+    # Upload the file as is rather than inside a JSON document, so it is
+    # streamed from disk and binary files go through untouched.
+    try:
+        mtime = os.stat(file_path).st_mtime
+    except:
+        log('Push abort, could not stat `{}`'.format(file_path))
+        return False
+    body, sha1_checksum, is_binary = lib.lib.get_upload_body(file_path)
+    params = {
+        'api_key': api_key,
+        'file_path': file_path,
+        'mtime': int(mtime),
+        'sha1_checksum': sha1_checksum,
+        'is_case_sensitive': lib.lib.is_case_sensitive(),
+        'is_binary': is_binary,
+        'is_encrypted': False,
+    }
+    with body:
+        req = get_session().post(url, params=params, data=body,
+                            headers={'Content-Type': 'application/octet-stream'})
     resp_body = lib.lib.get_response_body(req)
     payload = json.loads(resp_body)
     lib.lib.check_for_error(payload)
     
     #log('Payload: {}'.format(json.dumps(payload, indent=4)))
-    print(lib.lib.check_local_file(payload))
+    lib.lib.echo(lib.lib.check_local_file(payload, get_index()))
+    return payload
+
+
+def push_many(url, api_key, file_paths):
+    files = []
+    for file_path in file_paths:
+        data = get_push_data(file_path)
+        if data is not None:
+            files.append(data)
+    if len(files) == 0:
+        return []
+    
+    req = get_session().post(url, data=json.dumps({'api_key': api_key, 'files': files}))
+    resp_body = lib.lib.get_response_body(req)
+    payload = json.loads(resp_body)
+    lib.lib.check_for_error(payload)
+    
+    for result in payload.get('results', []):
+        if 'error' in result:
+            log('Push error for `{}`: {}'.format(result.get('file_path'), result.get('error')))
+            continue
+        lib.lib.echo(lib.lib.check_local_file(result, get_index()))
+    return payload.get('results', [])
@@ -1,11 +1,9 @@
 # System
 import os, sys, socket, json
 
-# 3rd Party
-import requests
-
 # Local
 import lib.lib
+from lib.session import get_session
 
 
 def register(args, config):
@@ -13,7 +11,7 @@ def register(args, config):
     my_hostname = socket.getfqdn().lower()
     agent_root_dir = os.path.dirname(os.path.dirname(__file__))
     url = lib.lib.get_config_url(config, path)
-    req = requests.post(url, data=json.dumps({'fqdn': my_hostname}))
+    req = get_session().post(url, data=json.dumps({'fqdn': my_hostname}))
     resp_body = lib.lib.get_response_body(req)
     obj = json.loads(resp_body)
     lib.lib.check_for_error(obj)
@@ -31,7 +29,7 @@ def unregister(args, config):
     my_hostname = socket.getfqdn().lower()
     api_key = lib.lib.get_config_api_key(config)
     url = lib.lib.get_config_url(config, path)
-    req = requests.post(url, data=json.dumps({'api_key': api_key}))
+    req = get_session().post(url, data=json.dumps({'api_key': api_key}))
     resp_body = lib.lib.get_response_body(req)
     obj = json.loads(resp_body)
     lib.lib.check_for_error(obj)
@@ -0,0 +1,65 @@
+# System
+import gzip
+
+# 3rd Party
+import requests
+from requests.adapters import HTTPAdapter
+
+# Local
+import lib.lib
+
+
+class AgentSession(object):
+    '''
+    The HTTP client every agent command talks to the server through.
+    
+    Connections are kept alive and pooled, up to `POOL_SIZE` of them, so a
+    sync of many files reuses the same few connections. Every request gets
+    the `TIMEOUT` of the agent config, in seconds or as a (connect, read)
+    pair, unless it gives its own. With `GZIP_REQUESTS`, request bodies of
+    `GZIP_MIN_SIZE` bytes or more are sent gzip encoded.
+    '''
+    def __init__(self, config):
+        self.timeout = config.get('TIMEOUT', (10, 300))
+        self.gzip_requests = config.get('GZIP_REQUESTS', False)
+        self.gzip_min_size = config.get('GZIP_MIN_SIZE', 1024)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.get('POOL_SIZE', 8))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        data = kwargs.get('data', None)
+        if self.gzip_requests and isinstance(data, (str, bytes)) and len(data) >= self.gzip_min_size:
+            if isinstance(data, str):
+                data = data.encode('UTF-8')
+            kwargs['data'] = gzip.compress(data)
+            headers = dict(kwargs.get('headers', None) or {})
+            headers['Content-Encoding'] = 'gzip'
+            kwargs['headers'] = headers
+        return self.session.request(method, url, **kwargs)
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+    
+    def close(self):
+        self.session.close()
+
+
+_session = None
+
+def get_session(config=None):
+    '''
+    Return the session shared by the whole agent run, creating it from
+    `config`, or the agent config file, on first use.
+    '''
+    global _session
+    if _session is None:
+        if config is None:
+            config = lib.lib.get_config('config')
+        _session = AgentSession(config)
+    return _session
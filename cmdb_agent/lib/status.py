@@ -1,11 +1,10 @@
 # System
 import os, sys, socket, json
 
-# 3rd Party
-import requests
-
 # Local
 import lib.lib
+from lib.session import get_session
+from lib.local_index import get_index
 
 
 def info(args, config):
@@ -13,7 +12,7 @@ def info(args, config):
     uri = lib.lib.get_config_uri(config)
     url = lib.lib.get_config_url(config, path)
     api_key = lib.lib.get_config_api_key(config)
-    req = requests.get(url, params={'api_key': api_key})
+    req = get_session().get(url, params={'api_key': api_key})
     resp_body = lib.lib.get_response_body(req)
     obj = json.loads(resp_body)
     lib.lib.check_for_error(obj)
@@ -31,12 +30,15 @@ def status(args, config):
     path = '/clients/status/'
     url = lib.lib.get_config_url(config, path)
     api_key = lib.lib.get_config_api_key(config)
-    req = requests.get(url, params={'api_key': api_key})
+    req = get_session().get(url, params={'api_key': api_key})
     resp_body = lib.lib.get_response_body(req)
     obj = json.loads(resp_body)
     lib.lib.check_for_error(obj)
     
+    # Files unchanged since they were last hashed aren't read again.
+    index = get_index()
     for config in obj.get('configurations'):
-        print(lib.lib.check_local_file(config))
+        print(lib.lib.check_local_file(config, index))
+    index.save()
     
     #print('Response body: {}'.format(json.dumps(obj, indent=4)))
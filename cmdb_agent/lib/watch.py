@@ -0,0 +1,135 @@
+# System
+import os
+import sys
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+
+
+# inotify(7) event masks.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+# A file is changed once it is written and closed, or replaced by renaming
+# another over it as most editors do, or removed.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Watcher(object):
+    '''
+    Report which of a set of files changed, by stat()ing them all every
+    `scan_interval` seconds. Works everywhere; see `InotifyWatcher` for
+    Linux.
+    '''
+    def __init__(self, file_paths, scan_interval=10):
+        self.scan_interval = scan_interval
+        self.file_paths = set()
+        self.stats = {}
+        self.next_scan = time.time() + scan_interval
+        self.set_paths(file_paths)
+    
+    def set_paths(self, file_paths):
+        # Files already watched keep the stat data of the last scan, so they
+        # are still reported if they changed since.
+        self.file_paths = set(file_paths)
+        self.stats = dict((p, self.stats[p] if p in self.stats else self._stat(p)) for p in self.file_paths)
+    
+    def _stat(self, file_path):
+        try:
+            st = os.stat(file_path)
+            return (st.st_size, st.st_mtime_ns, st.st_ino)
+        except OSError:
+            return None
+    
+    def wait(self, timeout):
+        '''
+        Wait up to `timeout` seconds for files to change. Returns the set of
+        paths that changed, possibly empty.
+        '''
+        timeout = max(0, min(timeout, self.next_scan - time.time()))
+        time.sleep(timeout)
+        if time.time() < self.next_scan:
+            return set()
+        self.next_scan = time.time() + self.scan_interval
+        changed = set()
+        for file_path in self.file_paths:
+            st = self._stat(file_path)
+            if st != self.stats.get(file_path):
+                self.stats[file_path] = st
+                changed.add(file_path)
+        return changed
+    
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    '''
+    Report which of a set of files changed as soon as they are written, using
+    Linux inotify. The directories holding the files are watched rather than
+    the files, so files that are replaced or recreated are still seen.
+    '''
+    def __init__(self, file_paths, scan_interval=10):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+        super(InotifyWatcher, self).__init__(file_paths, scan_interval)
+    
+    def set_paths(self, file_paths):
+        self.file_paths = set(file_paths)
+        for directory in set(os.path.dirname(p) for p in self.file_paths):
+            if directory in self.watches.values():
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = directory
+    
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not ready:
+            return set()
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, any of the files may have changed.
+                return set(self.file_paths)
+            if wd in self.watches and name:
+                file_path = os.path.join(self.watches[wd], os.fsdecode(name))
+                if file_path in self.file_paths:
+                    changed.add(file_path)
+        return changed
+    
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(file_paths, scan_interval=10):
+    '''
+    Return an `InotifyWatcher` where inotify is available, a scanning
+    `Watcher` otherwise.
+    '''
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(file_paths, scan_interval)
+        except (OSError, AttributeError):
+            pass
+    return Watcher(file_paths, scan_interval)
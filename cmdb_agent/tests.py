@@ -0,0 +1,487 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import requests
+
+# The agent imports its modules as `lib.*`, from its own directory.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import lib.lib
+from lib import daemon, hash_tree, local_index, poll, session, watch
+from lib.hash_tree import HashTree
+from lib.local_index import LocalIndex
+
+
+class FakeResponse(object):
+    def __init__(self, payload, status_code=200, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode('UTF-8') if payload is not None else b''
+        self.headers = headers or {'Content-Type': 'application/json'}
+
+
+class TreeSession(object):
+    '''
+    Answer `/clients/tree/` requests from a hash tree, as the server does.
+    '''
+    def __init__(self, tree, etag='"tree"', cursor=7):
+        self.tree = tree
+        self.etag = etag
+        self.cursor = cursor
+        self.requests = []
+    
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.requests.append(params.get('prefix'))
+        if headers and headers.get('If-None-Match') == self.etag:
+            return FakeResponse(None, 304, {'ETag': self.etag})
+        details = {
+            'is_disabled': False,
+            'is_blacklisted': False,
+            'cursor': self.cursor,
+            'depth': self.tree.depth,
+            'nodes': [self.tree.get_node(prefix) for prefix in params.get('prefix')],
+        }
+        return FakeResponse(details, headers={'Content-Type': 'application/json', 'ETag': self.etag})
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+    
+    def time(self):
+        return self.now
+
+
+class FakeWatcher(object):
+    '''
+    Report the changes of `steps`, `(seconds, paths)` pairs, one per wait,
+    moving `clock` on by `seconds`, or by the whole timeout if it is None.
+    Stops the daemon once they run out.
+    '''
+    scan_interval = 10
+    
+    def __init__(self, clock, steps):
+        self.clock = clock
+        self.steps = list(steps)
+        self.timeouts = []
+    
+    def set_paths(self, file_paths):
+        pass
+    
+    def wait(self, timeout):
+        if not self.steps:
+            raise KeyboardInterrupt()
+        self.timeouts.append(timeout)
+        seconds, paths = self.steps.pop(0)
+        self.clock.now += timeout if seconds is None else seconds
+        return set(paths)
+    
+    def close(self):
+        pass
+
+
+class AgentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.config = {
+            'AGENT_ROOT_DIR': self.root_dir,
+            'HOSTNAME': 'cmdb.example.com',
+            'PORT': 80,
+            'URI': '/cmdb',
+            'API_KEY': 'a' * 40,
+            'POLL_LOG_FILE': 'agent.log',
+            'ENCRYPTION_KEY': '',
+        }
+        patcher = mock.patch('lib.lib.get_config', return_value=self.config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        local_index._index = None
+        session._session = None
+        self.stdout = io.StringIO()
+        redirect = redirect_stdout(self.stdout)
+        redirect.__enter__()
+        self.addCleanup(redirect.__exit__, None, None, None)
+    
+    def tearDown(self):
+        local_index._index = None
+        session._session = None
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+    
+    def write_file(self, name, content, age=60):
+        file_path = os.path.join(self.root_dir, name)
+        with open(file_path, 'wb') as fh:
+            fh.write(content)
+        mtime = time.time() - age
+        os.utime(file_path, (mtime, mtime))
+        return file_path
+
+
+class SyncOrderTests(AgentTestCase):
+    def test_output_follows_manifest_order(self):
+        configs = [{'file_path': '/etc/test/{}.conf'.format(i), 'sha1_checksum': str(i) * 40, 'revision': 1}
+                   for i in range(6)]
+        
+        def sync_file(config, api_key, configuration, local_future):
+            # The first files of the manifest finish last.
+            i = int(configuration.get('sha1_checksum')[0])
+            time.sleep((len(configs) - i) * 0.02)
+            lib.lib.log('synced {}'.format(configuration.get('file_path')))
+            return 'synced', configuration
+        
+        synced = {}
+        with mock.patch('lib.poll.sync_file', sync_file), mock.patch('lib.poll.resolve_local_file'):
+            failed, is_pushed = poll.sync_files(dict(self.config, SYNC_WORKERS=6), 'a' * 40, synced, configs)
+        self.assertEqual((failed, is_pushed), ([], True))
+        self.assertEqual(self.stdout.getvalue().splitlines(),
+                         ['synced {}'.format(c['file_path']) for c in configs])
+        self.assertEqual(sorted(synced), [c['file_path'] for c in configs])
+    
+    def test_failed_files_are_reported(self):
+        configs = [{'file_path': '/etc/test/{}.conf'.format(i), 'sha1_checksum': str(i) * 40, 'revision': 1}
+                   for i in range(3)]
+        
+        def sync_file(config, api_key, configuration, local_future):
+            if configuration.get('file_path') == '/etc/test/1.conf':
+                return None, None
+            return 'synced', configuration
+        
+        synced = {}
+        with mock.patch('lib.poll.sync_file', sync_file), mock.patch('lib.poll.resolve_local_file'):
+            failed, is_pushed = poll.sync_files(self.config, 'a' * 40, synced, configs)
+        self.assertEqual(failed, ['/etc/test/1.conf'])
+        self.assertEqual(sorted(synced), ['/etc/test/0.conf', '/etc/test/2.conf'])
+    
+    def test_errors_fail_only_their_file(self):
+        configs = [{'file_path': '/etc/test/{}.conf'.format(i), 'sha1_checksum': str(i) * 40, 'revision': 1}
+                   for i in range(3)]
+        
+        def sync_file(config, api_key, configuration, local_future):
+            lib.lib.log('syncing {}'.format(configuration.get('file_path')))
+            if configuration.get('file_path') == '/etc/test/1.conf':
+                raise PermissionError(13, 'Permission denied')
+            return 'synced', configuration
+        
+        synced = {}
+        with mock.patch('lib.poll.sync_file', sync_file), mock.patch('lib.poll.resolve_local_file'):
+            failed, is_pushed = poll.sync_files(self.config, 'a' * 40, synced, configs)
+        self.assertEqual(failed, ['/etc/test/1.conf'])
+        self.assertEqual(sorted(synced), ['/etc/test/0.conf', '/etc/test/2.conf'])
+        lines = self.stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertIn('/etc/test/1.conf could not be synced: PermissionError', lines[2])
+
+
+class LocalIndexTests(AgentTestCase):
+    def test_unchanged_file_is_not_read_again(self):
+        file_path = self.write_file('a.conf', b'setting = 1\n')
+        index = LocalIndex(os.path.join(self.root_dir, 'index.json'))
+        entry = index.lookup(file_path)
+        self.assertEqual(entry[3], lib.lib.file_checksums(file_path)[0])
+        with mock.patch('lib.lib.file_checksums') as file_checksums:
+            self.assertEqual(index.lookup(file_path), entry)
+        self.assertFalse(file_checksums.called)
+    
+    def test_changed_stat_data_rehashes(self):
+        file_path = self.write_file('a.conf', b'setting = 1\n')
+        index = LocalIndex(os.path.join(self.root_dir, 'index.json'))
+        entry = index.lookup(file_path)
+        index.set_revision(file_path, 3)
+        self.write_file('a.conf', b'setting = 2\n', age=30)
+        changed = index.lookup(file_path)
+        self.assertNotEqual(changed[3], entry[3])
+        self.assertEqual(changed[5], 3)
+    
+    def test_racily_clean_file_is_not_indexed(self):
+        # Modified within RACY_SECONDS, a change made now might not move its
+        # mtime, so it is hashed every time until it settles.
+        file_path = self.write_file('a.conf', b'setting = 1\n', age=0)
+        index = LocalIndex(os.path.join(self.root_dir, 'index.json'))
+        index.lookup(file_path)
+        self.assertNotIn(file_path, index.entries)
+        self.assertFalse(index.is_changed)
+        
+        old = time.time() - local_index.RACY_SECONDS - 1
+        os.utime(file_path, (old, old))
+        index.lookup(file_path)
+        self.assertIn(file_path, index.entries)
+    
+    def test_text_and_binary_checksums(self):
+        text_path = self.write_file('a.conf', b'setting = 1\r\n')
+        binary_path = self.write_file('b.bin', b'\xff\xfe\x00')
+        index = LocalIndex(os.path.join(self.root_dir, 'index.json'))
+        self.assertEqual(index.checksum(text_path, True), lib.lib.file_checksum(text_path))
+        self.assertIsNotNone(index.checksum(text_path, False))
+        self.assertIsNone(index.checksum(binary_path, False))
+    
+    def test_saved_index_is_loaded(self):
+        file_path = self.write_file('a.conf', b'setting = 1\n')
+        index = local_index.get_index(self.config)
+        entry = index.lookup(file_path)
+        index.save()
+        self.assertFalse(index.is_changed)
+        self.assertEqual(LocalIndex.load(self.config).entries, {file_path: entry})
+        
+        with open(lib.lib.get_config_index_file_path(self.config), 'w') as fh:
+            fh.write('not json')
+        self.assertEqual(LocalIndex.load(self.config).entries, {})
+
+
+class UploadBodyTests(AgentTestCase):
+    def test_text_is_uploaded_with_unix_line_endings(self):
+        # Small chunks split the CRLFs and the two bytes of the 'é'.
+        file_path = self.write_file('a.conf', 'a = 1\r\nb = \u00e9\r\n'.encode('UTF-8') * 50)
+        index = LocalIndex(os.path.join(self.root_dir, 'index.json'))
+        body, sha1_checksum, is_binary = lib.lib.get_upload_body(file_path, chunk_size=3)
+        with body:
+            content = body.read(7) + body.read()
+        self.assertEqual(content, 'a = 1\nb = \u00e9\n'.encode('UTF-8') * 50)
+        self.assertEqual(len(body), len(content))
+        self.assertEqual(sha1_checksum, index.lookup(file_path)[4])
+        self.assertFalse(is_binary)
+    
+    def test_binary_is_uploaded_as_is(self):
+        file_path = self.write_file('b.bin', b'\xff\xfe\r\n\x00')
+        body, sha1_checksum, is_binary = lib.lib.get_upload_body(file_path)
+        with body:
+            self.assertEqual(body.read(), b'\xff\xfe\r\n\x00')
+        self.assertEqual(sha1_checksum, lib.lib.file_checksum(file_path))
+        self.assertTrue(is_binary)
+
+
+class TreeChangesTests(AgentTestCase):
+    def setUp(self):
+        super(TreeChangesTests, self).setUp()
+        self.entries = [('/etc/test/{}.conf'.format(i), '{:040x}'.format(i), 1) for i in range(300)]
+        self.state = {'entries': dict((p, [s, r]) for p, s, r in self.entries)}
+    
+    def get_tree_changes(self, server_entries, state):
+        tree_session = TreeSession(HashTree(server_entries))
+        
+        def fetch_many(url, api_key, file_paths, inline=None):
+            server = dict((p, (s, r)) for p, s, r in server_entries)
+            return dict((p, {'file_path': p, 'sha1_checksum': server[p][0], 'revision': server[p][1]})
+                        for p in file_paths if p != '/etc/test/missing.conf')
+        
+        with mock.patch('lib.poll.get_session', return_value=tree_session), \
+             mock.patch('lib.poll.fetch_many', fetch_many):
+            req, payload = poll.get_tree_changes(self.config, 'a' * 40, state)
+        return req, payload, tree_session.requests
+    
+    def test_nothing_changed(self):
+        req, payload, requests = self.get_tree_changes(self.entries, self.state)
+        self.assertEqual(payload['configurations'], [])
+        self.assertEqual(payload['removed'], [])
+        self.assertEqual(requests, [['']])
+        self.assertEqual(req.headers['ETag'], '"tree"')
+    
+    def test_walk_finds_only_what_changed(self):
+        server_entries = [e for e in self.entries if e[0] != '/etc/test/8.conf']
+        server_entries[7] = ('/etc/test/7.conf', 'f' * 40, 2)
+        server_entries.append(('/etc/test/new.conf', 'e' * 40, 1))
+        server_entries.append(('/etc/test/missing.conf', 'd' * 40, 1))
+        req, payload, requests = self.get_tree_changes(server_entries, self.state)
+        self.assertEqual(sorted(c['file_path'] for c in payload['configurations']),
+                         ['/etc/test/7.conf', '/etc/test/new.conf'])
+        self.assertEqual(payload['removed'], ['/etc/test/8.conf'])
+        self.assertEqual(payload['missing'], ['/etc/test/missing.conf'])
+        self.assertEqual(payload['cursor'], 7)
+        self.assertLessEqual(len(requests), hash_tree.DEPTH + 1)
+        self.assertNotIn('/etc/test/0.conf', [c['file_path'] for c in payload['configurations']])
+    
+    def test_unchanged_tree_is_not_walked(self):
+        state = dict(self.state, manifest_etag='"tree"')
+        req, payload, requests = self.get_tree_changes(self.entries, state)
+        self.assertEqual(req.status_code, 304)
+        self.assertEqual(payload, {})
+        self.assertEqual(len(requests), 1)
+
+
+class DownloadTests(AgentTestCase):
+    def download(self, configuration):
+        with mock.patch('lib.poll.fetch', return_value=True) as fetch:
+            self.assertTrue(poll.download(self.config, 'a' * 40, configuration))
+        return fetch.call_args[0]
+    
+    def test_blob_with_a_token_is_fetched_without_the_api_key(self):
+        configuration = {'file_path': '/etc/test/0.conf', 'sha1_checksum': 'b' * 40, 'blob_token': 'c' * 40}
+        url, api_key = self.download(configuration)[:2]
+        self.assertTrue(url.endswith('/clients/blob/{}/{}/'.format('b' * 40, 'c' * 40)))
+        self.assertIsNone(api_key)
+    
+    def test_blob_without_a_token_is_fetched_with_the_api_key(self):
+        url, api_key = self.download({'file_path': '/etc/test/0.conf', 'sha1_checksum': 'b' * 40})[:2]
+        self.assertTrue(url.endswith('/clients/blob/{}/'.format('b' * 40)))
+        self.assertEqual(api_key, 'a' * 40)
+
+
+class IncrementalSyncTests(AgentTestCase):
+    def run_sync(self, state, changes_cursor):
+        lib.lib.save_state(self.config, state)
+        calls = []
+        
+        def get_changes(config, api_key, state):
+            calls.append(('changes', state.get('cursor', 0)))
+            return FakeResponse(None, headers={'ETag': '"changes"'}), {'configurations': [], 'cursor': changes_cursor}
+        
+        def get_tree_changes(config, api_key, state):
+            calls.append(('tree', None))
+            return FakeResponse(None, headers={'ETag': '"tree"'}), {'configurations': [], 'cursor': 4}
+        
+        with mock.patch('lib.poll.get_changes', get_changes), \
+             mock.patch('lib.poll.get_tree_changes', get_tree_changes), \
+             mock.patch('lib.poll.get_local_changes', return_value=[]):
+            self.assertEqual(poll.run_sync(self.config), 0)
+        return calls, lib.lib.load_state(self.config)
+    
+    def test_first_sync_lists_every_file(self):
+        calls, state = self.run_sync({}, 5)
+        self.assertEqual(calls, [('changes', 0)])
+        self.assertEqual(state['cursor'], 5)
+    
+    def test_saved_cursor_is_used(self):
+        calls, state = self.run_sync({'entries': {}, 'cursor': 5}, 9)
+        self.assertEqual(calls, [('changes', 5)])
+        self.assertEqual(state['cursor'], 9)
+    
+    def test_state_without_a_cursor_walks_the_tree(self):
+        calls, state = self.run_sync({'entries': {}}, 9)
+        self.assertEqual(calls, [('tree', None)])
+        self.assertEqual(state['cursor'], 4)
+    
+    def test_cursor_the_server_hasnt_reached_walks_the_tree(self):
+        calls, state = self.run_sync({'entries': {}, 'cursor': 5}, 3)
+        self.assertEqual(calls, [('changes', 5), ('tree', None)])
+        self.assertEqual(state['cursor'], 4)
+        self.assertEqual(state['manifest_etag'], '"tree"')
+
+
+class WatcherTests(AgentTestCase):
+    def test_scan_coalesces_changes(self):
+        file_path = self.write_file('a.conf', b'setting = 1\n')
+        other_path = self.write_file('b.conf', b'setting = 1\n')
+        watcher = watch.Watcher([file_path, other_path], scan_interval=0)
+        self.assertEqual(watcher.wait(0), set())
+        
+        for i in range(3):
+            self.write_file('a.conf', 'setting = {}\n'.format(i).encode('UTF-8'), age=10 - i)
+        self.assertEqual(watcher.wait(0), set([file_path]))
+        self.assertEqual(watcher.wait(0), set())
+        
+        os.unlink(other_path)
+        self.assertEqual(watcher.wait(0), set([other_path]))
+    
+    def test_scan_waits_for_its_interval(self):
+        file_path = self.write_file('a.conf', b'setting = 1\n')
+        watcher = watch.Watcher([file_path], scan_interval=60)
+        self.write_file('a.conf', b'setting = 2\n', age=10)
+        self.assertEqual(watcher.wait(0), set())
+    
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux.')
+    def test_inotify_reports_watched_files_once(self):
+        file_path = self.write_file('a.conf', b'setting = 1\n')
+        watcher = watch.get_watcher([file_path])
+        if not isinstance(watcher, watch.InotifyWatcher):
+            watcher.close()
+            self.skipTest('inotify is not available.')
+        self.addCleanup(watcher.close)
+        
+        for i in range(3):
+            self.write_file('a.conf', 'setting = {}\n'.format(i).encode('UTF-8'))
+        self.write_file('untracked.conf', b'setting = 1\n')
+        # Editors replace files by renaming a new one over them.
+        temp_path = self.write_file('a.conf.tmp', b'setting = 3\n')
+        os.replace(temp_path, file_path)
+        changed = set()
+        for _ in range(10):
+            changed |= watcher.wait(0.1)
+        self.assertEqual(changed, set([file_path]))
+
+
+class DaemonTests(AgentTestCase):
+    def run_daemon(self, steps, **config):
+        clock = FakeClock()
+        watcher = FakeWatcher(clock, steps)
+        config = dict(self.config, POLL_INTERVAL=300, PUSH_DELAY=2, **config)
+        with mock.patch('lib.daemon.time', clock), \
+             mock.patch('lib.daemon.get_watcher', return_value=watcher):
+            daemon.daemon([], config)
+        return watcher
+    
+    def test_writes_are_debounced(self):
+        run_sync = mock.Mock(return_value=0)
+        sync_local_changes = mock.Mock(return_value=[])
+        with mock.patch('lib.daemon.run_sync', run_sync), \
+             mock.patch('lib.daemon.sync_local_changes', sync_local_changes):
+            watcher = self.run_daemon([
+                (0.5, ['/etc/a.conf']),
+                (1, ['/etc/a.conf', '/etc/b.conf']),
+                (1, ['/etc/a.conf']),
+                (None, []),
+                (None, []),
+            ])
+        self.assertEqual(run_sync.call_count, 1)
+        # A burst of writes is pushed once, PUSH_DELAY after the last of them.
+        self.assertEqual(sync_local_changes.call_count, 2)
+        self.assertEqual(sorted(sync_local_changes.call_args_list[0][0][1]), ['/etc/b.conf'])
+        self.assertEqual(sorted(sync_local_changes.call_args_list[1][0][1]), ['/etc/a.conf'])
+        self.assertEqual(watcher.timeouts[:3], [300, 2, 2])
+    
+    def test_server_errors_dont_stop_the_daemon(self):
+        run_sync = mock.Mock(side_effect=[requests.exceptions.ConnectionError('refused'),
+                                          TypeError('bad payload'), 0])
+        sync_local_changes = mock.Mock(side_effect=OSError(13, 'Permission denied'))
+        with mock.patch('lib.daemon.run_sync', run_sync), \
+             mock.patch('lib.daemon.sync_local_changes', sync_local_changes):
+            self.run_daemon([
+                (None, ['/etc/a.conf']),
+                (None, []),
+                (None, []),
+            ])
+        self.assertEqual(run_sync.call_count, 3)
+        self.assertEqual(sync_local_changes.call_count, 1)
+        output = self.stdout.getvalue()
+        self.assertIn('Could not reach the server: refused', output)
+        self.assertIn('Sync failed: TypeError: bad payload', output)
+        self.assertIn('Sync failed: PermissionError', output)
+        self.assertIn('Daemon stopped.', output)
+    
+    def test_error_responses_are_json_errors(self):
+        cwd = os.getcwd()
+        os.chdir(self.root_dir)
+        self.addCleanup(os.chdir, cwd)
+        response = FakeResponse(None, 500)
+        response.content = b'<html>Internal Server Error</html>'
+        self.assertIn('error', json.loads(lib.lib.get_response_body(response)))
+        response = FakeResponse({'error': 'Remote file not found.'}, 404)
+        self.assertEqual(json.loads(lib.lib.get_response_body(response)), {'error': 'Remote file not found.'})
+
+
+class SessionTests(AgentTestCase):
+    def test_large_bodies_are_sent_gzip_encoded(self):
+        agent_session = session.AgentSession(dict(self.config, GZIP_REQUESTS=True, GZIP_MIN_SIZE=64))
+        with mock.patch.object(agent_session.session, 'request') as request:
+            body = json.dumps({'files': ['/etc/test/{}.conf'.format(i) for i in range(20)]})
+            agent_session.post('http://cmdb.example.com/', data=body)
+            kwargs = request.call_args[1]
+            self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(kwargs['data']).decode('UTF-8'), body)
+            self.assertEqual(kwargs['timeout'], (10, 300))
+            
+            agent_session.post('http://cmdb.example.com/', data='{}')
+            kwargs = request.call_args[1]
+            self.assertEqual(kwargs['data'], '{}')
+            self.assertNotIn('headers', kwargs)
+    
+    def test_gzip_is_off_by_default(self):
+        agent_session = session.AgentSession(self.config)
+        with mock.patch.object(agent_session.session, 'request') as request:
+            agent_session.post('http://cmdb.example.com/', data='x' * 4096)
+            self.assertEqual(request.call_args[1]['data'], 'x' * 4096)